@@ -1,5 +1,8 @@
 import os
 import shutil
+from tqdm import tqdm
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -13,19 +16,23 @@ def clean_download_dir(download_dir):
     shutil.rmtree(download_dir)
 
 
-def clean_analysis_dir(analysis_dir):
+def clean_analysis_dir(analysis_dir, keep_extensions=()):
     """Cleans the analysis directory from previously created files.
 
     :param analysis_dir: analysis directory
     :type analysis_dir: str
+    :param keep_extensions: extensions of the files to keep, e.g. rendered figures that can be reused
+    :type keep_extensions: tuple
     """
     for el in os.listdir(analysis_dir):
         path = os.path.join(analysis_dir, el)
         if not os.path.isdir(path):
-            os.remove(path=path)
+            if not el.endswith(tuple(keep_extensions)):
+                os.remove(path=path)
         else:
             for subfile in os.listdir(path=path):
-                os.remove(os.path.join(path, subfile))
+                if not subfile.endswith(tuple(keep_extensions)):
+                    os.remove(os.path.join(path, subfile))
 
 
 def value_valid_mix(x):
@@ -39,4 +46,30 @@ def value_valid_mix(x):
     if x[1]:
         return x[0]
     else:
-        return np.nan
\ No newline at end of file
+        return np.nan
+
+
+def run_in_pool(func, args_list, n_jobs, desc):
+    """Runs func on every element of args_list in a process pool, returning the results in the order of args_list
+    and showing the number of completed tasks per worker
+
+    :param func: picklable function returning (pid, result)
+    :type func: callable
+    :param args_list: list of arguments
+    :type args_list: list
+    :param n_jobs: number of worker processes
+    :type n_jobs: int
+    :param desc: progress bar description
+    :type desc: str
+    :return: list of results
+    :rtype: list
+    """
+    results = []
+    worker_counter = Counter()
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(args_list), desc=desc) as pbar:
+        for pid, res in executor.map(func, args_list):
+            worker_counter[pid] += 1
+            pbar.set_postfix({f"worker_{i}": count for i, count in enumerate(worker_counter.values())})
+            pbar.update()
+            results.append(res)
+    return results
@@ -9,15 +9,134 @@ def pair_to_str(pair):
     return pair[0] + "_" + pair[1]
 
 
-def avg_corr(discriminant_column, corr_dir):
-    """Computes average correlation for using a discriminant
+def get_corr_files(discriminant_column, corr_dir):
+    """Returns the correlation matrix files of a discriminant
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param corr_dir: directory containing the correlation matrices
+    :type corr_dir: str
+    :return: list of file names
+    :rtype: list
+    """
+    return [file for file in os.listdir(corr_dir) if file.endswith("_corr.pkl") and discriminant_column in file]
+
+
+def get_corr_sources(discriminant_column, corr_dir):
+    """Returns the files a tensor of a discriminant is built from, correlation matrices and overlap counts, with their
+    modification times, used to detect whether a saved tensor is stale
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param corr_dir: directory containing the correlation matrices
+    :type corr_dir: str
+    :return: sorted array of "file name:modification time in ns"
+    :rtype: np.ndarray
+    """
+    files = get_corr_files(discriminant_column, corr_dir)
+    files += [file.replace("_corr.pkl", "_count.pkl") for file in files]
+    return np.array(sorted(f"{file}:{os.stat(os.path.join(corr_dir, file)).st_mtime_ns}" for file in files
+                           if os.path.exists(os.path.join(corr_dir, file))), dtype=str)
+
+
+def load_corr_tensor(discriminant_column, corr_dir):
+    """Loads all the correlation matrices of a discriminant in one array aligned over the union of their labels.
+    The overlap counts saved by madrid_analysis.save_batched_corr_mat are loaded as well when available.
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param corr_dir: directory containing the correlation matrices
+    :type corr_dir: str
+    :return: {"values": array (file, label, label), "counts": array (file, label, label) or None,
+        "labels": array of labels, "files": array of file names}, with no files and no labels if there are no
+        matrices
+    :rtype: dict
+    """
+    df_file_list = get_corr_files(discriminant_column, corr_dir)
+    corr_list = [pd.read_pickle(os.path.join(corr_dir, file)) for file in df_file_list]
+    labels = pd.Index([])
+    for corr in corr_list:
+        labels = labels.append(corr.columns.difference(labels, sort=False))
+    values = np.empty((0, 0, 0))
+    if len(corr_list) > 0:
+        values = np.stack([corr.reindex(index=labels, columns=labels).to_numpy(dtype=float) for corr in corr_list])
+    count_files = [os.path.join(corr_dir, file.replace("_corr.pkl", "_count.pkl")) for file in df_file_list]
+    counts = None
+    if len(count_files) > 0 and all(os.path.exists(file) for file in count_files):
+        counts = np.stack([pd.read_pickle(file).reindex(index=labels, columns=labels).fillna(0).to_numpy(dtype=float)
+                           for file in count_files])
+    return {"values": values, "counts": counts, "labels": np.array(labels, dtype=str),
+            "files": np.array(df_file_list, dtype=str)}
+
+
+def save_corr_tensor(tensor, path):
+    """Saves a tensor returned by load_corr_tensor in one compressed file
+
+    :param tensor: correlation tensor
+    :type tensor: dict
+    :param path: file path, .npz
+    :type path: str
+    """
+    np.savez_compressed(path, **{key: value for key, value in tensor.items() if value is not None})
+
+
+def load_saved_corr_tensor(path):
+    """Loads a tensor saved by save_corr_tensor
+
+    :param path: file path
+    :type path: str
+    :return: correlation tensor
+    :rtype: dict
+    """
+    with np.load(path) as data:
+        tensor = {key: data[key] for key in data.files}
+    tensor.setdefault("counts", None)
+    return tensor
+
+
+def aggregate_corr(tensor):
+    """Aggregates the correlation matrices of a tensor for every pair of labels ignoring np.nan
+
+    :param tensor: correlation tensor as returned by load_corr_tensor
+    :type tensor: dict
+    :return: DataFrame with one row per pair and mean, count, abs_mean (absolute value of mean), mean_abs (mean of
+        absolute values), std and weighted_mean (mean weighted by the overlap counts, when available) columns
+    :rtype: pd.DataFrame
+    """
+    labels = tensor["labels"]
+    first, second = np.triu_indices(len(labels), k=1)
+    # Same element as df[pair[0]].loc[pair[1]]
+    pair_values = tensor["values"][:, second, first]
+    valid = ~np.isnan(pair_values)
+    count = valid.sum(axis=0)
+    filled = np.where(valid, pair_values, 0.)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / count
+        mean_abs = np.abs(filled).sum(axis=0) / count
+        std = np.sqrt(((filled - mean) ** 2 * valid).sum(axis=0) / (count - 1))
+        if tensor["counts"] is not None:
+            weights = np.where(valid, tensor["counts"][:, second, first], 0.)
+            weighted_mean = (filled * weights).sum(axis=0) / weights.sum(axis=0)
+        else:
+            weighted_mean = mean
+    return pd.DataFrame({"pivot_combinations": [pair_to_str(pair) for pair in zip(labels[first], labels[second])],
+                         "mean": mean,
+                         "count": count,
+                         "abs_mean": np.abs(mean),
+                         "mean_abs": mean_abs,
+                         "std": std,
+                         "weighted_mean": weighted_mean})
+
+
+def avg_corr_loop(discriminant_column, corr_dir):
+    """Computes average correlation for using a discriminant looping over files and pairs
 
     :param discriminant_column: column acting as discriminant
     :type discriminant_column: str
     :return mean_corr_df: DataFrame with correlation means
     :rtype mean_corr_df: pd.DataFrame
     """
-    df_file_list = [file for file in os.listdir(corr_dir) if ".pkl" in file and discriminant_column in file]
+    df_file_list = get_corr_files(discriminant_column, corr_dir)
     first_df = pd.read_pickle(os.path.join(corr_dir, df_file_list[0]))
     pivot_combinations = list(itertools.combinations(first_df.columns, 2))
     corr_dict = {pair_to_str(pair): {"count": 0, "mean": 0} for pair in pivot_combinations}
@@ -37,6 +156,40 @@ def avg_corr(discriminant_column, corr_dir):
     return mean_corr_df
 
 
+def avg_corr(discriminant_column, corr_dir, tensor_file=None):
+    """Computes average correlation for using a discriminant. Pairs are taken over the union of the labels of all
+    the matrices.
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param corr_dir: directory containing the correlation matrices
+    :type corr_dir: str
+    :param tensor_file: consolidated tensor file, .npz. It is used if it was built from the same files with the same
+        modification times, see get_corr_sources, otherwise it is rebuilt from the matrices. None always reads the
+        matrices.
+    :type tensor_file: str
+    :return mean_corr_df: DataFrame with correlation means, empty if there are no matrices
+    :rtype mean_corr_df: pd.DataFrame
+    """
+    tensor = None
+    if tensor_file is not None:
+        sources = get_corr_sources(discriminant_column, corr_dir)
+        if os.path.exists(tensor_file):
+            tensor = load_saved_corr_tensor(tensor_file)
+            if "sources" not in tensor or not np.array_equal(tensor["sources"], sources):
+                tensor = None
+    if tensor is None:
+        tensor = load_corr_tensor(discriminant_column, corr_dir)
+        if tensor_file is not None:
+            tensor["sources"] = sources
+            save_corr_tensor(tensor, tensor_file)
+    mean_corr_df = aggregate_corr(tensor)
+    mean_corr_df.sort_values("abs_mean", ascending=False, inplace=True)
+    return mean_corr_df
+
+
 if __name__ == "__main__":
-    print(avg_corr(discriminant_column=station_col, corr_dir=madrid_corr_dir))
-    print(avg_corr(discriminant_column=pollutant_col, corr_dir=madrid_corr_dir))
+    print(avg_corr(discriminant_column=station_col, corr_dir=madrid_corr_dir,
+                   tensor_file=os.path.join(madrid_corr_dir, f"{station_col}_corr_tensor.npz")))
+    print(avg_corr(discriminant_column=pollutant_col, corr_dir=madrid_corr_dir,
+                   tensor_file=os.path.join(madrid_corr_dir, f"{pollutant_col}_corr_tensor.npz")))
@@ -0,0 +1,256 @@
+import numpy as np
+import pandas as pd
+
+corr_methods = ["pearson", "spearman"]
+# Variances up to var_rtol times the sum of squares they are computed from are rounding residuals of a constant
+# variable, e.g. of a variable constant only over the times shared with the other one
+var_rtol = 1e-12
+
+
+def nan_rank(values):
+    """Ranks values along the time axis ignoring np.nan, ties get their average rank
+
+    :param values: array (group, time, variable)
+    :type values: np.ndarray
+    :return: array of ranks with np.nan where values is np.nan
+    :rtype: np.ndarray
+    """
+    ranks = np.empty(values.shape, dtype=float)
+    for i in range(values.shape[0]):
+        ranks[i] = pd.DataFrame(values[i]).rank(axis=0).to_numpy()
+    return ranks
+
+
+def corr_moments(values, shift=None):
+    """Computes the pairwise complete co-moment sums of all the groups of a stacked array. Sums of different chunks
+    of time computed with the same shift can be added to get the sums of the whole time axis, see merge_corr_moments.
+
+    :param values: array (group, time, variable) with np.nan for missing values
+    :type values: np.ndarray
+    :param shift: array (group, 1, variable) subtracted from the values before summing, the closer to the means the
+        smaller the cancellation in the sums of products. None uses the means of values.
+    :type shift: np.ndarray
+    :return: {"counts", "sum_x", "sum_xx", "sum_xy"} arrays (group, variable, variable), sum_x[g, i, j] is the sum
+        of x_i over the times where x_j is valid, and "shift"
+    :rtype: dict
+    """
+    values = np.asarray(values, dtype=float)
+    mask = ~np.isnan(values)
+    m = mask.astype(float)
+    if shift is None:
+        sums = np.where(mask, values, 0.).sum(axis=1, keepdims=True)
+        n_valid = m.sum(axis=1, keepdims=True)
+        shift = np.divide(sums, n_valid, out=np.zeros_like(sums), where=n_valid > 0)
+    x = np.where(mask, values - shift, 0.)
+    m_t, x_t = m.transpose(0, 2, 1), x.transpose(0, 2, 1)
+    return {"counts": m_t @ m,
+            "sum_x": x_t @ m,
+            "sum_xx": (x_t * x_t) @ m,
+            "sum_xy": x_t @ x,
+            "shift": shift}
+
+
+def merge_corr_moments(moments, other):
+    """Adds the co-moment sums of two chunks of time computed with the same shift
+
+    :param moments: co-moment sums as returned by corr_moments
+    :type moments: dict
+    :param other: co-moment sums as returned by corr_moments
+    :type other: dict
+    :return: co-moment sums of both chunks
+    :rtype: dict
+    """
+    if not np.array_equal(moments["shift"], other["shift"]):
+        raise ValueError("co-moment sums computed with different shifts cannot be merged")
+    merged = {key: moments[key] + other[key] for key in ["counts", "sum_x", "sum_xx", "sum_xy"]}
+    merged["shift"] = moments["shift"]
+    return merged
+
+
+def corr_from_moments(moments, min_periods=1):
+    """Computes the pairwise complete correlation matrices from co-moment sums
+
+    :param moments: co-moment sums as returned by corr_moments
+    :type moments: dict
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :return: (correlations, counts) arrays (group, variable, variable), counts are the common observations
+    :rtype: tuple
+    """
+    counts, sum_x = moments["counts"], moments["sum_x"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = moments["sum_xy"] - sum_x * sum_x.transpose(0, 2, 1) / counts
+        var_x = moments["sum_xx"] - sum_x ** 2 / counts
+        corr = cov / np.sqrt(var_x * var_x.transpose(0, 2, 1))
+    constant = var_x <= var_rtol * moments["sum_xx"]
+    corr[(counts < max(min_periods, 2)) | constant | constant.transpose(0, 2, 1)] = np.nan
+    return np.clip(corr, -1., 1.), counts.astype(np.int64)
+
+
+def _complete_corr(a, b, min_periods):
+    """Computes the correlation of every column of a with the same column of b, both np.nan at the same times
+
+    :param a: array (time, pair)
+    :type a: np.ndarray
+    :param b: array (time, pair)
+    :type b: np.ndarray
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :return: (correlations, counts) arrays (pair,)
+    :rtype: tuple
+    """
+    mask = ~np.isnan(a)
+    n = mask.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a = np.where(mask, a - np.where(mask, a, 0.).sum(axis=0) / n, 0.)
+        b = np.where(mask, b - np.where(mask, b, 0.).sum(axis=0) / n, 0.)
+        var_a, var_b = (a * a).sum(axis=0), (b * b).sum(axis=0)
+        corr = (a * b).sum(axis=0) / np.sqrt(var_a * var_b)
+    corr[(n < max(min_periods, 2)) | (var_a <= 0) | (var_b <= 0)] = np.nan
+    return np.clip(corr, -1., 1.), n
+
+
+def pairwise_spearman(values, min_periods=1):
+    """Computes the spearman correlation matrices of all the groups of a stacked array ranking every pair of
+    variables on the times where both are valid, as pd.DataFrame.corr(method="spearman"). Variables are ranked once
+    over all their valid values and only the pairs of variables missing at different times are ranked again, all the
+    pairs of a variable at once.
+
+    :param values: array (group, time, variable) with np.nan for missing values
+    :type values: np.ndarray
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :return: (correlations, counts) arrays (group, variable, variable), counts are the common observations
+    :rtype: tuple
+    """
+    values = np.asarray(values, dtype=float)
+    corr, counts = corr_from_moments(corr_moments(nan_rank(values)), min_periods=min_periods)
+    mask = ~np.isnan(values)
+    for g in range(values.shape[0]):
+        group_mask, group_values = mask[g], values[g]
+        for i in range(values.shape[2]):
+            others = i + 1 + np.nonzero((group_mask[:, i:i + 1] != group_mask[:, i + 1:]).any(axis=0))[0]
+            if len(others) == 0:
+                continue
+            pair_mask = group_mask[:, i:i + 1] & group_mask[:, others]
+            ranks_i = pd.DataFrame(np.where(pair_mask, group_values[:, i:i + 1], np.nan)).rank(axis=0).to_numpy()
+            ranks_j = pd.DataFrame(np.where(pair_mask, group_values[:, others], np.nan)).rank(axis=0).to_numpy()
+            pair_corr, _ = _complete_corr(ranks_i, ranks_j, min_periods=min_periods)
+            corr[g, i, others] = pair_corr
+            corr[g, others, i] = pair_corr
+    return corr, counts
+
+
+def batched_corr(values, method="pearson", min_periods=1):
+    """Computes the pairwise complete correlation matrices of all the groups of a stacked array in one vectorized
+    pass. For every pair of variables only the times where both are not np.nan are used, as in pd.DataFrame.corr.
+    With method="spearman" the ranks are computed by pairwise_spearman.
+
+    :param values: array (group, time, variable) with np.nan for missing values
+    :type values: np.ndarray
+    :param method: one of corr_methods
+    :type method: str
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :return: (correlations, counts) arrays (group, variable, variable), counts are the common observations
+    :rtype: tuple
+    """
+    if method not in corr_methods:
+        raise ValueError(f"method must be one of {corr_methods}")
+    values = np.asarray(values, dtype=float)
+    if method == "spearman":
+        return pairwise_spearman(values, min_periods=min_periods)
+    # Centering on the mean of each variable reduces the cancellation in the sums of products
+    return corr_from_moments(corr_moments(values), min_periods=min_periods)
+
+
+def _window_sums(a, starts, ends):
+    """Sums the rows of a inside every window using prefix sums, i.e. adding the rows entering and subtracting the
+    rows leaving the window as it moves forward
+
+    :param a: array (time, k)
+    :type a: np.ndarray
+    :param starts: first row of every window
+    :type starts: np.ndarray
+    :param ends: row after the last one of every window
+    :type ends: np.ndarray
+    :return: array (window, k)
+    :rtype: np.ndarray
+    """
+    prefix = np.zeros((a.shape[0] + 1, a.shape[1]))
+    np.cumsum(a, axis=0, out=prefix[1:])
+    return prefix[ends] - prefix[starts]
+
+
+def _window_ranges(a, window, ends):
+    """Returns the difference between the largest and the smallest value of every column of a inside every window,
+    ignoring np.nan
+
+    :param a: array (time, k) with np.nan for missing values
+    :type a: np.ndarray
+    :param window: number of rows of every window
+    :type window: int
+    :param ends: row after the last one of every window
+    :type ends: np.ndarray
+    :return: array (window, k), np.nan for windows without values
+    :rtype: np.ndarray
+    """
+    rolling = pd.DataFrame(a).rolling(window, min_periods=1)
+    return (rolling.max().to_numpy() - rolling.min().to_numpy())[ends - 1]
+
+
+def rolling_corr(values, window, step=1, min_periods=2, pair_block=256):
+    """Computes the pairwise complete correlation of every pair of variables over windows moving along the time
+    axis, as pd.DataFrame.corr on every window but from running co-moment sums instead of recomputing each window.
+    Pairs are processed in blocks to bound the memory of the sums. A variable constant over the common times of a
+    window, e.g. a stuck sensor, gives np.nan as in pd.DataFrame.corr.
+
+    :param values: array (time, variable) with np.nan for missing values, rows are consecutive times
+    :type values: np.ndarray
+    :param window: number of rows of every window
+    :type window: int
+    :param step: number of rows between the starts of consecutive windows
+    :type step: int
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :param pair_block: number of pairs processed together
+    :type pair_block: int
+    :return: (correlations, counts) arrays (window, pair), first row of every window and (first, second) variable
+        indices of every pair, in the order of np.triu_indices
+    :rtype: tuple
+    """
+    values = np.asarray(values, dtype=float)
+    n_times, n_vars = values.shape
+    starts = np.arange(0, max(n_times - window + 1, 0), step)
+    ends = starts + window
+    first, second = np.triu_indices(n_vars, k=1)
+    corr = np.full((len(starts), len(first)), np.nan)
+    counts = np.zeros((len(starts), len(first)), dtype=np.int64)
+    mask = ~np.isnan(values)
+    m = mask.astype(float)
+    # Centering on the mean of each variable reduces the cancellation in the sums and in their differences
+    n_valid = m.sum(axis=0)
+    shift = np.divide(np.where(mask, values, 0.).sum(axis=0), n_valid, out=np.zeros(n_vars), where=n_valid > 0)
+    x = np.where(mask, values - shift, 0.)
+    for block in range(0, len(first), pair_block):
+        i, j = first[block:block + pair_block], second[block:block + pair_block]
+        n = _window_sums(m[:, i] * m[:, j], starts, ends)
+        sum_x = _window_sums(x[:, i] * m[:, j], starts, ends)
+        sum_y = _window_sums(x[:, j] * m[:, i], starts, ends)
+        sum_xx = _window_sums(x[:, i] ** 2 * m[:, j], starts, ends)
+        sum_yy = _window_sums(x[:, j] ** 2 * m[:, i], starts, ends)
+        sum_xy = _window_sums(x[:, i] * x[:, j], starts, ends)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var_x = sum_xx - sum_x ** 2 / n
+            var_y = sum_yy - sum_y ** 2 / n
+            block_corr = (sum_xy - sum_x * sum_y / n) / np.sqrt(var_x * var_y)
+        # Differences of prefix sums leave rounding residuals of the order of the sums of all the previous rows where
+        # the variance is zero, so constant windows are found from their range instead
+        both = mask[:, i] & mask[:, j]
+        range_x = _window_ranges(np.where(both, values[:, i], np.nan), window, ends)
+        range_y = _window_ranges(np.where(both, values[:, j], np.nan), window, ends)
+        constant = (range_x == 0) | (range_y == 0) | (var_x <= 0) | (var_y <= 0)
+        block_corr[(n < max(min_periods, 2)) | constant] = np.nan
+        corr[:, block:block + pair_block] = np.clip(block_corr, -1., 1.)
+        counts[:, block:block + pair_block] = np.rint(n).astype(np.int64)
+    return corr, counts, starts, (first, second)
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+from madrid_utilities import station_col, pollutant_col, concentration_col, datetime_col
+
+hour = np.timedelta64(1, "h")
+
+
+class CoverageIndex:
+    """Packed bitset of the valid hourly values of a long table over (station, pollutant, hour), built once and then
+    used to answer missing data queries without scanning the table again. Hours are counted from the first
+    datetime of the table, one bit per hour, 8 hours per byte.
+
+    :param df: long table with station, pollutant, datetime and concentration columns
+    :type df: pd.DataFrame
+    """
+
+    def __init__(self, df):
+        station_codes, self.stations = pd.factorize(df[station_col], sort=True)
+        pollutant_codes, self.pollutants = pd.factorize(df[pollutant_col], sort=True)
+        datetimes = df[datetime_col].to_numpy(dtype="datetime64[ns]")
+        self.start = datetimes.min()
+        hour_codes = ((datetimes - self.start) // hour).astype(np.int64)
+        self.n_hours = int(hour_codes.max()) + 1 if len(hour_codes) > 0 else 0
+        valid = df[concentration_col].notna().to_numpy()
+        bits = np.zeros((len(self.stations), len(self.pollutants), self.n_hours), dtype=bool)
+        bits[station_codes[valid], pollutant_codes[valid], hour_codes[valid]] = True
+        self.bits = np.packbits(bits, axis=-1)
+        # Hours with at least one row in the table, i.e. the rows of the pivoted dataframes
+        present = np.zeros(self.n_hours, dtype=bool)
+        present[hour_codes] = True
+        self.present = np.packbits(present)
+        self._station_pos = {station: i for i, station in enumerate(self.stations)}
+        self._pollutant_pos = {pollutant: i for i, pollutant in enumerate(self.pollutants)}
+
+    def hour_to_datetime(self, hours):
+        """Converts hour offsets to datetimes
+
+        :param hours: hour offsets
+        :type hours: np.ndarray
+        :return: datetimes
+        :rtype: pd.DatetimeIndex
+        """
+        return pd.DatetimeIndex(self.start + np.asarray(hours, dtype=np.int64) * hour)
+
+    def _hour_range(self, date_from=None, date_to=None):
+        """Returns the [first, last) hour offsets of a date range clipped to the index
+
+        :param date_from: first datetime (included), None means the first one of the index
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included), None means the last one of the index
+        :type date_to: str or datetime.datetime
+        :return: (first, last)
+        :rtype: tuple
+        """
+        first, last = 0, self.n_hours
+        if date_from is not None:
+            first = max(first, int(np.ceil((np.datetime64(pd.Timestamp(date_from)) - self.start) / hour)))
+        if date_to is not None:
+            last = min(last, int((np.datetime64(pd.Timestamp(date_to)) - self.start) // hour) + 1)
+        return first, max(first, last)
+
+    def valid(self, stations=None, pollutants=None, date_from=None, date_to=None):
+        """Unpacks the validity bits of a slice, only the bytes of the requested hours are unpacked
+
+        :param stations: stations of the slice, None means all of them
+        :type stations: list
+        :param pollutants: pollutants of the slice, None means all of them
+        :type pollutants: list
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: bool array (station, pollutant, hour) and the hour offset of its first hour
+        :rtype: tuple
+        """
+        station_pos = slice(None) if stations is None else [self._station_pos[station] for station in stations]
+        pollutant_pos = slice(None) if pollutants is None else [self._pollutant_pos[p] for p in pollutants]
+        first, last = self._hour_range(date_from, date_to)
+        packed = self.bits[station_pos][:, pollutant_pos, first // 8:(last + 7) // 8]
+        unpacked = np.unpackbits(packed, axis=-1, count=(last + 7) // 8 * 8 - first // 8 * 8)
+        return unpacked[..., first % 8:first % 8 + last - first].astype(bool), first
+
+    def _present(self, first, last):
+        """Returns which hours of [first, last) have at least one row in the table
+
+        :return: bool array
+        :rtype: np.ndarray
+        """
+        return np.unpackbits(self.present, count=self.n_hours)[first:last].astype(bool)
+
+    def _disc_valid(self, discriminant_column, value):
+        """Returns the validity bits of one discriminant value as array (pivot, hour) and the pivot labels
+
+        :param discriminant_column: station_col or pollutant_col
+        :type discriminant_column: str
+        :param value: discriminant value
+        :return: (bool array, pivot labels)
+        :rtype: tuple
+        """
+        if discriminant_column == station_col:
+            return self.valid(stations=[value])[0][0], self.pollutants
+        if discriminant_column == pollutant_col:
+            return self.valid(pollutants=[value])[0][:, 0], self.stations
+        raise ValueError(f"discriminant_column must be {station_col} or {pollutant_col}")
+
+    def fully_missing_dates(self, discriminant_column, value):
+        """Same as madrid_analysis.find_missing_dates on the pivoted dataframe of a discriminant value: datetimes of
+        the table where every pivot is missing, in chronological order
+
+        :param discriminant_column: station_col or pollutant_col
+        :type discriminant_column: str
+        :param value: discriminant value
+        :return: datetimes with all na
+        :rtype: list
+        """
+        valid, _ = self._disc_valid(discriminant_column, value)
+        missing = ~valid.any(axis=0) & self._present(0, self.n_hours)
+        return list(self.hour_to_datetime(np.flatnonzero(missing)))
+
+    def fully_missing_columns(self, discriminant_column, value):
+        """Same as madrid_analysis.find_missing_cols on the pivoted dataframe of a discriminant value
+
+        :param discriminant_column: station_col or pollutant_col
+        :type discriminant_column: str
+        :param value: discriminant value
+        :return: pivot columns with all na
+        :rtype: list
+        """
+        valid, pivots = self._disc_valid(discriminant_column, value)
+        return [str(pivot) for pivot in pivots[~valid.any(axis=1)]]
+
+    def gap_runs(self, station, pollutant, min_length=1, date_from=None, date_to=None):
+        """Returns the runs of consecutive missing hours of one series
+
+        :param station: station
+        :param pollutant: pollutant
+        :param min_length: minimum number of hours of the returned runs
+        :type min_length: int
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: DataFrame with start, end (both included) and length in hours of every run
+        :rtype: pd.DataFrame
+        """
+        valid, first = self.valid(stations=[station], pollutants=[pollutant], date_from=date_from, date_to=date_to)
+        missing = np.concatenate([[False], ~valid[0, 0], [False]]).astype(np.int8)
+        edges = np.diff(missing)
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        keep = ends - starts >= min_length
+        starts, ends = starts[keep] + first, ends[keep] + first
+        return pd.DataFrame({"start": self.hour_to_datetime(starts),
+                             "end": self.hour_to_datetime(ends - 1),
+                             "length": ends - starts})
+
+    def coverage_per_year(self, stations=None, pollutants=None, date_from=None, date_to=None):
+        """Returns the percentage of valid hours per year of every series of a slice. Only the calendar hours
+        covered by the index are counted.
+
+        :param stations: stations of the slice, None means all of them
+        :type stations: list
+        :param pollutants: pollutants of the slice, None means all of them
+        :type pollutants: list
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: DataFrame indexed by (station, pollutant) with one column per year
+        :rtype: pd.DataFrame
+        """
+        valid, first = self.valid(stations=stations, pollutants=pollutants, date_from=date_from, date_to=date_to)
+        stations = self.stations if stations is None else stations
+        pollutants = self.pollutants if pollutants is None else pollutants
+        years = self.hour_to_datetime(np.arange(first, first + valid.shape[-1])).year.to_numpy()
+        if len(years) == 0:
+            return pd.DataFrame(index=pd.MultiIndex.from_product([stations, pollutants],
+                                                                 names=[station_col, pollutant_col]))
+        year_starts = np.flatnonzero(np.diff(years, prepend=years[0] - 1))
+        valid_hours = np.add.reduceat(valid.reshape(-1, valid.shape[-1]), year_starts, axis=1)
+        total_hours = np.diff(np.append(year_starts, len(years)))
+        return pd.DataFrame(100 * valid_hours / total_hours, columns=years[year_starts],
+                            index=pd.MultiIndex.from_product([stations, pollutants],
+                                                             names=[station_col, pollutant_col]))
@@ -0,0 +1,191 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from madrid_utilities import station_col, pollutant_col, concentration_col, datetime_col
+
+cube_file_prefix = "cube-"
+cube_index_file_name = "index.json"
+hour = np.timedelta64(1, "h")
+
+
+def build_cube(df, cube_dir):
+    """Writes a long table as a dense float32 array [station, pollutant, hour] with np.nan for missing values, plus
+    the index mapping stations, pollutants and datetimes to offsets. The array is filled on disk through a memory
+    map, so only the long table has to fit in memory. Hours are counted from the first datetime of the table.
+    Every build writes a new array file and then atomically replaces the index, which names the array file, so
+    processes reading the previous cube keep their memory map and new readers always open a complete cube.
+
+    :param df: long table with station, pollutant, datetime and concentration columns
+    :type df: pd.DataFrame
+    :param cube_dir: output directory
+    :type cube_dir: str
+    :return: cube
+    :rtype: TimeSeriesCube
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    station_codes, stations = pd.factorize(df[station_col], sort=True)
+    pollutant_codes, pollutants = pd.factorize(df[pollutant_col], sort=True)
+    datetimes = df[datetime_col].to_numpy(dtype="datetime64[ns]")
+    start = datetimes.min()
+    hour_codes = ((datetimes - start) // hour).astype(np.int64)
+    n_hours = int(hour_codes.max()) + 1
+    cube_file = f"{cube_file_prefix}{pd.Timestamp.now(tz='UTC').strftime('%Y%m%dT%H%M%S%f')}.npy"
+    cube = np.lib.format.open_memmap(os.path.join(cube_dir, cube_file), mode="w+", dtype=np.float32,
+                                     shape=(len(stations), len(pollutants), n_hours))
+    cube[:] = np.nan
+    cube[station_codes, pollutant_codes, hour_codes] = df[concentration_col].to_numpy(dtype=np.float32)
+    cube.flush()
+    del cube
+    index = {"cube_file": cube_file,
+             "stations": np.asarray(stations).tolist(),
+             "pollutants": [str(pollutant) for pollutant in pollutants],
+             "start": str(pd.Timestamp(start)),
+             "n_hours": n_hours}
+    index_path = os.path.join(cube_dir, cube_index_file_name)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+    # Removed files stay readable through the memory maps already opened on them
+    for file in os.listdir(cube_dir):
+        if file.startswith(cube_file_prefix) and file != cube_file:
+            os.remove(os.path.join(cube_dir, file))
+    return TimeSeriesCube(cube_dir)
+
+
+class TimeSeriesCube:
+    """Read-only memory map of a cube written by build_cube. Single labels and date ranges return views of the
+    file: nothing is loaded until the values are used and the pages are shared by all the processes reading the
+    same cube. Pickling only stores the directory, so cubes can be sent to worker processes.
+
+    :param cube_dir: cube directory
+    :type cube_dir: str
+    """
+
+    def __init__(self, cube_dir):
+        self.cube_dir = cube_dir
+        index = self._read_index()
+        try:
+            self.values = np.load(os.path.join(cube_dir, index["cube_file"]), mmap_mode="r")
+        except FileNotFoundError:
+            # The cube was rebuilt between reading the index and opening the array file
+            index = self._read_index()
+            self.values = np.load(os.path.join(cube_dir, index["cube_file"]), mmap_mode="r")
+        self.stations = index["stations"]
+        self.pollutants = index["pollutants"]
+        self.start = np.datetime64(pd.Timestamp(index["start"]), "ns")
+        self.n_hours = index["n_hours"]
+        self._station_pos = {station: i for i, station in enumerate(self.stations)}
+        self._pollutant_pos = {pollutant: i for i, pollutant in enumerate(self.pollutants)}
+
+    def _read_index(self):
+        """Reads the index written by build_cube
+
+        :return: index
+        :rtype: dict
+        """
+        with open(os.path.join(self.cube_dir, cube_index_file_name), "r") as f:
+            return json.load(f)
+
+    def __getstate__(self):
+        return {"cube_dir": self.cube_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["cube_dir"])
+
+    def station_pos(self, station):
+        """Returns the offset of a station
+
+        :param station: station code
+        :return: offset
+        :rtype: int
+        """
+        return self._station_pos[station]
+
+    def pollutant_pos(self, pollutant):
+        """Returns the offset of a pollutant
+
+        :param pollutant: pollutant name
+        :type pollutant: str
+        :return: offset
+        :rtype: int
+        """
+        return self._pollutant_pos[str(pollutant)]
+
+    def hour_pos(self, date):
+        """Returns the offset of the hour of a datetime, it can be out of the cube
+
+        :param date: datetime
+        :type date: str or datetime.datetime
+        :return: offset
+        :rtype: int
+        """
+        return int((np.datetime64(pd.Timestamp(date), "ns") - self.start) // hour)
+
+    def hour_slice(self, date_from=None, date_to=None):
+        """Returns the slice of the hours of a date range clipped to the cube
+
+        :param date_from: first datetime (included), None means the first one of the cube
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included), None means the last one of the cube
+        :type date_to: str or datetime.datetime
+        :return: slice
+        :rtype: slice
+        """
+        first = 0 if date_from is None else min(max(self.hour_pos(date_from), 0), self.n_hours)
+        last = self.n_hours if date_to is None else min(max(self.hour_pos(date_to) + 1, first), self.n_hours)
+        return slice(first, last)
+
+    def datetimes(self, date_from=None, date_to=None):
+        """Returns the datetimes of the hours of a date range
+
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: datetimes
+        :rtype: pd.DatetimeIndex
+        """
+        hours = self.hour_slice(date_from, date_to)
+        return pd.DatetimeIndex(self.start + np.arange(hours.start, hours.stop) * hour, name=datetime_col)
+
+    def get(self, station=None, pollutant=None, date_from=None, date_to=None):
+        """Slices the cube. None keeps the whole axis, a single label drops the axis and a list of labels keeps it in
+        the given order. Without lists of labels the result is a view of the file, with lists it is a copy.
+
+        :param station: station code, list of station codes or None
+        :param pollutant: pollutant name, list of pollutant names or None
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: float32 array with the remaining axes among (station, pollutant, hour)
+        :rtype: np.ndarray
+        """
+        values = self.values[:, :, self.hour_slice(date_from, date_to)]
+        if isinstance(pollutant, list):
+            values = values[:, [self.pollutant_pos(el) for el in pollutant]]
+        elif pollutant is not None:
+            values = values[:, self.pollutant_pos(pollutant)]
+        if isinstance(station, list):
+            values = values[[self.station_pos(el) for el in station]]
+        elif station is not None:
+            values = values[self.station_pos(station)]
+        return values
+
+    def series(self, station, pollutant, date_from=None, date_to=None):
+        """Returns the time series of a station and a pollutant
+
+        :param station: station code
+        :param pollutant: pollutant name
+        :type pollutant: str
+        :param date_from: first datetime (included)
+        :type date_from: str or datetime.datetime
+        :param date_to: last datetime (included)
+        :type date_to: str or datetime.datetime
+        :return: series indexed by datetime, backed by the memory map
+        :rtype: pd.Series
+        """
+        return pd.Series(self.get(station, pollutant, date_from, date_to), index=self.datetimes(date_from, date_to),
+                         name=concentration_col, copy=False)
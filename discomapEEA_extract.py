@@ -1,6 +1,161 @@
 import os
+import shutil
 import pandas as pd
+from tqdm import tqdm
+
+from discomapEEA_utilities import pollutant_dict_eea, concentration_col as eea_concentration_col, \
+    get_eea_download_dir, get_eea_dataset_dir, station_file_extension
+from madrid_utilities import station_col, pollutant_col, datetime_col, concentration_col
+from common_utilities import run_in_pool
+from store_utilities import write_partitioned_dataset, read_partitioned_dataset
+from metrics_utilities import MetricsRecorder, null_metrics
+
+eea_station_col = "AirQualityStation"
+eea_datetime_col = "DatetimeBegin"
+eea_datetime_format = "%Y-%m-%d %H:%M:%S %z"
+
+
+def get_station_files(country_code, city_name, year_from, year_to):
+    """Returns the station files written by discomapEEA_full.download_eea for every pollutant
+
+    :param country_code: country code
+    :type country_code: str
+    :param city_name: city name
+    :type city_name: str
+    :param year_from: first year
+    :type year_from: int
+    :param year_to: last year
+    :type year_to: int
+    :return: {pollutant name: sorted file paths}, pollutants without files are left out
+    :rtype: dict
+    """
+    station_files = {}
+    for p_name in pollutant_dict_eea.values():
+        download_dir = get_eea_download_dir(country_code, city_name, year_from, year_to, p_name)
+        if os.path.isdir(download_dir):
+            files = sorted(os.path.join(download_dir, file) for file in os.listdir(download_dir)
+                           if file.endswith(station_file_extension))
+            if len(files) > 0:
+                station_files[p_name] = files
+    return station_files
+
+
+def open_station_file(path, p_name):
+    """Opens a station file and converts it to the long table of the Madrid extraction. Datetimes are converted to
+    UTC without time zone, so that the stations of different countries and the daylight saving changes are aligned.
+
+    :param path: csv file written by discomapEEA_utilities.eea_smart_download
+    :type path: str
+    :param p_name: pollutant name, used instead of AirPollutant so that partitions are named as the download
+        directories
+    :type p_name: str
+    :return: long table with station, pollutant, datetime and concentration columns
+    :rtype: pd.DataFrame
+    """
+    df = pd.read_csv(path, encoding="utf-8")
+    return pd.DataFrame({station_col: df[eea_station_col].astype(str).to_numpy(),
+                         pollutant_col: p_name,
+                         datetime_col: pd.to_datetime(df[eea_datetime_col], format=eea_datetime_format,
+                                                      utc=True).dt.tz_convert(None).to_numpy(),
+                         concentration_col: df[eea_concentration_col].to_numpy(dtype=float)})
+
+
+def _open_station_batch(args):
+    """Opens and converts a batch of station files of one pollutant, recording the "open_batch" stage. Used as
+    process pool task, batching keeps the number of tasks and of returned dataframes independent of the number of
+    stations.
+
+    :param args: (pollutant name, file paths, recorder of the worker as returned by MetricsRecorder.spawn)
+    :type args: tuple
+    :return: worker pid, long table of the batch and records of the worker
+    :rtype: tuple
+    """
+    p_name, files, metrics = args
+    with metrics.stage("open_batch", pollutant=p_name) as batch_stage:
+        df = pd.concat([open_station_file(path, p_name) for path in files], axis=0, ignore_index=True)
+        if metrics.enabled:
+            batch_stage.add(rows_out=len(df), bytes_read=sum(os.path.getsize(path) for path in files))
+    return os.getpid(), (df, metrics.records)
+
+
+def consolidate_pollutant(df_list):
+    """Joins the converted station files of one pollutant. The sampling points of the same station are averaged, so
+    that every station has one value per datetime.
+
+    :param df_list: long tables of the station files
+    :type df_list: list
+    :return: long table sorted by station and datetime
+    :rtype: pd.DataFrame
+    """
+    df = pd.concat(df_list, axis=0, ignore_index=True)
+    df = df.groupby([station_col, pollutant_col, datetime_col], sort=True)[concentration_col].mean()
+    return df.reset_index()[[station_col, pollutant_col, datetime_col, concentration_col]]
+
+
+def extract_eea(country_code, city_name, year_from, year_to, dataset_dir=None, n_jobs=None, batch_size=64,
+                metrics=null_metrics):
+    """Consolidates the station files of a city in one dataset partitioned by year and pollutant, with the schema of
+    the Madrid dataset, so that it can be read with store_utilities.read_partitioned_dataset and analysed with
+    madrid_chunked_analysis.chunked_analysis, in an analysis directory of its own. The files are read by a process
+    pool in batches, the dataset is rebuilt from scratch.
+
+    :param country_code: country code
+    :type country_code: str
+    :param city_name: city name
+    :type city_name: str
+    :param year_from: first year
+    :type year_from: int
+    :param year_to: last year
+    :type year_to: int
+    :param dataset_dir: dataset directory, None uses discomapEEA_utilities.get_eea_dataset_dir
+    :type dataset_dir: str
+    :param n_jobs: number of worker processes, 1 runs serially in the current process, None uses all the cpus
+    :type n_jobs: int
+    :param batch_size: number of station files of every pool task
+    :type batch_size: int
+    :param metrics: recorder of the "extract_eea" stage of every pollutant and of the "open_batch" stage of every
+        batch, recorded by the workers
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: one row per pollutant with pollutant, files, rows and stations columns
+    :rtype: pd.DataFrame
+    """
+    if dataset_dir is None:
+        dataset_dir = get_eea_dataset_dir(country_code, city_name, year_from, year_to)
+    station_files = get_station_files(country_code, city_name, year_from, year_to)
+    batches = [(p_name, files[i:i + batch_size]) for p_name, files in station_files.items()
+               for i in range(0, len(files), batch_size)]
+    tasks = [(p_name, files, metrics.spawn()) for p_name, files in batches]
+    if n_jobs == 1:
+        results = [_open_station_batch(task)[1] for task in tqdm(tasks, desc="batches")]
+    else:
+        results = run_in_pool(_open_station_batch, tasks, n_jobs=n_jobs, desc="batches")
+    batch_dfs = [df for df, _ in results]
+    for _, records in results:
+        metrics.extend(records)
+    if os.path.isdir(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    report = []
+    for p_name, files in station_files.items():
+        with metrics.stage("extract_eea", pollutant=p_name) as extract_stage:
+            df = consolidate_pollutant([batch_df for (batch_p_name, _), batch_df in zip(batches, batch_dfs)
+                                        if batch_p_name == p_name])
+            written = write_partitioned_dataset(df, dataset_dir)
+            if metrics.enabled:
+                extract_stage.add(rows_out=len(df), bytes_read=sum(os.path.getsize(path) for path in files),
+                                  bytes_written=sum(os.path.getsize(path) for path in written))
+        report.append({"pollutant": p_name, "files": len(files), "rows": len(df),
+                       "stations": df[station_col].nunique()})
+    return pd.DataFrame(report, columns=["pollutant", "files", "rows", "stations"])
 
 
 if __name__ == "__main__":
-    print("cio")
+    country_code = 'BE'
+    city_name = "Bruxelles / Brussel"
+    year_from = 2013
+    year_to = 2021
+    metrics = MetricsRecorder()
+    print(extract_eea(country_code=country_code, city_name=city_name, year_from=year_from, year_to=year_to,
+                      metrics=metrics))
+    dataset_dir = get_eea_dataset_dir(country_code, city_name, year_from, year_to)
+    metrics.save(os.path.join(dataset_dir, "extract_metrics.json"))
+    print(read_partitioned_dataset(dataset_dir).groupby(pollutant_col)[concentration_col].describe())
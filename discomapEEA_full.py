@@ -1,41 +1,102 @@
 import os
-import pandas as pd
-from tqdm import tqdm
-from common_utilities import clean_download_dir
-from discomapEEA_utilities import get_stat_data_name, pollutant_dict_eea, url_col, eea_data_dir, eea_smart_download
+from discomapEEA_utilities import get_stat_data_name, pollutant_dict_eea, url_col, eea_data_dir, eea_smart_download, \
+    eea_hub_url, eea_cache_dir, get_default_engine, get_eea_download_dir, station_file_extension
+from download_utilities import DownloadEngine, HttpCache
+from metrics_utilities import MetricsRecorder, null_metrics
 # For more details
 # https://discomap.eea.europa.eu/map/fme/AirQualityExport.htm
 
 
-def download_eea(country_code, city_name, year_from, year_to):
-    for p_number, p_name in pollutant_dict_eea.items():
-        print(f"Looking for {p_name} data")
+def _download_pollutant(country_code, city_name, year_from, year_to, p_number, p_name, engine, hub_url, stream):
+    """Downloads the time series of all the stations of a city for one pollutant, see download_eea. The station files
+    of previous downloads are kept, so that the unchanged ones are neither parsed nor written again, except the
+    ones of stations that are no longer listed.
+
+    :param p_number: pollutant code of the EEA service
+    :type p_number: int
+    :param p_name: pollutant name
+    :type p_name: str
+    :return: number of station files
+    :rtype: int
+    """
+    print(f"Looking for {p_name} data")
+
+    first_url = f"{hub_url}?" \
+                f"CountryCode={country_code}&CityName={city_name}&Pollutant={p_number}&Year_from={year_from}&" \
+                f"Year_to={year_to}&Station=&Samplingpoint=&Source=All&Output=TEXT&UpdateDate=&TimeCoverage=Year"
+    first_url = first_url.replace(" ", "%20")
+
+    sub_url_data = eea_smart_download(path=None, url=first_url, to_filter=False, engine=engine)
+    print("Hub file downloaded")
 
-        first_url = f"https://fme.discomap.eea.europa.eu/fmedatastreaming/AirQualityDownload/AQData_Extract.fmw?" \
-                    f"CountryCode={country_code}&CityName={city_name}&Pollutant={p_number}&Year_from={year_from}&" \
-                    f"Year_to={year_to}&Station=&Samplingpoint=&Source=All&Output=TEXT&UpdateDate=&TimeCoverage=Year"
-        first_url = first_url.replace(" ", "%20")
+    output_dir = get_eea_download_dir(country_code, city_name, year_from, year_to, p_name)
+    file_names = {url: get_stat_data_name(url=url) + station_file_extension for url in sub_url_data[url_col]}
+    if len(sub_url_data) > 0:
+        os.makedirs(output_dir, exist_ok=True)
 
-        tmp_file = eea_smart_download(path=tmp_file, url=first_url, to_filter=False)
-        print("Hub file downloaded")
-        sub_url_data = pd.read_csv(tmp_file, header=None, names=[url_col])
+        def download_station(url):
+            eea_smart_download(os.path.join(output_dir, file_names[url]), url=url, to_filter=True, engine=engine,
+                               stream=stream)
 
-        if len(sub_url_data) > 0:
-            output_dir = os.path.join(eea_data_dir, f"{country_code}_{city_name[:3]}_{year_from}_{year_to}_{p_name}")
-            os.mkdir(output_dir)
-            for url in tqdm(sub_url_data[url_col]):
-                station_name = get_stat_data_name(url=url)
-                file_name = station_name + ".pkl"
-                eea_smart_download(os.path.join(output_dir, file_name), url=url)
-            print(f"Download completed for {p_name}")
-        else:
-            print(f"no pollutant data found for {p_name}")
+        engine.map(download_station, sub_url_data[url_col], desc=p_name)
+        print(f"Download completed for {p_name}")
+    else:
+        print(f"no pollutant data found for {p_name}")
+    if os.path.isdir(output_dir):
+        for file in set(os.listdir(output_dir)) - set(file_names.values()):
+            os.remove(os.path.join(output_dir, file))
+    return len(sub_url_data)
+
+
+def download_eea(country_code, city_name, year_from, year_to, engine=None, hub_url=eea_hub_url, stream=False,
+                 metrics=null_metrics):
+    """Downloads the time series of all the stations of a city, one directory per pollutant
+
+    :param country_code: country code
+    :type country_code: str
+    :param city_name: city name
+    :type city_name: str
+    :param year_from: first year
+    :type year_from: int
+    :param year_to: last year
+    :type year_to: int
+    :param engine: download engine, None uses the shared cached engine of eea_smart_download
+    :type engine: DownloadEngine
+    :param hub_url: url of the service returning the list of station files
+    :type hub_url: str
+    :param stream: whether to parse the station files in chunks while downloading them, the files written are the
+        same
+    :type stream: bool
+    :param metrics: recorder of the "download" stage of every pollutant
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: throughput statistics of the engine
+    :rtype: dict
+    """
+    engine = get_default_engine() if engine is None else engine
+    engine.reset_stats()
+    for p_number, p_name in pollutant_dict_eea.items():
+        with metrics.stage("download", pollutant=p_name) as download_stage:
+            n_bytes = engine.n_bytes
+            n_files = _download_pollutant(country_code, city_name, year_from, year_to, p_number, p_name,
+                                          engine=engine, hub_url=hub_url, stream=stream)
+            download_stage.add(rows_out=n_files, bytes_read=engine.n_bytes - n_bytes)
+    stats = engine.throughput()
+    print(f"{stats['files']} files in {stats['seconds']:.1f}s: {stats['files_per_s']:.2f} files/s, "
+          f"{stats['mb_per_s']:.2f} MB/s")
+    if engine.cache is not None:
+        stats["cache"] = engine.cache.stats()
+        print(f"cache: {stats['cache']}")
+    return stats
 
 
 if __name__ == "__main__":
-    clean_download_dir(eea_data_dir)
     country_code = 'BE'
     city_name = "Bruxelles / Brussel"  # [Antwerpen, Brugge, Bruxelles / Brussel, ...]
     year_from = 2013  #
     year_to = 2021
-    download_eea(country_code=country_code, city_name=city_name, year_from=year_from, year_to=year_to)
\ No newline at end of file
+    engine = DownloadEngine(max_workers=8, retries=3, backoff_factor=1., rate_limit=10,
+                            cache=HttpCache(eea_cache_dir))
+    metrics = MetricsRecorder()
+    download_eea(country_code=country_code, city_name=city_name, year_from=year_from, year_to=year_to, engine=engine,
+                 metrics=metrics)
+    metrics.save(os.path.join(eea_data_dir, "download_metrics.json"))
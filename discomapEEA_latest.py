@@ -1,33 +1,201 @@
-# Python sample for download of air quality up-to-date files
-# The Pyton script shows a simple sample how the pre-processed CSV files can be downloaded.
+# Ingestion of the air quality up-to-date files
+# Based on the EEA Python sample showing how the pre-processed CSV files can be downloaded.
 # EEA takes no responsibility of the script and the code is provided 'as is', without warranty of any kind.
 # Peter Kjeld, 15. February 2019
 
+import os
+import json
+import time
 import requests
+import pandas as pd
+from download_utilities import DownloadEngine, HttpCache
+from discomapEEA_utilities import eea_latest_url, eea_latest_dir, eea_cache_dir, latest_kept_cols, \
+    latest_samplingpoint_col, latest_datetime_col
 
-print('-----------------------------------------------------------------------')
+watermarks_file_name = "watermarks.json"
 
-# Set download url
-ServiceUrl = "http://discomap.eea.europa.eu/map/fme/latest"
 
-# Countries to download
-# Note: List is not complete
-countries = ['BE', 'IT']
+def get_feed_name(country, pollutant):
+    return f"{country}_{pollutant}"
 
-# Pollutant to be downloaded
-pollutants = ['C6H6', 'PM10', 'CO', 'NO2', 'SO2', 'O3', 'PM2.5']
 
-for country in countries:
-    for pollutant in pollutants:
-        fileName = "data/discomapEEA/%s_%s.csv" % (country, pollutant)
-        downloadFile = '%s/%s_%s.csv' % (ServiceUrl, country, pollutant)
-        # Download and save to local path
-        print('Downloading: %s' % downloadFile)
-        file = requests.get(downloadFile).content
-        with open(fileName, 'wb') as output:
-            output.write(file)
-        print('Saved locally as: %s ' % fileName)
-        print('-----')
-    print('Download finished')
+def get_feed_dir(store_dir, country, pollutant):
+    """Returns the directory of the parts and of the watermarks of a feed
 
+    :param store_dir: store directory
+    :type store_dir: str
+    :param country: country code
+    :type country: str
+    :param pollutant: pollutant name
+    :type pollutant: str
+    :return: directory path
+    :rtype: str
+    """
+    return os.path.join(store_dir, get_feed_name(country, pollutant))
 
+
+def load_watermarks(feed_dir):
+    """Loads the last ingested datetime of every sampling point of a feed
+
+    :param feed_dir: feed directory
+    :type feed_dir: str
+    :return: series of UTC datetimes indexed by sampling point
+    :rtype: pd.Series
+    """
+    path = os.path.join(feed_dir, watermarks_file_name)
+    if not os.path.exists(path):
+        return pd.Series(dtype="datetime64[ns, UTC]")
+    with open(path, "r") as f:
+        return pd.to_datetime(pd.Series(json.load(f), dtype=object), utc=True)
+
+
+def save_watermarks(watermarks, feed_dir):
+    """Saves the watermarks of a feed replacing the previous file atomically
+
+    :param watermarks: series of UTC datetimes indexed by sampling point
+    :type watermarks: pd.Series
+    :param feed_dir: feed directory
+    :type feed_dir: str
+    """
+    path = os.path.join(feed_dir, watermarks_file_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump({str(point): date.isoformat() for point, date in watermarks.items()}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def filter_new_rows(df, watermarks):
+    """Keeps the rows newer than the watermark of their sampling point, all the rows of new sampling points
+
+    :param df: rows of an up-to-date file with UTC datetimes
+    :type df: pd.DataFrame
+    :param watermarks: series of UTC datetimes indexed by sampling point
+    :type watermarks: pd.Series
+    :return: new rows
+    :rtype: pd.DataFrame
+    """
+    last = df[latest_samplingpoint_col].map(watermarks)
+    return df[last.isna() | (df[latest_datetime_col] > last)]
+
+
+def ingest_feed(country, pollutant, engine, store_dir=eea_latest_dir, latest_url=eea_latest_url, chunksize=100000):
+    """Appends the new rows of the up-to-date file of a country and a pollutant to the store. The request is
+    conditional when the engine has a cache, so an unchanged file is neither downloaded nor parsed, unless the feed
+    has no rows in the store, e.g. after the store was removed, then the cached file is parsed. Otherwise the
+    file is parsed in chunks while it is downloaded and only the rows newer than the watermark of their sampling
+    point are kept and written as a new part.
+
+    :param country: country code
+    :type country: str
+    :param pollutant: pollutant name
+    :type pollutant: str
+    :param engine: download engine
+    :type engine: DownloadEngine
+    :param store_dir: store directory
+    :type store_dir: str
+    :param latest_url: url of the up-to-date files
+    :type latest_url: str
+    :param chunksize: number of rows of every parsed chunk
+    :type chunksize: int
+    :return: {"feed", "not_modified", "new_rows", "seconds"}
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    feed_dir = get_feed_dir(store_dir, country, pollutant)
+    os.makedirs(feed_dir, exist_ok=True)
+    watermarks = load_watermarks(feed_dir)
+    is_empty = len(watermarks) == 0 and not any(part.endswith(".parquet") for part in os.listdir(feed_dir))
+    delta_list = []
+    with engine.open_stream(f"{latest_url}/{get_feed_name(country, pollutant)}.csv") as (f, not_modified):
+        # An unchanged file is parsed from the cache if the store lost its rows
+        if not not_modified or is_empty:
+            for chunk in pd.read_csv(f, usecols=latest_kept_cols, chunksize=chunksize, encoding="utf-8"):
+                chunk[latest_datetime_col] = pd.to_datetime(chunk[latest_datetime_col], utc=True)
+                delta_list.append(filter_new_rows(chunk, watermarks))
+    report = {"feed": get_feed_name(country, pollutant), "not_modified": not_modified, "new_rows": 0}
+    if len(delta_list) > 0:
+        delta = pd.concat(delta_list, axis=0, ignore_index=True)
+        delta = delta.drop_duplicates([latest_samplingpoint_col, latest_datetime_col], keep="last")
+        if len(delta) > 0:
+            part_name = f"part-{pd.Timestamp.now(tz='UTC').strftime('%Y%m%dT%H%M%S%f')}.parquet"
+            part_path = os.path.join(feed_dir, part_name)
+            delta.to_parquet(part_path + ".tmp", index=False)
+            os.replace(part_path + ".tmp", part_path)
+            new_watermarks = delta.groupby(latest_samplingpoint_col)[latest_datetime_col].max()
+            save_watermarks(pd.concat([watermarks, new_watermarks]).groupby(level=0).max(), feed_dir)
+            report["new_rows"] = len(delta)
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def ingest_latest(countries, pollutants, engine, store_dir=eea_latest_dir, latest_url=eea_latest_url):
+    """Polls the up-to-date files of all the countries and pollutants concurrently, see ingest_feed. A feed that
+    cannot be downloaded or parsed, e.g. missing on the server, is reported with its error and does not stop the
+    other feeds.
+
+    :param countries: country codes
+    :type countries: list
+    :param pollutants: pollutant names
+    :type pollutants: list
+    :param engine: download engine, its cache should be enabled to skip unchanged files
+    :type engine: DownloadEngine
+    :param store_dir: store directory
+    :type store_dir: str
+    :param latest_url: url of the up-to-date files
+    :type latest_url: str
+    :return: one row per feed with feed, not_modified, new_rows, seconds and error columns, error is None for the
+        ingested feeds
+    :rtype: pd.DataFrame
+    """
+    def ingest_or_report(feed):
+        start = time.perf_counter()
+        try:
+            return dict(ingest_feed(feed[0], feed[1], engine=engine, store_dir=store_dir, latest_url=latest_url),
+                        error=None)
+        except (requests.RequestException, ValueError) as e:
+            return {"feed": get_feed_name(feed[0], feed[1]), "not_modified": False, "new_rows": 0,
+                    "seconds": time.perf_counter() - start, "error": repr(e)}
+
+    feeds = [(country, pollutant) for country in countries for pollutant in pollutants]
+    reports = engine.map(ingest_or_report, feeds, desc="feeds")
+    return pd.DataFrame(reports, columns=["feed", "not_modified", "new_rows", "seconds", "error"])
+
+
+def read_latest_store(store_dir=eea_latest_dir, country=None, pollutant=None):
+    """Reads the ingested rows of the store. Duplicates of a feed left by an interrupted ingestion are dropped.
+
+    :param store_dir: store directory
+    :type store_dir: str
+    :param country: country code, None reads all of them
+    :type country: str
+    :param pollutant: pollutant name, None reads all of them
+    :type pollutant: str
+    :return: ingested rows
+    :rtype: pd.DataFrame
+    """
+    df_list = []
+    for feed in sorted(os.listdir(store_dir)) if os.path.isdir(store_dir) else []:
+        feed_country, feed_pollutant = feed.split("_", 1)
+        if (country is not None and feed_country != country) or (pollutant is not None and feed_pollutant != pollutant):
+            continue
+        feed_dir = os.path.join(store_dir, feed)
+        part_list = [pd.read_parquet(os.path.join(feed_dir, part)) for part in sorted(os.listdir(feed_dir))
+                     if part.endswith(".parquet")]
+        if len(part_list) > 0:
+            feed_df = pd.concat(part_list, axis=0, ignore_index=True)
+            df_list.append(feed_df.drop_duplicates([latest_samplingpoint_col, latest_datetime_col], keep="last"))
+    if len(df_list) == 0:
+        return pd.DataFrame(columns=latest_kept_cols)
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
+if __name__ == "__main__":
+    # Countries to download
+    # Note: List is not complete
+    countries = ['BE', 'IT']
+
+    # Pollutant to be downloaded
+    pollutants = ['C6H6', 'PM10', 'CO', 'NO2', 'SO2', 'O3', 'PM2.5']
+
+    engine = DownloadEngine(max_workers=8, retries=3, backoff_factor=1., rate_limit=10,
+                            cache=HttpCache(eea_cache_dir))
+    print(ingest_latest(countries, pollutants, engine=engine))
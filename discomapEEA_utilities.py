@@ -1,11 +1,20 @@
+import os
 import re
 import io
-import requests
+import numpy as np
 import pandas as pd
-from common_utilities import value_valid_mix
+from download_utilities import DownloadEngine, HttpCache
 
 
 concentration_col = "Concentration"
+validity_col = "Validity"
+verification_col = "Verification"
+# Columns kept from the station time series, the others (Namespace, AirQualityNetwork, AirQualityStationEoICode,
+# SamplingPoint, SamplingProcess, Sample, AirPollutantCode, AveragingTime, UnitOfMeasurement, DatetimeEnd) are dropped
+eea_kept_cols = ["Countrycode", "AirQualityStation", "AirPollutant", concentration_col, "DatetimeBegin"]
+# Format of the filtered station files, the same with and without stream so that the files can be appended chunk by
+# chunk
+station_file_extension = ".csv"
 
 
 def get_stat_data_name(url):
@@ -16,37 +25,82 @@ def get_stat_data_name(url):
     :return: station_data code
     :rtype: str
     """
-    tmp = re.sub(r"https\:\/\/ereporting\.blob\.core\.windows\.net\/downloadservice\/", "", url)
-    tmp = re.sub(r"^[A-Z]{,2}\/", "", tmp)
+    tmp = url.split("/")[-1]
     tmp = re.sub(r"^[A-Z]{,2}\_\d+\_", "", tmp)
     return re.sub(r"\_timeseries\.csv", "", tmp)
 
 
-def eea_smart_download(path, url, to_filter):
+_default_engine = None
+
+
+def get_default_engine():
+    """Returns the download engine shared by the calls of eea_smart_download without an explicit engine
+
+    :return: download engine
+    :rtype: DownloadEngine
+    """
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = DownloadEngine(cache=HttpCache(eea_cache_dir))
+    return _default_engine
+
+
+def filter_eea_df(df):
+    """Sets to np.nan the concentrations that are not both valid and verified and drops the flag columns
+
+    :param df: raw station data, or a chunk of it
+    :type df: pd.DataFrame
+    :return: filtered data
+    :rtype: pd.DataFrame
+    """
+    # http://dd.eionet.europa.eu/vocabulary/aq/observationverification/view
+    # http://dd.eionet.europa.eu/vocabulary/aq/observationvalidity/view
+    valid = (df[validity_col] == 1) & (df[verification_col] == 1)
+    df[concentration_col] = df[concentration_col].where(valid, np.nan)
+    return df.drop([validity_col, verification_col], axis=1)
+
+
+def eea_smart_download(path, url, to_filter, engine=None, stream=False, chunksize=100000):
     """Downloads API response into a file
 
-    :param path: file path
+    :param path: csv file path
     :type path: str
     :param url: API request url
     :type url: str
     :param to_filter: whether data need to be cleaned before
     :type to_filter: bool
+    :param engine: download engine, None uses the shared default one
+    :type engine: DownloadEngine
+    :param stream: whether to parse and filter the response in chunks while it is downloaded, appending every chunk
+        to the output csv, so that the memory used does not depend on the size of the file
+    :type stream: bool
+    :param chunksize: number of rows of every chunk when stream is True
+    :type chunksize: int
     """
-    file = requests.get(url).content
+    engine = get_default_engine() if engine is None else engine
+    if to_filter and stream:
+        with engine.open_stream(url) as (f, not_modified):
+            if not_modified and os.path.exists(path):
+                return None
+            tmp_path = path + ".tmp"
+            for i, chunk in enumerate(pd.read_csv(f, usecols=eea_kept_cols + [validity_col, verification_col],
+                                                  chunksize=chunksize, encoding="utf-8")):
+                filter_eea_df(chunk).to_csv(tmp_path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        os.replace(tmp_path, path)
+        return None
+    file, not_modified = engine.fetch(url)
+    if to_filter and not_modified and os.path.exists(path):
+        # The server confirmed that the cached file did not change => the csv is already up to date
+        return None
     io_str = io.StringIO(file.decode('utf-8'))
     if not to_filter:
         rawData = pd.read_csv(io_str, header=None, names=[url_col])
         return rawData
     else:
-        # http://dd.eionet.europa.eu/vocabulary/aq/observationverification/view
-        # http://dd.eionet.europa.eu/vocabulary/aq/observationvalidity/view
-        rawData = pd.read_csv(io_str)
-        rawData["Validity"] = (rawData["Validity"] == 1) & (rawData["Verification"] == 1)
-        rawData[concentration_col] = rawData[[concentration_col, "Validity"]].apply(value_valid_mix)
-        rawData.drop(['Namespace', 'AirQualityNetwork', 'AirQualityStationEoICode', 'SamplingPoint', 'SamplingProcess',
-                      'Sample', 'AirPollutantCode', 'AveragingTime', 'UnitOfMeasurement', 'DatetimeEnd', 'Validity',
-                      'Verification'], axis=1, inplace=True)
-        rawData.to_pickle(path)
+        rawData = pd.read_csv(io_str, usecols=eea_kept_cols + [validity_col, verification_col])
+        rawData = filter_eea_df(rawData)
+        rawData.to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
         return None
 
 
@@ -62,3 +116,49 @@ pollutant_dict_eea = {
 
 url_col = "url"
 eea_data_dir = "data/discomapEEA"
+eea_cache_dir = "data/discomapEEA_cache"
+eea_hub_url = "https://fme.discomap.eea.europa.eu/fmedatastreaming/AirQualityDownload/AQData_Extract.fmw"
+eea_latest_url = "http://discomap.eea.europa.eu/map/fme/latest"
+# Outside eea_data_dir, like eea_cache_dir
+eea_latest_dir = "data/discomapEEA_latest"
+# Columns of the up-to-date files kept in the latest store
+latest_samplingpoint_col = "samplingpoint_localid"
+latest_datetime_col = "value_datetime_begin"
+latest_kept_cols = ["network_countrycode", "pollutant", "station_code", latest_samplingpoint_col, latest_datetime_col,
+                    "value_numeric", "value_validity", "value_verification", "value_unit"]
+
+
+def get_eea_download_dir(country_code, city_name, year_from, year_to, p_name):
+    """Returns the directory of the station files of a city and a pollutant
+
+    :param country_code: country code
+    :type country_code: str
+    :param city_name: city name
+    :type city_name: str
+    :param year_from: first year
+    :type year_from: int
+    :param year_to: last year
+    :type year_to: int
+    :param p_name: pollutant name
+    :type p_name: str
+    :return: directory path
+    :rtype: str
+    """
+    return os.path.join(eea_data_dir, f"{country_code}_{city_name[:3]}_{year_from}_{year_to}_{p_name}")
+
+
+def get_eea_dataset_dir(country_code, city_name, year_from, year_to):
+    """Returns the directory of the partitioned dataset consolidating the station files of a city
+
+    :param country_code: country code
+    :type country_code: str
+    :param city_name: city name
+    :type city_name: str
+    :param year_from: first year
+    :type year_from: int
+    :param year_to: last year
+    :type year_to: int
+    :return: directory path
+    :rtype: str
+    """
+    return os.path.join(eea_data_dir, f"{country_code}_{city_name[:3]}_{year_from}_{year_to}_dataset")
@@ -0,0 +1,486 @@
+import io
+import os
+import json
+import atexit
+import time
+import contextlib
+import hashlib
+import threading
+import requests
+from urllib.parse import urlparse
+from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+retry_status_codes = [429, 500, 502, 503, 504]
+
+
+class HttpCache:
+    """On disk cache of http responses keyed by url. Every entry stores the response body together with its ETag and
+    Last-Modified headers, which are sent back as conditional request headers. When the total size of the bodies
+    exceeds max_bytes the least recently used entries are evicted.
+    The index is kept in memory and saved after evictions, every save_every updates and on flush or close, which
+    also runs at interpreter exit, so that hits do not rewrite it. Entries stored after the last save are lost if the
+    process is killed, their bodies are downloaded again.
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param max_bytes: maximum total size of the cached bodies
+    :type max_bytes: int
+    :param save_every: number of index updates between two saves
+    :type save_every: int
+    """
+    index_file_name = "index.json"
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, save_every=100):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, self.index_file_name)
+        self.index = {}
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+        self.total_bytes = sum(entry["size"] for entry in self.index.values())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._n_unsaved = 0
+        with self._lock:
+            self._evict()
+            self._save_index()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @staticmethod
+    def get_key(url):
+        """Returns the cache key of url
+
+        :param url: request url
+        :type url: str
+        :return: key
+        :rtype: str
+        """
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get_body_path(self, url):
+        """Returns the path of the cached body of url
+
+        :param url: request url
+        :type url: str
+        :return: body path
+        :rtype: str
+        """
+        return os.path.join(self.cache_dir, self.get_key(url))
+
+    def conditional_headers(self, url):
+        """Returns the conditional request headers for url, empty if url is not cached
+
+        :param url: request url
+        :type url: str
+        :return: request headers
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self.index.get(self.get_key(url))
+        if entry is None or not os.path.exists(self.get_body_path(url)):
+            return {}
+        headers = {}
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def open(self, url):
+        """Opens the cached body of url, counting a hit
+
+        :param url: request url
+        :type url: str
+        :return: binary file object, None if the entry was evicted in the meantime
+        :rtype: io.BufferedReader
+        """
+        try:
+            f = open(self.get_body_path(url), "rb")
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if self.get_key(url) not in self.index:
+                f.close()
+                return None
+            self.index[self.get_key(url)]["last_access"] = time.time()
+            self.hits += 1
+            self._update_index()
+        return f
+
+    def read(self, url):
+        """Reads the cached body of url, counting a hit
+
+        :param url: request url
+        :type url: str
+        :return: cached body, None if it was evicted in the meantime
+        :rtype: bytes
+        """
+        f = self.open(url)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def get_tmp_path(self, url):
+        """Returns a temporary path where the body of url can be written before store_file
+
+        :param url: request url
+        :type url: str
+        :return: temporary path
+        :rtype: str
+        """
+        return f"{self.get_body_path(url)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def store(self, url, content, headers):
+        """Stores the body of a response, counting a miss, and evicts old entries if needed
+
+        :param url: request url
+        :type url: str
+        :param content: response body
+        :type content: bytes
+        :param headers: response headers
+        :type headers: dict
+        """
+        tmp_path = self.get_tmp_path(url)
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        self.store_file(url, tmp_path, headers)
+
+    def store_file(self, url, tmp_path, headers):
+        """Moves a file containing the body of a response into the cache, counting a miss, and evicts old entries
+        if needed
+
+        :param url: request url
+        :type url: str
+        :param tmp_path: path of the body, as returned by get_tmp_path
+        :type tmp_path: str
+        :param headers: response headers
+        :type headers: dict
+        """
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, self.get_body_path(url))
+        with self._lock:
+            self.misses += 1
+            previous = self.index.get(self.get_key(url))
+            self.total_bytes += size - (0 if previous is None else previous["size"])
+            self.index[self.get_key(url)] = {"url": url,
+                                             "etag": headers.get("ETag"),
+                                             "last_modified": headers.get("Last-Modified"),
+                                             "size": size,
+                                             "last_access": time.time()}
+            if self._evict() > 0:
+                self._save_index()
+            else:
+                self._update_index()
+
+    def _evict(self):
+        """Evicts the least recently used entries until the cache respects max_bytes. Must hold the lock.
+
+        :return: number of evicted entries
+        :rtype: int
+        """
+        if self.total_bytes <= self.max_bytes:
+            return 0
+        n_evicted = 0
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_access"]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            body_path = os.path.join(self.cache_dir, key)
+            if os.path.exists(body_path):
+                os.remove(body_path)
+            self.total_bytes -= entry["size"]
+            del self.index[key]
+            n_evicted += 1
+        self.evictions += n_evicted
+        return n_evicted
+
+    def _update_index(self):
+        """Counts an update of the index, saving it every save_every updates. Must hold the lock."""
+        self._n_unsaved += 1
+        if self._n_unsaved >= self.save_every:
+            self._save_index()
+
+    def _save_index(self):
+        """Saves the index on disk. Must hold the lock."""
+        tmp_path = os.path.join(self.cache_dir, self.index_file_name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.cache_dir, self.index_file_name))
+        self._n_unsaved = 0
+
+    def flush(self):
+        """Saves the index on disk if it has unsaved updates"""
+        with self._lock:
+            if self._n_unsaved > 0:
+                self._save_index()
+
+    def close(self):
+        """Saves the index, the cache can still be used afterwards"""
+        self.flush()
+
+    def stats(self):
+        """Returns hit/miss statistics
+
+        :return: statistics dictionary
+        :rtype: dict
+        """
+        with self._lock:
+            requests_count = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / requests_count if requests_count > 0 else float("nan"),
+                    "evictions": self.evictions,
+                    "entries": len(self.index),
+                    "bytes": self.total_bytes}
+
+
+class _TeeStream(io.RawIOBase):
+    """Raw binary stream reading from a source stream and copying everything it reads into a sink file
+
+    :param source: source stream
+    :type source: file-like
+    :param sink: sink file, None only counts the bytes
+    :type sink: file-like
+    """
+
+    def __init__(self, source, sink=None):
+        super().__init__()
+        self.source = source
+        self.sink = sink
+        self.n_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.source.read(len(b))
+        n = len(data)
+        b[:n] = data
+        if self.sink is not None:
+            self.sink.write(data)
+        self.n_bytes += n
+        return n
+
+
+class DownloadEngine:
+    """Downloads urls sharing one connection pool, with bounded concurrency, retries with exponential backoff and a
+    per host rate limit. It keeps track of the downloaded files and bytes to report the throughput.
+
+    :param max_workers: maximum number of concurrent downloads
+    :type max_workers: int
+    :param retries: number of retries after the first attempt
+    :type retries: int
+    :param backoff_factor: the n-th retry waits backoff_factor * 2 ** (n - 1) seconds
+    :type backoff_factor: float
+    :param rate_limit: maximum number of requests per second to the same host, None means no limit
+    :type rate_limit: float
+    :param timeout: timeout in seconds of every request
+    :type timeout: float
+    :param cache: response cache used to revalidate urls with conditional requests, None disables caching
+    :type cache: HttpCache
+    """
+
+    def __init__(self, max_workers=8, retries=3, backoff_factor=0.5, rate_limit=None, timeout=60, cache=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._next_request_time = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Resets the throughput statistics"""
+        with self._lock:
+            self.n_files = 0
+            self.n_bytes = 0
+            self.n_retries = 0
+            self.start_time = time.perf_counter()
+
+    def add_stats(self, n_files=0, n_bytes=0, n_retries=0):
+        """Adds downloaded files, bytes and retries to the statistics
+
+        :param n_files: number of files
+        :type n_files: int
+        :param n_bytes: number of bytes
+        :type n_bytes: int
+        :param n_retries: number of retries
+        :type n_retries: int
+        """
+        with self._lock:
+            self.n_files += n_files
+            self.n_bytes += n_bytes
+            self.n_retries += n_retries
+
+    def _wait_rate_limit(self, url):
+        """Waits until a new request to the host of url respects the rate limit
+
+        :param url: request url
+        :type url: str
+        """
+        if self.rate_limit is None:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            request_time = max(now, self._next_request_time.get(host, now))
+            self._next_request_time[host] = request_time + 1. / self.rate_limit
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def request(self, url, headers=None, stream=False):
+        """Sends a GET request retrying on connection errors and on retry_status_codes
+
+        :param url: request url
+        :type url: str
+        :param headers: additional request headers
+        :type headers: dict
+        :param stream: whether to defer the download of the response body
+        :type stream: bool
+        :return: response
+        :rtype: requests.Response
+        """
+        attempt = 0
+        while True:
+            self._wait_rate_limit(url)
+            try:
+                response = self.session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+                if response.status_code not in retry_status_codes or attempt == self.retries:
+                    response.raise_for_status()
+                    return response
+                response.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            attempt += 1
+            self.add_stats(n_retries=1)
+            time.sleep(self.backoff_factor * 2 ** (attempt - 1))
+
+    def fetch(self, url):
+        """Downloads the content of url. If the engine has a cache the request is conditional and a 304 response
+        returns the cached content.
+
+        :param url: request url
+        :type url: str
+        :return: (response content, whether the server answered 304 Not Modified)
+        :rtype: tuple
+        """
+        headers = {} if self.cache is None else self.cache.conditional_headers(url)
+        response = self.request(url, headers=headers)
+        if response.status_code == 304:
+            content = self.cache.read(url)
+            if content is not None:
+                return content, True
+            response = self.request(url)
+        content = response.content
+        self.add_stats(n_files=1, n_bytes=len(content))
+        if self.cache is not None:
+            self.cache.store(url, content, response.headers)
+        return content, False
+
+    @contextlib.contextmanager
+    def open_stream(self, url, buffer_size=1 << 16):
+        """Opens url as a binary stream, so that its body can be parsed while it is downloaded. If the engine has
+        a cache the request is conditional, a 304 response streams the cached body and a 200 response is copied
+        into the cache while it is read.
+
+        :param url: request url
+        :type url: str
+        :param buffer_size: size of the read buffer
+        :type buffer_size: int
+        :return: context manager yielding (binary stream, whether the server answered 304 Not Modified)
+        :rtype: contextlib.AbstractContextManager
+        """
+        headers = {} if self.cache is None else self.cache.conditional_headers(url)
+        response = self.request(url, headers=headers, stream=True)
+        tmp_path, sink = None, None
+        try:
+            cached_file = self.cache.open(url) if response.status_code == 304 else None
+            if cached_file is not None:
+                with cached_file:
+                    yield cached_file, True
+                return
+            if response.status_code == 304:
+                response.close()
+                response = self.request(url, stream=True)
+            response.raw.decode_content = True
+            if self.cache is not None:
+                tmp_path = self.cache.get_tmp_path(url)
+                sink = open(tmp_path, "wb")
+            tee = _TeeStream(response.raw, sink=sink)
+            with io.BufferedReader(tee, buffer_size=buffer_size) as reader:
+                yield reader, False
+                # The body must be complete before being cached
+                while reader.read(buffer_size):
+                    pass
+            self.add_stats(n_files=1, n_bytes=tee.n_bytes)
+            if sink is not None:
+                sink.close()
+                self.cache.store_file(url, tmp_path, response.headers)
+        finally:
+            response.close()
+            if sink is not None:
+                sink.close()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, url):
+        """Downloads the content of url
+
+        :param url: request url
+        :type url: str
+        :return: response content
+        :rtype: bytes
+        """
+        return self.fetch(url)[0]
+
+    def map(self, func, items, desc=None):
+        """Applies func to every item using max_workers threads
+
+        :param func: function to apply, usually performing downloads through this engine
+        :type func: callable
+        :param items: items to process
+        :type items: list
+        :param desc: progress bar description
+        :type desc: str
+        :return: results in the order of items
+        :rtype: list
+        """
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(tqdm(executor.map(func, items), total=len(items), desc=desc))
+
+    def throughput(self):
+        """Returns the throughput since the last reset_stats
+
+        :return: statistics dictionary
+        :rtype: dict
+        """
+        with self._lock:
+            seconds = time.perf_counter() - self.start_time
+            return {"files": self.n_files,
+                    "bytes": self.n_bytes,
+                    "retries": self.n_retries,
+                    "seconds": seconds,
+                    "files_per_s": self.n_files / seconds,
+                    "mb_per_s": self.n_bytes / seconds / 1e6}
@@ -1,14 +1,18 @@
 import os
 import pickle
+import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 from common_utilities import clean_analysis_dir
-from madrid_utilities import madrid_corr_dir, madrid_stat_dir, madrid_all_file, madrid_analysis_dir, pollutant_col,\
-    station_col, concentration_col, datetime_col
-
-# https://matplotlib.org/stable/tutorials/colors/colormaps.html
+from store_utilities import read_partitioned_dataset
+from corr_utilities import batched_corr, rolling_corr
+from corr_study import pair_to_str
+from coverage_utilities import CoverageIndex
+from render_utilities import make_heatmap_job, render_heatmap, render_heatmaps, hash_suffix
+from metrics_utilities import MetricsRecorder, null_metrics
+from stat_utilities import StatAccumulator, default_sketch_edges
+from madrid_utilities import madrid_corr_dir, madrid_dataset_dir, madrid_analysis_dir, pollutant_col, station_col, \
+    concentration_col, datetime_col, corr_subdir, stat_subdir
 
 
 def fill_missing_df(missing_dict):
@@ -19,12 +23,9 @@ def fill_missing_df(missing_dict):
     :return missing_df: df showing which values are missing
     :rtype missing_df: pd.DataFrame
     """
-    idx_values = set([el for value in missing_dict.values() for el in value])
-    disc_list = list(missing_dict.keys())
-    missing_df = pd.DataFrame(columns=disc_list, index=idx_values)
-    for idx in idx_values:
-        for disc in disc_list:
-            missing_df[disc].loc[idx] = idx in missing_dict[disc]
+    idx_values = pd.Index(list(dict.fromkeys(el for value in missing_dict.values() for el in value)))
+    missing_df = pd.DataFrame({disc: idx_values.isin(value) for disc, value in missing_dict.items()},
+                              index=idx_values, columns=list(missing_dict.keys()))
     return missing_df
 
 
@@ -58,6 +59,28 @@ def find_missing_cols(df, discriminant_column):
             if col not in [discriminant_column, datetime_col] and df[col].isna().sum() == length]
 
 
+def make_corr_heatmap_job(corr, discriminant_column, discriminant_value, group_name, analysis_dir=madrid_analysis_dir):
+    """Creates the heatmap job of a correlation matrix
+
+    :param corr: correlation matrix
+    :type corr: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param discriminant_value: value of the discriminant
+    :type discriminant_value: str
+    :param group_name: name of the group of features
+    :type group_name: str
+    :param analysis_dir: analysis directory, the heatmap is rendered in its corr subdirectory
+    :type analysis_dir: str
+    :return: heatmap job for render_utilities.render_heatmaps
+    :rtype: dict
+    """
+    # https://matplotlib.org/stable/tutorials/colors/colormaps.html
+    png_path = os.path.join(analysis_dir, corr_subdir, f"{discriminant_column}_{discriminant_value}_corr.png")
+    return make_heatmap_job(corr, title=f"Correlation matrix of {discriminant_column}_{discriminant_value}",
+                            xlabel=group_name, ylabel=group_name, png_path=png_path)
+
+
 def save_corr_mat(df, discriminant_column, group_name):
     """Saves correlation matrix given a discriminant value
 
@@ -71,17 +94,64 @@ def save_corr_mat(df, discriminant_column, group_name):
     discriminant_value = df[discriminant_column][0]
     df = df.drop([datetime_col, discriminant_column], axis=1, inplace=False)
     corr = df.corr()
-    sns.heatmap(corr, annot=True, vmin=-1, vmax=1, cmap="YlOrRd")
-    plt.title(f"Correlation matrix of {discriminant_column}_{discriminant_value}")
-    plt.xlabel(group_name)
-    plt.ylabel(group_name)
-    plt.savefig(os.path.join(madrid_corr_dir, f"{discriminant_column}_{discriminant_value}_corr.png"))
-    plt.close()
+    render_heatmap(make_corr_heatmap_job(corr, discriminant_column, discriminant_value, group_name))
     corr.to_pickle(os.path.join(madrid_corr_dir, f"{discriminant_column}_{discriminant_value}_corr.pkl"))
 
 
+def save_batched_corr_mat(values, disc_labels, pivot_labels, discriminant_column, method="pearson"):
+    """Computes and saves the correlation matrices of all the discriminant values at once, together with the number
+    of common observations of every pair
+
+    :param values: array (discriminant, datetime, pivot) as returned by fast_pivot with as_array=True
+    :type values: np.ndarray
+    :param disc_labels: discriminant values
+    :type disc_labels: iterable
+    :param pivot_labels: pivot values
+    :type pivot_labels: iterable
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param method: one of corr_utilities.corr_methods
+    :type method: str
+    :return: {discriminant: correlation matrix}
+    :rtype: dict
+    """
+    corr, counts = batched_corr(values, method=method)
+    return save_corr_arrays(corr, counts, disc_labels, pivot_labels, discriminant_column=discriminant_column)
+
+
+def save_corr_arrays(corr, counts, disc_labels, pivot_labels, discriminant_column, analysis_dir=madrid_analysis_dir):
+    """Saves the correlation matrices and the common observation counts of all the discriminant values
+
+    :param corr: correlations array (discriminant, pivot, pivot)
+    :type corr: np.ndarray
+    :param counts: common observations array (discriminant, pivot, pivot)
+    :type counts: np.ndarray
+    :param disc_labels: discriminant values
+    :type disc_labels: iterable
+    :param pivot_labels: pivot values
+    :type pivot_labels: iterable
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param analysis_dir: analysis directory, the matrices are saved in its corr subdirectory
+    :type analysis_dir: str
+    :return: {discriminant: correlation matrix}
+    :rtype: dict
+    """
+    pivot_str = [str(pivot) for pivot in pivot_labels]
+    res = {}
+    for i, discriminant_value in enumerate(disc_labels):
+        corr_df = pd.DataFrame(corr[i], index=pivot_str, columns=pivot_str)
+        corr_dir = os.path.join(analysis_dir, corr_subdir)
+        corr_df.to_pickle(os.path.join(corr_dir, f"{discriminant_column}_{discriminant_value}_corr.pkl"))
+        pd.DataFrame(counts[i], index=pivot_str, columns=pivot_str).to_pickle(
+            os.path.join(corr_dir, f"{discriminant_column}_{discriminant_value}_count.pkl"))
+        res[discriminant_value] = corr_df
+    return res
+
+
 def get_stat(df, discriminant_column):
-    """Compute some statistics about the dataset
+    """Compute some statistics about the dataset. See stat_utilities.StatAccumulator for statistics that can be
+    updated chunk by chunk.
 
     :param df: input dataframe
     :type df: pd.DataFrame
@@ -99,15 +169,18 @@ def get_stat(df, discriminant_column):
             "missing_dict": {col: df[col].isna().sum() for col in df.columns if col != datetime_col}}
 
 
-def save_stat(stat_dict):
+def save_stat(stat_dict, analysis_dir=madrid_analysis_dir):
     """Saves stat_dict from get_stat
 
     :param stat_dict: result of from get_stat
     :type stat_dict: dict
+    :param analysis_dir: analysis directory, the statistics are saved in its stat subdirectory
+    :type analysis_dir: str
     """
     discriminant_column = stat_dict["discriminant"]
     discriminant_value = stat_dict["value"]
-    with open(os.path.join(madrid_stat_dir, f"{discriminant_column}_{discriminant_value}_stat.pkl"), "wb") as f:
+    with open(os.path.join(analysis_dir, stat_subdir, f"{discriminant_column}_{discriminant_value}_stat.pkl"),
+              "wb") as f:
         pickle.dump(stat_dict, f)
 
 
@@ -142,7 +215,89 @@ def smart_pivot(df, discriminant_column, pivot_column, value_column):
     return res
 
 
-def disc_analysis(df, discriminant_column, pivot_column, value_column):
+def fast_pivot(df, discriminant_column, pivot_column, value_column, as_array=False):
+    """Same as smart_pivot but reshaping the whole input dataframe in one pass: every row is scattered in a
+    (discriminant, datetime, pivot) array using the factorized codes of the three columns.
+    If a (discriminant, datetime, pivot) triplet appears more than once the last value is kept.
+
+    :param df: input dataframe
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param pivot_column: column acting as pivot
+    :type pivot_column: str
+    :param value_column: column where values are contained
+    :type value_column: str
+    :param as_array: whether to return the 3-D array and its labels instead of the dataframes
+    :type as_array: bool
+    :return res: {disciminant: pd.DataFrame} or (array, discriminant labels, datetime labels, pivot labels)
+    :rtype res: dict or tuple
+    """
+    disc_codes, unique_discriminant = pd.factorize(df[discriminant_column])
+    datetime_codes, datetime_unique = pd.factorize(df[datetime_col])
+    pivot_codes, pivot_unique = pd.factorize(df[pivot_column])
+    values = np.full((len(unique_discriminant), len(datetime_unique), len(pivot_unique)), np.nan)
+    values[disc_codes, datetime_codes, pivot_codes] = df[value_column].to_numpy(dtype=float)
+    if as_array:
+        return values, unique_discriminant, datetime_unique, pivot_unique
+    return pivot_array_to_dict(values, unique_discriminant, datetime_unique, pivot_unique, discriminant_column)
+
+
+def pivot_array_to_dict(values, disc_labels, datetime_labels, pivot_labels, discriminant_column):
+    """Converts the array returned by fast_pivot with as_array=True to the {discriminant: pd.DataFrame} format
+
+    :param values: array (discriminant, datetime, pivot)
+    :type values: np.ndarray
+    :param disc_labels: discriminant values
+    :type disc_labels: iterable
+    :param datetime_labels: datetimes
+    :type datetime_labels: iterable
+    :param pivot_labels: pivot values
+    :type pivot_labels: iterable
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :return res: {disciminant: pd.DataFrame}
+    :rtype res: dict
+    """
+    res = {}
+    for i, disc in enumerate(disc_labels):
+        new_df = pd.DataFrame(values[i], columns=[str(pivot) for pivot in pivot_labels])
+        new_df.insert(0, datetime_col, datetime_labels)
+        new_df[discriminant_column] = disc
+        res[disc] = new_df
+    return res
+
+
+def rolling_corr_df(df, discriminant_column, window, step=1, min_periods=2, freq="h"):
+    """Computes the correlation of every pair of pivot columns of a pivoted dataframe over moving windows, see
+    corr_utilities.rolling_corr. The rows are sorted and missing datetimes are filled with np.nan, so that windows
+    span a fixed time.
+
+    :param df: pivoted dataframe, as returned by fast_pivot
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param window: number of periods of every window
+    :type window: int
+    :param step: number of periods between the starts of consecutive windows
+    :type step: int
+    :param min_periods: minimum number of common observations required to have a result
+    :type min_periods: int
+    :param freq: period of the rows
+    :type freq: str
+    :return: float32 DataFrame indexed by the last datetime of every window, with one column per pair named as in
+        corr_study
+    :rtype: pd.DataFrame
+    """
+    series = df.drop(columns=[discriminant_column]).set_index(datetime_col).sort_index().asfreq(freq)
+    corr, _, starts, (first, second) = rolling_corr(series.to_numpy(dtype=float), window=window, step=step,
+                                                    min_periods=min_periods)
+    columns = [pair_to_str(pair) for pair in zip(series.columns[first], series.columns[second])]
+    return pd.DataFrame(corr.astype(np.float32), index=series.index[starts + window - 1], columns=columns)
+
+
+def disc_analysis(df, discriminant_column, pivot_column, value_column, corr_method="pearson", coverage=None,
+                  metrics=null_metrics):
     """Analyse input dataframe in n time series like dataframe where n is the number of unique items in
     discriminat_column
 
@@ -154,36 +309,98 @@ def disc_analysis(df, discriminant_column, pivot_column, value_column):
     :type pivot_column: str
     :param value_column: column where values are contained
     :type value_column: str
+    :param corr_method: one of corr_utilities.corr_methods
+    :type corr_method: str
+    :param coverage: coverage index of df, None builds it
+    :type coverage: CoverageIndex
+    :param metrics: recorder of the "pivot" and "corr" stages and of the "stat" stage of every discriminant value
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: heatmap jobs of the correlation matrices, to be rendered with render_utilities.render_heatmaps
+    :rtype: list
     """
-    disc_df = smart_pivot(df=df, discriminant_column=discriminant_column, pivot_column=pivot_column,
-                          value_column=value_column)
+    with metrics.stage("pivot", **{discriminant_column: "all"}) as pivot_stage:
+        values, disc_labels, datetime_labels, pivot_labels = fast_pivot(
+            df=df, discriminant_column=discriminant_column, pivot_column=pivot_column, value_column=value_column,
+            as_array=True)
+        pivot_stage.add(rows_in=len(df), rows_out=values.shape[0] * values.shape[1])
+    with metrics.stage("corr", **{discriminant_column: "all"}) as corr_stage:
+        corr_dict = save_batched_corr_mat(values, disc_labels, pivot_labels, discriminant_column=discriminant_column,
+                                          method=corr_method)
+        corr_stage.add(rows_in=values.shape[0] * values.shape[1], rows_out=len(corr_dict))
+    disc_df = pivot_array_to_dict(values, disc_labels, datetime_labels, pivot_labels, discriminant_column)
+    coverage = CoverageIndex(df) if coverage is None else coverage
     missing_cols_dict = {}
     missing_dates_dict = {}
     for el, df in tqdm(disc_df.items()):
-        df.to_pickle(os.path.join(madrid_analysis_dir, f"{discriminant_column}_{el}_df.pkl"))
-        stat_dict = get_stat(df, discriminant_column)
-        print(stat_dict)
-        save_stat(stat_dict=stat_dict)
-        save_corr_mat(df=df, discriminant_column=discriminant_column, group_name=pivot_column)
-        missing_cols_dict[el] = find_missing_cols(df=df, discriminant_column=discriminant_column)
-        missing_dates_dict[el] = find_missing_dates(df=df, discriminant_column=discriminant_column)
+        with metrics.stage("stat", **{discriminant_column: el}) as stat_stage:
+            df_path = os.path.join(madrid_analysis_dir, f"{discriminant_column}_{el}_df.pkl")
+            df.to_pickle(df_path)
+            stat = StatAccumulator.from_df(df, discriminant_column, sketch_edges=default_sketch_edges)
+            stat_dict = stat.to_stat_dict()
+            print(stat_dict)
+            save_stat(stat_dict=stat_dict)
+            missing_cols_dict[el] = coverage.fully_missing_columns(discriminant_column, el)
+            missing_dates_dict[el] = coverage.fully_missing_dates(discriminant_column, el)
+            stat_stage.add(rows_in=len(df), bytes_written=os.path.getsize(df_path) if metrics.enabled else 0)
     disc_missing_cols_df = fill_missing_df(missing_dict=missing_cols_dict)
     disc_missing_cols_df.to_pickle(os.path.join(madrid_analysis_dir, f"missing_df_{discriminant_column}.pkl"))
+    return [make_corr_heatmap_job(corr, discriminant_column, el, pivot_column) for el, corr in corr_dict.items()]
+
+
+def load_long_df(file, **filters):
+    """Loads the long table either from a pickle file or from a partitioned dataset directory
+
+    :param file: pickle file or dataset directory
+    :type file: str
+    :param filters: stations, pollutants, columns, date_from and date_to filters of read_partitioned_dataset,
+        only supported for dataset directories
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    if os.path.isdir(file):
+        return read_partitioned_dataset(file, **filters)
+    if len(filters) > 0:
+        raise ValueError("filters are only supported when reading a partitioned dataset")
+    return pd.read_pickle(file)
 
 
-def full_analysis(file):
-    """Performs the full analysis of a dataframe using both station_col and pollutant_col as discriminant_column
+def full_analysis(file, render=True, n_jobs=None, metrics=null_metrics, **filters):
+    """Performs the full analysis of a dataframe using both station_col and pollutant_col as discriminant_column.
+    The heatmaps are rendered only once all the numeric results are saved.
 
-    :param file:
+    :param file: pickle file or partitioned dataset directory
     :type file: str
+    :param render: whether to render the correlation heatmaps
+    :type render: bool
+    :param n_jobs: number of processes rendering the heatmaps, None uses all the cpus
+    :type n_jobs: int
+    :param metrics: recorder of the "load", "coverage" and "render" stages and of the stages of disc_analysis
+    :type metrics: metrics_utilities.MetricsRecorder
+    :param filters: filters passed to read_partitioned_dataset, see load_long_df
     """
-    df = pd.read_pickle(file)
-    disc_analysis(df, discriminant_column=station_col, pivot_column=pollutant_col, value_column=concentration_col)
-    disc_analysis(df, discriminant_column=pollutant_col, pivot_column=station_col, value_column=concentration_col)
+    with metrics.stage("load") as load_stage:
+        df = load_long_df(file, **filters)
+        load_stage.add(rows_out=len(df))
+    with metrics.stage("coverage") as coverage_stage:
+        coverage = CoverageIndex(df)
+        coverage_stage.add(rows_in=len(df))
+    heatmap_jobs = disc_analysis(df, discriminant_column=station_col, pivot_column=pollutant_col,
+                                 value_column=concentration_col, coverage=coverage, metrics=metrics)
+    heatmap_jobs += disc_analysis(df, discriminant_column=pollutant_col, pivot_column=station_col,
+                                  value_column=concentration_col, coverage=coverage, metrics=metrics)
+    if render:
+        with metrics.stage("render") as render_stage:
+            render_report = render_heatmaps(heatmap_jobs, n_jobs=n_jobs, remove_stale=True)
+            render_stage.add(rows_out=render_report["rendered"])
+        print(render_report)
 
 
 if __name__ == "__main__":
-    clean_analysis_dir(analysis_dir=madrid_analysis_dir)
-    file = madrid_all_file
-    #  file = "ciao.pkl"
-    full_analysis(file=file)
+    # Rendered heatmaps are kept: render_heatmaps only redraws the ones whose correlation matrix changed and removes
+    # the ones of discriminant values that are no longer in the data
+    clean_analysis_dir(analysis_dir=madrid_analysis_dir, keep_extensions=(".png", hash_suffix))
+    # The dataset is kept up to date by madrid_extract.incremental_extract
+    file = madrid_dataset_dir
+    metrics = MetricsRecorder()
+    full_analysis(file=file, metrics=metrics)
+    metrics.save(os.path.join(madrid_analysis_dir, "analysis_metrics.json"))
@@ -0,0 +1,278 @@
+import os
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from common_utilities import clean_analysis_dir
+from store_utilities import read_partitioned_dataset, count_year_rows
+from corr_utilities import corr_moments, merge_corr_moments, corr_from_moments
+from render_utilities import render_heatmaps, hash_suffix
+from metrics_utilities import MetricsRecorder, null_metrics
+from stat_utilities import StatAccumulator, default_sketch_edges
+from madrid_analysis import save_corr_arrays, save_stat, pivot_array_to_dict, fill_missing_df, make_corr_heatmap_job
+from madrid_utilities import madrid_analysis_dir, madrid_dataset_dir, pollutant_col, station_col, concentration_col, \
+    datetime_col, corr_subdir, stat_subdir
+
+# Bytes of one row of the long table read by read_year_chunk, measured with DataFrame.memory_usage(deep=True) on the
+# Madrid dataset: 84, the pollutant strings take 60 of them
+long_row_bytes = 90
+# Peak bytes of one cell of the array (discriminant, datetime, pivot) while DiscAccumulator.add_chunk runs, measured
+# with tracemalloc on the Madrid dataset: 66, i.e. the array, the codes of pivot_chunk and the temporary arrays of
+# corr_moments. The accumulators of both discriminants have the same number of cells and run one after the other.
+pivot_cell_bytes = 72
+
+
+def estimate_year_bytes(year, n_rows, n_cells_per_hour):
+    """Estimates the peak memory of analysing one year: its rows of the long table and the cells of its pivoted array
+
+    :param year: year
+    :type year: int
+    :param n_rows: number of rows of the year
+    :type n_rows: int
+    :param n_cells_per_hour: number of cells of the pivoted array of one hour, i.e. stations times pollutants
+    :type n_cells_per_hour: int
+    :return: bytes
+    :rtype: float
+    """
+    n_hours = (pd.Timestamp(f"{year + 1}-01-01") - pd.Timestamp(f"{year}-01-01")) // pd.Timedelta(1, "h")
+    return n_rows * long_row_bytes + n_hours * n_cells_per_hour * pivot_cell_bytes
+
+
+def plan_year_chunks(dataset_dir, memory_budget_mb, n_cells_per_hour):
+    """Groups the consecutive years of a dataset in chunks whose estimated analysis memory, see estimate_year_bytes,
+    fits the budget. A year exceeding the budget on its own gets its own chunk.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param memory_budget_mb: memory budget in MB
+    :type memory_budget_mb: float
+    :param n_cells_per_hour: number of cells of the pivoted array of one hour, i.e. stations times pollutants
+    :type n_cells_per_hour: int
+    :return: list of lists of years
+    :rtype: list
+    """
+    max_bytes = memory_budget_mb * 1e6
+    chunks = []
+    chunk_bytes = 0
+    for year, n_rows in count_year_rows(dataset_dir).items():
+        year_bytes = estimate_year_bytes(year, n_rows, n_cells_per_hour)
+        if len(chunks) == 0 or chunk_bytes + year_bytes > max_bytes:
+            chunks.append([])
+            chunk_bytes = 0
+        chunks[-1].append(year)
+        chunk_bytes += year_bytes
+    return chunks
+
+
+def read_year_chunk(dataset_dir, years, columns=None):
+    """Reads the rows of a chunk of consecutive years
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param years: consecutive years
+    :type years: list
+    :param columns: columns to read, None reads all of them
+    :type columns: list
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    return read_partitioned_dataset(dataset_dir, columns=columns, date_from=f"{years[0]}-01-01",
+                                    date_to=pd.Timestamp(f"{years[-1] + 1}-01-01") - pd.Timedelta(1, "ns"))
+
+
+def get_dataset_labels(dataset_dir, chunks):
+    """Returns the stations and pollutants of a dataset in order of first appearance, the same order
+    madrid_analysis.fast_pivot gives to the whole dataset. Only one chunk of the two columns is read at a time.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param chunks: consecutive chunks of years
+    :return: (station labels, pollutant labels)
+    :rtype: tuple
+    """
+    stations, pollutants = pd.Index([]), pd.Index([])
+    for years in chunks:
+        df = read_year_chunk(dataset_dir, years, columns=[station_col, pollutant_col])
+        stations = stations.append(pd.Index(pd.unique(df[station_col].to_numpy())).difference(stations, sort=False))
+        pollutants = pollutants.append(
+            pd.Index(pd.unique(df[pollutant_col].to_numpy())).difference(pollutants, sort=False))
+    return stations.to_numpy(), pollutants.to_numpy()
+
+
+def pivot_chunk(df, discriminant_column, pivot_column, value_column, disc_labels, pivot_labels):
+    """Same as madrid_analysis.fast_pivot with as_array=True but using fixed discriminant and pivot labels, so that
+    the arrays of different chunks are aligned
+
+    :param df: long table of one chunk
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param pivot_column: column acting as pivot
+    :type pivot_column: str
+    :param value_column: column where values are contained
+    :type value_column: str
+    :param disc_labels: all the discriminant values of the dataset
+    :type disc_labels: np.ndarray
+    :param pivot_labels: all the pivot values of the dataset
+    :type pivot_labels: np.ndarray
+    :return: (array (discriminant, datetime, pivot), datetime labels)
+    :rtype: tuple
+    """
+    disc_codes = pd.Index(disc_labels).get_indexer(df[discriminant_column].to_numpy())
+    pivot_codes = pd.Index(pivot_labels).get_indexer(df[pivot_column].to_numpy())
+    datetime_codes, datetime_unique = pd.factorize(df[datetime_col])
+    values = np.full((len(disc_labels), len(datetime_unique), len(pivot_labels)), np.nan)
+    values[disc_codes, datetime_codes, pivot_codes] = df[value_column].to_numpy(dtype=float)
+    return values, datetime_unique
+
+
+def load_chunked_pivot(discriminant_column, discriminant_value, analysis_dir=madrid_analysis_dir):
+    """Joins the pivoted dataframe of a discriminant value saved one chunk at a time by chunked_analysis
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param discriminant_value: discriminant value
+    :param analysis_dir: analysis directory
+    :type analysis_dir: str
+    :return: pivoted dataframe, as saved by madrid_analysis.disc_analysis
+    :rtype: pd.DataFrame
+    """
+    prefix = f"{discriminant_column}_{discriminant_value}_df_"
+    files = sorted(file for file in os.listdir(analysis_dir) if file.startswith(prefix) and file.endswith(".pkl"))
+    return pd.concat([pd.read_pickle(os.path.join(analysis_dir, file)) for file in files], axis=0, ignore_index=True)
+
+
+class DiscAccumulator:
+    """Accumulates the results of madrid_analysis.disc_analysis one chunk of years at a time: statistics (see
+    stat_utilities.StatAccumulator) and co-moment sums of the correlations are merged in memory, the pivoted
+    dataframes are saved one file per chunk. Memory only depends on the size of a chunk and on the number of labels.
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param pivot_column: column acting as pivot
+    :type pivot_column: str
+    :param value_column: column where values are contained
+    :type value_column: str
+    :param disc_labels: all the discriminant values of the dataset
+    :type disc_labels: np.ndarray
+    :param pivot_labels: all the pivot values of the dataset
+    :type pivot_labels: np.ndarray
+    :param analysis_dir: directory of the results, with corr and stat subdirectories
+    :type analysis_dir: str
+    """
+
+    def __init__(self, discriminant_column, pivot_column, value_column, disc_labels, pivot_labels,
+                 analysis_dir=madrid_analysis_dir):
+        self.discriminant_column = discriminant_column
+        self.pivot_column = pivot_column
+        self.value_column = value_column
+        self.disc_labels = disc_labels
+        self.pivot_labels = pivot_labels
+        self.analysis_dir = analysis_dir
+        self.moments = None
+        self.stats = [StatAccumulator(discriminant_column, el, pivot_labels, sketch_edges=default_sketch_edges)
+                      for el in disc_labels]
+
+    def add_chunk(self, df, chunk_name):
+        """Adds the rows of a chunk
+
+        :param df: long table of the chunk
+        :type df: pd.DataFrame
+        :param chunk_name: name of the chunk, the pivoted dataframes are joined in the order of the names
+        :type chunk_name: str
+        """
+        values, datetime_labels = pivot_chunk(df, self.discriminant_column, self.pivot_column, self.value_column,
+                                              self.disc_labels, self.pivot_labels)
+        if values.shape[1] == 0:
+            return
+        if self.moments is None:
+            # The means of the first chunk are the shift of all the chunks, so that their sums can be added
+            self.moments = corr_moments(values)
+        else:
+            self.moments = merge_corr_moments(self.moments, corr_moments(values, shift=self.moments["shift"]))
+        for i, stat in enumerate(self.stats):
+            stat.update_values(datetime_labels, values[i])
+        disc_df = pivot_array_to_dict(values, self.disc_labels, datetime_labels, self.pivot_labels,
+                                      self.discriminant_column)
+        for el, pivot_df in disc_df.items():
+            pivot_df.to_pickle(os.path.join(self.analysis_dir,
+                                            f"{self.discriminant_column}_{el}_df_{chunk_name}.pkl"))
+
+    def finalize(self):
+        """Saves correlations, statistics and fully missing columns as madrid_analysis.disc_analysis does
+
+        :return: heatmap jobs of the correlation matrices, to be rendered with render_utilities.render_heatmaps
+        :rtype: list
+        """
+        if self.moments is None:
+            raise ValueError(f"no rows were added to the {self.discriminant_column} accumulator")
+        corr, counts = corr_from_moments(self.moments)
+        corr_dict = save_corr_arrays(corr, counts, self.disc_labels, self.pivot_labels,
+                                     discriminant_column=self.discriminant_column, analysis_dir=self.analysis_dir)
+        sorted_pivots = np.argsort(pd.Index(self.pivot_labels))
+        missing_cols_dict = {}
+        for el, stat in zip(self.disc_labels, self.stats):
+            stat_dict = stat.to_stat_dict()
+            print(stat_dict)
+            save_stat(stat_dict=stat_dict, analysis_dir=self.analysis_dir)
+            missing_cols_dict[el] = [str(self.pivot_labels[j]) for j in sorted_pivots if stat.count[j] == 0]
+        disc_missing_cols_df = fill_missing_df(missing_dict=missing_cols_dict)
+        disc_missing_cols_df.to_pickle(os.path.join(self.analysis_dir, f"missing_df_{self.discriminant_column}.pkl"))
+        return [make_corr_heatmap_job(corr, self.discriminant_column, el, self.pivot_column,
+                                      analysis_dir=self.analysis_dir) for el, corr in corr_dict.items()]
+
+
+def chunked_analysis(dataset_dir, analysis_dir=madrid_analysis_dir, memory_budget_mb=1024, render=True, n_jobs=None,
+                     metrics=null_metrics):
+    """Out-of-core version of madrid_analysis.full_analysis for partitioned datasets: the years are processed in
+    chunks fitting the memory budget, so peak memory does not grow with the number of years. Statistics, correlations
+    and missing columns are the same as the ones of full_analysis, the pivoted dataframes are saved one file per
+    chunk and can be joined with load_chunked_pivot. Only pearson correlations can be merged across chunks.
+
+    :param dataset_dir: dataset directory, see madrid_extract.incremental_extract
+    :type dataset_dir: str
+    :param analysis_dir: directory of the results, a different one for every dataset, e.g. for the EEA datasets of
+        discomapEEA_extract.extract_eea. Its corr and stat subdirectories are created if missing.
+    :type analysis_dir: str
+    :param memory_budget_mb: memory budget of one chunk in MB
+    :type memory_budget_mb: float
+    :param render: whether to render the correlation heatmaps
+    :type render: bool
+    :param n_jobs: number of processes rendering the heatmaps, None uses all the cpus
+    :type n_jobs: int
+    :param metrics: recorder of the "labels" stage, of the "chunk" stage of every chunk and of the "render" stage
+    :type metrics: metrics_utilities.MetricsRecorder
+    """
+    with metrics.stage("labels"):
+        station_labels, pollutant_labels = get_dataset_labels(dataset_dir,
+                                                              [[year] for year in count_year_rows(dataset_dir)])
+    chunks = plan_year_chunks(dataset_dir, memory_budget_mb=memory_budget_mb,
+                              n_cells_per_hour=len(station_labels) * len(pollutant_labels))
+    for subdir in [corr_subdir, stat_subdir]:
+        os.makedirs(os.path.join(analysis_dir, subdir), exist_ok=True)
+    accumulators = [DiscAccumulator(station_col, pollutant_col, concentration_col, station_labels, pollutant_labels,
+                                    analysis_dir=analysis_dir),
+                    DiscAccumulator(pollutant_col, station_col, concentration_col, pollutant_labels, station_labels,
+                                    analysis_dir=analysis_dir)]
+    for years in tqdm(chunks, desc="chunks"):
+        with metrics.stage("chunk", years=f"{years[0]}-{years[-1]}") as chunk_stage:
+            df = read_year_chunk(dataset_dir, years)
+            for accumulator in accumulators:
+                accumulator.add_chunk(df, chunk_name=str(years[0]))
+            chunk_stage.add(rows_in=len(df))
+            del df
+    heatmap_jobs = []
+    for accumulator in accumulators:
+        heatmap_jobs += accumulator.finalize()
+    if render:
+        with metrics.stage("render") as render_stage:
+            render_report = render_heatmaps(heatmap_jobs, n_jobs=n_jobs, remove_stale=True)
+            render_stage.add(rows_out=render_report["rendered"])
+        print(render_report)
+
+
+if __name__ == "__main__":
+    clean_analysis_dir(analysis_dir=madrid_analysis_dir, keep_extensions=(".png", hash_suffix))
+    metrics = MetricsRecorder(trace_memory=True)
+    chunked_analysis(dataset_dir=madrid_dataset_dir, analysis_dir=madrid_analysis_dir, memory_budget_mb=512,
+                     metrics=metrics)
+    metrics.save(os.path.join(madrid_analysis_dir, "chunked_analysis_metrics.json"))
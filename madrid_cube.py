@@ -0,0 +1,10 @@
+from store_utilities import read_partitioned_dataset
+from cube_utilities import build_cube, TimeSeriesCube
+from madrid_utilities import madrid_dataset_dir, madrid_cube_dir
+
+
+if __name__ == "__main__":
+    cube = build_cube(read_partitioned_dataset(madrid_dataset_dir), cube_dir=madrid_cube_dir)
+    print(f"cube {cube.values.shape} of {len(cube.stations)} stations, {len(cube.pollutants)} pollutants and "
+          f"{cube.n_hours} hours from {cube.start}")
+    print(TimeSeriesCube(madrid_cube_dir).series(cube.stations[0], cube.pollutants[0]).describe())
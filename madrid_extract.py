@@ -1,12 +1,18 @@
 import os
+import re
+import shutil
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
 
-from common_utilities import value_valid_mix
-from madrid_utilities import madrid_data_dir, convert_station_number, useless_col, station_col_old, date_columns, \
-    madrid_all_file, pollutant_col_old, pollutant_dict_madrid, concentration_col, datetime_col, pollutant_col,\
-    station_col, is_relevant_pollutant
+from common_utilities import value_valid_mix, run_in_pool
+from madrid_utilities import useless_col, station_col_old, date_columns, pollutant_col_old, \
+    concentration_col, datetime_col, pollutant_col, station_col, is_relevant_pollutant, madrid_dataset_dir, zip_dir, \
+    convert_station_numbers, convert_pollutant_codes, pollutant_names, madrid_proc_dir
+from madrid_unzip import get_zip_members, is_zip_member, read_zip_member_csv, get_zip_member_signature
+from store_utilities import write_partitioned_dataset, get_file_signature, load_manifest, save_manifest, remove_parts
+from metrics_utilities import MetricsRecorder, null_metrics
 
 valid_col = "valid"
 hour_col = "hour"
@@ -35,7 +41,7 @@ def get_all_stations(data_dir):
     most_recent_dir = os.path.join(data_dir, list_dir[-1])
     most_recent_file = os.listdir(most_recent_dir)[0]
     data = open_clean_df(filename=os.path.join(most_recent_dir, most_recent_file))
-    data[station_col] = data[station_col].apply(convert_station_number)
+    data[station_col] = convert_station_numbers(data[station_col])
     return list(data[station_col].unique())
 
 
@@ -48,19 +54,49 @@ def open_year_dir(dir_path):
     :rtype: pd.DataFrame
     """
     file_list = os.listdir(dir_path)
-    df_list = [open_clean_df(os.path.join(dir_path, file)) for file in file_list]
+    return open_year_sources([os.path.join(dir_path, file) for file in file_list])
+
+
+def open_year_sources(sources):
+    """Opens, cleans and joins all the files of one year.
+
+    :param sources: file paths or zip members
+    :type sources: list
+    :return: yearly data
+    :rtype: pd.DataFrame
+    """
+    df_list = [open_clean_df(source) for source in sources]
     return pd.concat(df_list, axis=0)
 
 
+def get_year_sources(data_dir, from_zip=False):
+    """Returns the source files grouped by year
+
+    :param data_dir: data directory, or directory containing the zip archives if from_zip
+    :type data_dir: str
+    :param from_zip: whether to read the csv members of the zip archives instead of the yearly directories
+    :type from_zip: bool
+    :return: list of lists of file paths or zip members
+    :rtype: list
+    """
+    if from_zip:
+        return list(get_zip_members(data_dir).values())
+    dir_paths = [os.path.join(data_dir, year_dir) for year_dir in get_year_directories(data_dir)]
+    return [[os.path.join(dir_path, file) for file in os.listdir(dir_path)] for dir_path in dir_paths]
+
+
 def open_clean_df(filename):
     """Extract data from a file
 
-    :param filename: filename
+    :param filename: filename or zip member as returned by madrid_unzip.get_zip_members
     :type filename: str
     :return data: year data
     :rtype data: pd.DataFrame
     """
-    data = pd.read_csv(filename, sep=";")
+    if is_zip_member(filename):
+        data = read_zip_member_csv(filename, sep=";")
+    else:
+        data = pd.read_csv(filename, sep=";")
     data.drop(useless_col, axis=1, inplace=True)
     data.columns = [x if x != pollutant_col_old else pollutant_col for x in data.columns]
     data.columns = [x if x != station_col_old else station_col for x in data.columns]
@@ -101,24 +137,320 @@ def convert_from_year_df(data):
     return melted_hour_df
 
 
-def extract_all_ts(data_dir):
+def fast_convert_from_year_df(data):
+    """Extract a station data from yearly data working on whole columns. It returns exactly the same frame as
+    convert_from_year_df but without any per row python call: datetimes are computed with datetime64 arithmetic from
+    ANO, MES, DIA and the hour offset and invalid values are masked with a boolean array.
+
+    :param data: year data
+    :type data: pd.DataFrame
+    :return res_data: station data
+    :rtype res_data: pd.DataFrame
+    """
+    hours_cols = [col for col in data.columns if col.startswith("H")]
+    valid_cols = [col for col in data.columns if col.startswith("V")]
+    useful_cols = [col for col in data.columns if col not in hours_cols+valid_cols]
+    id_cols = [col for col in useful_cols if col not in date_columns]
+    n_rows, n_hours = len(data), len(hours_cols)
+    # pd.melt stacks value_vars one after the other => column major order
+    concentration = pd.Series(data[hours_cols].to_numpy().ravel(order="F"))
+    valid = (data[valid_cols].to_numpy() == "V").ravel(order="F")
+    year, month, day = (np.tile(data[col].to_numpy(dtype=np.int64), n_hours) for col in date_columns)
+    hour = np.repeat(np.array([int(col[1:])-1 for col in hours_cols], dtype=np.int64), n_rows)
+    month_start = ((year-1970)*12 + month-1).astype("datetime64[M]")
+    day_start = month_start.astype("datetime64[D]") + (day-1)
+    if (day_start.astype("datetime64[M]") != month_start).any():
+        raise ValueError("day is out of range for month")
+    res_data = pd.DataFrame({col: np.tile(data[col].to_numpy(), n_hours) for col in id_cols})
+    res_data[concentration_col] = concentration.where(valid, np.nan)
+    res_data[datetime_col] = pd.Series(day_start.astype("datetime64[h]") + hour).astype("datetime64[ns]")
+    return res_data
+
+
+def convert_year_sources(sources, year_df=None, metrics=null_metrics):
+    """Opens and converts the files of one year, recording the "extract_year" stage
+
+    :param sources: file paths or zip members
+    :type sources: list
+    :param year_df: cleaned data of the files if already opened, None opens them
+    :type year_df: pd.DataFrame
+    :param metrics: metrics recorder
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: converted year data
+    :rtype: pd.DataFrame
+    """
+    with metrics.stage("extract_year") as year_stage:
+        year_df = open_year_sources(sources) if year_df is None else year_df
+        res = fast_convert_from_year_df(year_df)
+        if metrics.enabled:
+            year_stage.set_partition(year=int(res[datetime_col].dt.year.min()))
+            year_stage.add(rows_in=len(year_df), rows_out=len(res),
+                           bytes_read=sum(get_source_signature(source)["size"] for source in sources))
+    return res
+
+
+def _convert_year_sources(args):
+    """Opens and converts the files of one year. Used as process pool task.
+
+    :param args: (file paths or zip members, recorder of the worker as returned by MetricsRecorder.spawn)
+    :type args: tuple
+    :return: worker pid, converted year data and records of the worker
+    :rtype: tuple
+    """
+    sources, metrics = args
+    return os.getpid(), (convert_year_sources(sources, metrics=metrics), metrics.records)
+
+
+def _open_clean_file(args):
+    """Opens and cleans one monthly file, recording the "open_file" stage. Used as process pool task.
+
+    :param args: (filename, recorder of the worker as returned by MetricsRecorder.spawn)
+    :type args: tuple
+    :return: worker pid, cleaned monthly data and records of the worker
+    :rtype: tuple
+    """
+    filename, metrics = args
+    with metrics.stage("open_file", source=filename) as file_stage:
+        df = open_clean_df(filename=filename)
+        file_stage.add(rows_out=len(df))
+    return os.getpid(), (df, metrics.records)
+
+
+def extract_all_ts(data_dir, n_jobs=1, per_file=False, from_zip=False, compact=False, unify_stations=False,
+                   metrics=null_metrics):
     """Returns the list of all measurement stations
 
-    :param data_dir: data directory
+    :param data_dir: data directory, or directory containing the zip archives if from_zip
     :type data_dir: str
+    :param n_jobs: number of worker processes, 1 runs serially in the current process
+    :type n_jobs: int
+    :param per_file: whether to send each monthly file to the pool instead of each year directory
+    :type per_file: bool
+    :param from_zip: whether to stream the csv members of the zip archives instead of reading the yearly directories
+    :type from_zip: bool
+    :param compact: whether to use the compact schema, see finalize_long_df
+    :type compact: bool
+    :param unify_stations: whether to convert old station numbers to the new ones
+    :type unify_stations: bool
+    :param metrics: recorder of the "extract" stage, of the "extract_year" stage of every year and, when per_file, of
+        the "open_file" stage of every file. The stages run by the workers are recorded by the workers.
+    :type metrics: metrics_utilities.MetricsRecorder
     :return: list of all stations
     :rtype: list
     """
-    year_dirs = get_year_directories(data_dir)
-    all_df = pd.concat([convert_from_year_df(open_year_dir(dir_path=os.path.join(data_dir, year_dir)))
-                        for year_dir in tqdm(year_dirs)], axis=0)
+    with metrics.stage("extract") as extract_stage:
+        year_sources = get_year_sources(data_dir, from_zip=from_zip)
+        all_df = _extract_year_sources(year_sources, n_jobs=n_jobs, per_file=per_file, metrics=metrics)
+        all_df = finalize_long_df(all_df, compact=compact, unify_stations=unify_stations)
+        if metrics.enabled:
+            extract_stage.add(rows_out=len(all_df), bytes_read=sum(get_source_signature(source)["size"]
+                                                                   for sources in year_sources for source in sources))
+    return all_df
+
+
+def _extract_year_sources(year_sources, n_jobs, per_file, metrics):
+    """Converts the source files of every year and concatenates them, see extract_all_ts
+
+    :param year_sources: source files of every year, as returned by get_year_sources
+    :type year_sources: list
+    :param n_jobs: number of worker processes, 1 runs serially in the current process
+    :type n_jobs: int
+    :param per_file: whether to send each monthly file to the pool instead of each year directory
+    :type per_file: bool
+    :param metrics: metrics recorder
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    if n_jobs == 1:
+        df_list = [convert_year_sources(sources, metrics=metrics) for sources in tqdm(year_sources)]
+    elif not per_file:
+        results = run_in_pool(_convert_year_sources, [(sources, metrics.spawn()) for sources in year_sources],
+                              n_jobs=n_jobs, desc="years")
+        df_list = [df for df, _ in results]
+        for _, records in results:
+            metrics.extend(records)
+    else:
+        results = run_in_pool(_open_clean_file, [(source, metrics.spawn()) for sources in year_sources
+                                                 for source in sources], n_jobs=n_jobs, desc="files")
+        for _, records in results:
+            metrics.extend(records)
+        month_iter = iter(df for df, _ in results)
+        df_list = [convert_year_sources(sources, year_df=pd.concat([next(month_iter) for _ in sources], axis=0),
+                                        metrics=metrics) for sources in year_sources]
+    all_df = pd.concat(df_list, axis=0)
     all_df.reset_index(inplace=True, drop=True)
-    all_df[station_col] = all_df[station_col].apply(int)
-    all_df[pollutant_col] = all_df[pollutant_col].apply(int)
-    all_df[pollutant_col] = all_df[pollutant_col].apply(lambda x: pollutant_dict_madrid[x])
     return all_df
 
 
+def finalize_long_df(all_df, compact=False, unify_stations=False):
+    """Converts station and pollutant codes of converted data to their final format.
+    The default schema has int64 stations, object pollutant names and float64 concentrations. The compact one has
+    int16 stations, categorical pollutant names and float32 concentrations.
+
+    :param all_df: converted data
+    :type all_df: pd.DataFrame
+    :param compact: whether to use the compact schema
+    :type compact: bool
+    :param unify_stations: whether to convert old station numbers to the new ones
+    :type unify_stations: bool
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    stations = all_df[station_col].to_numpy(dtype=np.int64)
+    if unify_stations:
+        stations = convert_station_numbers(stations)
+    pollutants = convert_pollutant_codes(all_df[pollutant_col].to_numpy(dtype=np.int64))
+    if compact:
+        all_df[station_col] = stations.astype(np.int16)
+        all_df[pollutant_col] = pollutants
+        all_df[concentration_col] = all_df[concentration_col].astype(np.float32)
+    else:
+        all_df[station_col] = stations
+        all_df[pollutant_col] = np.asarray(pollutants, dtype=object)
+    return all_df
+
+
+def compact_long_df(df):
+    """Converts a long table with the default schema to the compact one of finalize_long_df
+
+    :param df: long table
+    :type df: pd.DataFrame
+    :return: compact long table
+    :rtype: pd.DataFrame
+    """
+    return pd.DataFrame({station_col: df[station_col].to_numpy(dtype=np.int16),
+                         pollutant_col: pd.Categorical(df[pollutant_col], categories=pollutant_names),
+                         concentration_col: df[concentration_col].to_numpy(dtype=np.float32),
+                         datetime_col: df[datetime_col].to_numpy(dtype="datetime64[ns]")}, index=df.index)
+
+
+def memory_report(df, compact_df=None):
+    """Compares the memory used by a long table with the default schema and by its compact version
+
+    :param df: long table with the default schema
+    :type df: pd.DataFrame
+    :param compact_df: compact long table, None computes it with compact_long_df
+    :type compact_df: pd.DataFrame
+    :return: DataFrame with the bytes of every column in both layouts and the saved fraction
+    :rtype: pd.DataFrame
+    """
+    compact_df = compact_long_df(df) if compact_df is None else compact_df
+    report = pd.DataFrame({"default_bytes": df.memory_usage(deep=True, index=False),
+                           "compact_bytes": compact_df.memory_usage(deep=True, index=False)})
+    report.loc["total"] = report.sum()
+    report["saved"] = 1 - report["compact_bytes"] / report["default_bytes"]
+    return report
+
+
+def get_source_files(data_dir, from_zip=False):
+    """Returns all the source files of the yearly directories or of the zip archives
+
+    :param data_dir: data directory, or directory containing the zip archives if from_zip
+    :type data_dir: str
+    :param from_zip: whether to list the csv members of the zip archives
+    :type from_zip: bool
+    :return: {source key: file path or zip member} where the key is the path relative to data_dir
+    :rtype: dict
+    """
+    sources = [source for year_sources in get_year_sources(data_dir, from_zip=from_zip) for source in year_sources]
+    return {os.path.relpath(source, data_dir): source for source in sorted(sources)}
+
+
+def get_source_signature(source, use_hash=False):
+    """Returns the signature used to detect whether a source changed
+
+    :param source: file path or zip member
+    :type source: str
+    :param use_hash: whether to hash the content of files on disk, zip members always use their CRC
+    :type use_hash: bool
+    :return: signature
+    :rtype: dict
+    """
+    if is_zip_member(source):
+        return get_zip_member_signature(source)
+    return get_file_signature(source, use_hash=use_hash)
+
+
+def source_to_part_name(source):
+    """Returns the name of the partition files produced by a source file
+
+    :param source: source key
+    :type source: str
+    :return: part name
+    :rtype: str
+    """
+    return re.sub(r"[^\w\-]", "_", source)
+
+
+def extract_file_to_dataset(filename, dataset_dir, part_name):
+    """Extracts one source file and writes it in the partitioned dataset
+
+    :param filename: filename or zip member
+    :type filename: str
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param part_name: name of the partition files produced by filename
+    :type part_name: str
+    :return: written paths relative to dataset_dir
+    :rtype: list
+    """
+    df = finalize_long_df(fast_convert_from_year_df(open_clean_df(filename=filename)))
+    return [os.path.relpath(path, dataset_dir)
+            for path in write_partitioned_dataset(df, dataset_dir=dataset_dir, part_name=part_name)]
+
+
+def incremental_extract(data_dir, dataset_dir, use_hash=False, full_rebuild=False, from_zip=False,
+                        metrics=null_metrics):
+    """Updates the partitioned dataset processing only new or changed source files. Every source file writes its
+    own part in each (year, pollutant) partition it touches and the manifest records the parts of each source, so
+    the rows of a changed file replace its stale rows and the rows of a removed file are deleted.
+    A full rebuild and an incremental update produce the same parts.
+
+    :param data_dir: data directory, or directory containing the zip archives if from_zip
+    :type data_dir: str
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param use_hash: whether to compare the sha1 of the files instead of their modification time
+    :type use_hash: bool
+    :param full_rebuild: whether to delete the dataset and process every source file
+    :type full_rebuild: bool
+    :param from_zip: whether to read the csv members of the zip archives instead of the yearly directories
+    :type from_zip: bool
+    :param metrics: recorder of the "extract_file" stage of every processed source file
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: {"added": [...], "changed": [...], "removed": [...], "unchanged": [...]} source keys
+    :rtype: dict
+    """
+    if full_rebuild and os.path.isdir(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    manifest = load_manifest(dataset_dir)
+    sources = get_source_files(data_dir, from_zip=from_zip)
+    report = {"added": [], "changed": [], "removed": [], "unchanged": []}
+    for source in sorted(set(manifest.keys()) - set(sources.keys())):
+        remove_parts(dataset_dir, manifest.pop(source)["parts"])
+        report["removed"].append(source)
+    for source, filename in tqdm(sources.items()):
+        signature = get_source_signature(filename, use_hash=use_hash)
+        if source in manifest and manifest[source]["signature"] == signature:
+            report["unchanged"].append(source)
+            continue
+        if source in manifest:
+            remove_parts(dataset_dir, manifest.pop(source)["parts"])
+            report["changed"].append(source)
+        else:
+            report["added"].append(source)
+        with metrics.stage("extract_file", source=source) as file_stage:
+            parts = extract_file_to_dataset(filename, dataset_dir=dataset_dir, part_name=source_to_part_name(source))
+            file_stage.add(bytes_read=signature["size"], bytes_written=sum(
+                os.path.getsize(os.path.join(dataset_dir, part)) for part in parts) if metrics.enabled else 0)
+        manifest[source] = {"signature": signature, "parts": parts}
+        save_manifest(manifest, dataset_dir)
+    save_manifest(manifest, dataset_dir)
+    return report
+
+
 if __name__ == "__main__":
-    all_df = extract_all_ts(data_dir=madrid_data_dir)
-    all_df.to_pickle(madrid_all_file)
+    metrics = MetricsRecorder(trace_memory=True)
+    print(incremental_extract(data_dir=zip_dir, dataset_dir=madrid_dataset_dir, from_zip=True, metrics=metrics))
+    metrics.save(os.path.join(madrid_proc_dir, "extract_metrics.json"))
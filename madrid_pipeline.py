@@ -0,0 +1,202 @@
+import os
+import numpy as np
+from functools import partial
+import corr_study
+import corr_utilities
+import common_utilities
+import madrid_unzip
+import madrid_extract
+import madrid_utilities
+import stat_utilities
+from corr_utilities import batched_corr
+from corr_study import aggregate_corr
+from pipeline_utilities import Pipeline
+from stat_utilities import StatAccumulator, default_sketch_edges
+from madrid_unzip import unzip_all
+from madrid_extract import extract_all_ts, get_source_files, get_source_signature
+from madrid_analysis import fast_pivot, pivot_array_to_dict, save_stat, save_corr_arrays
+from madrid_utilities import madrid_cache_dir, madrid_data_dir, madrid_analysis_dir, zip_dir, station_col, \
+    pollutant_col, concentration_col
+
+
+def get_data_signature(data_dir):
+    """Returns the signatures of the csv files of the yearly directories
+
+    :param data_dir: data directory
+    :type data_dir: str
+    :return: {relative path: signature}
+    :rtype: dict
+    """
+    return {source: get_source_signature(path) for source, path in get_source_files(data_dir).items()}
+
+
+def unzip_stage(zip_dir, data_dir):
+    """Extracts the zip archives, see madrid_unzip.unzip_all
+
+    :param zip_dir: directory containing the zip archives
+    :type zip_dir: str
+    :param data_dir: data directory
+    :type data_dir: str
+    :return: signatures of the extracted files
+    :rtype: dict
+    """
+    unzip_all(zip_dir=zip_dir, data_dir=data_dir)
+    return get_data_signature(data_dir)
+
+
+def is_data_unchanged(data_signature, data_dir):
+    """Check of the unzip stage: the extracted files are still the ones it wrote
+
+    :param data_signature: output of the unzip stage
+    :type data_signature: dict
+    :param data_dir: data directory
+    :type data_dir: str
+    :return: whether the files are unchanged
+    :rtype: bool
+    """
+    return os.path.isdir(data_dir) and get_data_signature(data_dir) == data_signature
+
+
+def extract_stage(data_signature, data_dir):
+    """Extracts the long table of the yearly directories, see madrid_extract.extract_all_ts
+
+    :param data_signature: output of the unzip stage, it only makes the key depend on the extracted files
+    :type data_signature: dict
+    :param data_dir: data directory
+    :type data_dir: str
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    return extract_all_ts(data_dir=data_dir)
+
+
+def pivot_stage(df, discriminant_column, pivot_column):
+    """Pivots the long table, see madrid_analysis.fast_pivot
+
+    :param df: long table
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param pivot_column: column acting as pivot
+    :type pivot_column: str
+    :return: (array (discriminant, datetime, pivot), discriminant labels, datetime labels, pivot labels)
+    :rtype: tuple
+    """
+    return fast_pivot(df, discriminant_column=discriminant_column, pivot_column=pivot_column,
+                      value_column=concentration_col, as_array=True)
+
+
+def stats_stage(pivot, discriminant_column):
+    """Computes the statistics of every discriminant value, see stat_utilities.StatAccumulator
+
+    :param pivot: output of the pivot stage
+    :type pivot: tuple
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :return: {discriminant: statistic dictionary}
+    :rtype: dict
+    """
+    values, disc_labels, datetime_labels, pivot_labels = pivot
+    return {el: StatAccumulator(discriminant_column, el, pivot_labels, sketch_edges=default_sketch_edges).update_values(
+        datetime_labels, values[i]).to_stat_dict() for i, el in enumerate(disc_labels)}
+
+
+def corr_stage(pivot, method):
+    """Computes the correlation matrices of every discriminant value, see corr_utilities.batched_corr
+
+    :param pivot: output of the pivot stage
+    :type pivot: tuple
+    :param method: one of corr_utilities.corr_methods
+    :type method: str
+    :return: correlation tensor in the format of corr_study.load_corr_tensor, plus the discriminant labels
+    :rtype: dict
+    """
+    values, disc_labels, _, pivot_labels = pivot
+    corr, counts = batched_corr(values, method=method)
+    return {"values": corr, "counts": counts, "disc_labels": np.asarray(disc_labels),
+            "labels": np.array([str(pivot) for pivot in pivot_labels], dtype=str)}
+
+
+def avg_corr_stage(corr):
+    """Averages the correlation matrices of all the discriminant values, see corr_study.avg_corr
+
+    :param corr: output of the corr stage
+    :type corr: dict
+    :return: DataFrame with correlation means
+    :rtype: pd.DataFrame
+    """
+    mean_corr_df = aggregate_corr(corr)
+    mean_corr_df.sort_values("abs_mean", ascending=False, inplace=True)
+    return mean_corr_df
+
+
+def build_madrid_pipeline(cache_dir=madrid_cache_dir, zip_dir=zip_dir, data_dir=madrid_data_dir,
+                          corr_method="pearson"):
+    """Describes the Madrid analysis as a DAG of cached stages: unzip, extract, then pivot, stats, corr and avg_corr
+    for both station_col and pollutant_col as discriminant. The code called by every stage is listed in its deps.
+
+    :param cache_dir: cache directory of the stage outputs
+    :type cache_dir: str
+    :param zip_dir: directory containing the zip archives, their signatures are part of the unzip key
+    :type zip_dir: str
+    :param data_dir: data directory
+    :type data_dir: str
+    :param corr_method: one of corr_utilities.corr_methods
+    :type corr_method: str
+    :return: pipeline
+    :rtype: Pipeline
+    """
+    pipeline = Pipeline(cache_dir)
+    pipeline.add_stage("unzip", unzip_stage, params={"zip_dir": zip_dir, "data_dir": data_dir}, watch=["zip_dir"],
+                       check=partial(is_data_unchanged, data_dir=data_dir), deps=[madrid_unzip])
+    pipeline.add_stage("extract", extract_stage, inputs={"data_signature": "unzip"}, params={"data_dir": data_dir},
+                       deps=[madrid_extract, madrid_utilities, common_utilities])
+    for disc, pivot in [(station_col, pollutant_col), (pollutant_col, station_col)]:
+        pipeline.add_stage(f"pivot_{disc}", pivot_stage, inputs={"df": "extract"},
+                           params={"discriminant_column": disc, "pivot_column": pivot},
+                           deps=[fast_pivot, pivot_array_to_dict])
+        pipeline.add_stage(f"stats_{disc}", stats_stage, inputs={"pivot": f"pivot_{disc}"},
+                           params={"discriminant_column": disc}, deps=[stat_utilities])
+        pipeline.add_stage(f"corr_{disc}", corr_stage, inputs={"pivot": f"pivot_{disc}"},
+                           params={"method": corr_method}, deps=[corr_utilities])
+        pipeline.add_stage(f"avg_corr_{disc}", avg_corr_stage, inputs={"corr": f"corr_{disc}"}, deps=[corr_study])
+    return pipeline
+
+
+def export_results(outputs):
+    """Saves the statistics, correlation matrices and average correlations of a run in the analysis directories
+
+    :param outputs: {stage name: output} of the stats, corr and avg_corr stages
+    :type outputs: dict
+    """
+    for disc in [station_col, pollutant_col]:
+        for stat_dict in outputs[f"stats_{disc}"].values():
+            save_stat(stat_dict=stat_dict)
+        corr = outputs[f"corr_{disc}"]
+        save_corr_arrays(corr["values"], corr["counts"], corr["disc_labels"], corr["labels"], discriminant_column=disc)
+        outputs[f"avg_corr_{disc}"].to_pickle(os.path.join(madrid_analysis_dir, f"avg_corr_{disc}.pkl"))
+
+
+def run_madrid_pipeline(pipeline, force=()):
+    """Runs all the stages of the Madrid pipeline, exports their results and prints which stages ran
+
+    :param pipeline: pipeline returned by build_madrid_pipeline
+    :type pipeline: Pipeline
+    :param force: stage names to run even if cached
+    :type force: iterable
+    :return: report DataFrame, see Pipeline.run
+    :rtype: pd.DataFrame
+    """
+    targets = [f"{stage}_{disc}" for disc in [station_col, pollutant_col] for stage in ["stats", "corr", "avg_corr"]]
+    outputs, report = pipeline.run(targets=targets, force=force)
+    export_results(outputs)
+    print(report.to_string(index=False))
+    return report
+
+
+if __name__ == "__main__":
+    pipeline = build_madrid_pipeline()
+    run_madrid_pipeline(pipeline)
+    # Eviction is explicit: keep the outputs of the last two runs of every stage
+    pipeline.evict(keep_per_stage=2)
+    print(pipeline.cache_report())
@@ -0,0 +1,13 @@
+import os
+from rollup_utilities import build_rollups, query_rollups, get_rollup_dir
+from metrics_utilities import MetricsRecorder
+from madrid_utilities import madrid_dataset_dir
+
+
+if __name__ == "__main__":
+    metrics = MetricsRecorder()
+    print(build_rollups(madrid_dataset_dir, metrics=metrics))
+    metrics.save(os.path.join(get_rollup_dir(madrid_dataset_dir), "rollup_metrics.json"))
+    for freq in ["A", "Q", "M", "W", "D"]:
+        res, level = query_rollups(madrid_dataset_dir, freq=freq)
+        print(f"{freq}: {len(res)} rows from the {level} level")
@@ -1,6 +1,7 @@
 import os
 import re
 import zipfile
+import pandas as pd
 from tqdm import tqdm
 from madrid_utilities import madrid_data_dir, zip_dir
 
@@ -18,7 +19,76 @@ def get_year(file_name):
     return tmp[:4]
 
 
-if __name__ == "__main__":
+zip_member_sep = "::"
+
+
+def get_zip_members(zip_dir):
+    """Returns the csv members of all the zip archives of zip_dir grouped by year.
+    Each member is identified by the string <zip path><zip_member_sep><member name>.
+
+    :param zip_dir: directory containing the zip archives
+    :type zip_dir: str
+    :return: {year: [members]}
+    :rtype: dict
+    """
+    year_members = {}
+    for content in os.listdir(zip_dir):
+        file_path = os.path.join(zip_dir, content)
+        if zipfile.is_zipfile(file_path):
+            with zipfile.ZipFile(file_path) as zf:
+                members = [file_path + zip_member_sep + member.filename for member in zf.infolist()
+                           if "csv" in member.filename]
+            year_members.setdefault(get_year(content), []).extend(members)
+    return year_members
+
+
+def is_zip_member(source):
+    """Returns whether source identifies a zip archive member
+
+    :param source: file path or zip member
+    :type source: str
+    :return: whether source identifies a zip archive member
+    :rtype: bool
+    """
+    return zip_member_sep in source
+
+
+def read_zip_member_csv(source, **kwargs):
+    """Reads a csv member of a zip archive without extracting it to disk
+
+    :param source: zip member as returned by get_zip_members
+    :type source: str
+    :param kwargs: arguments of pd.read_csv
+    :return: member data
+    :rtype: pd.DataFrame
+    """
+    zip_path, member = source.split(zip_member_sep, 1)
+    with zipfile.ZipFile(zip_path) as zf, zf.open(member) as f:
+        return pd.read_csv(f, **kwargs)
+
+
+def get_zip_member_signature(source):
+    """Returns the signature used to detect whether a zip member changed: size and CRC stored in the archive
+
+    :param source: zip member as returned by get_zip_members
+    :type source: str
+    :return: signature
+    :rtype: dict
+    """
+    zip_path, member = source.split(zip_member_sep, 1)
+    with zipfile.ZipFile(zip_path) as zf:
+        info = zf.getinfo(member)
+    return {"size": info.file_size, "crc": info.CRC}
+
+
+def unzip_all(zip_dir, data_dir):
+    """Extracts the csv members of all the zip archives of zip_dir in the yearly directories of data_dir
+
+    :param zip_dir: directory containing the zip archives
+    :type zip_dir: str
+    :param data_dir: data directory
+    :type data_dir: str
+    """
     dir_content = os.listdir(zip_dir)
     for content in tqdm(dir_content):
         file_path = os.path.join(zip_dir, content)
@@ -27,4 +97,9 @@ if __name__ == "__main__":
             with zipfile.ZipFile(file_path) as zf:
                 for member in zf.infolist():
                     if "csv" in member.filename:
-                        zf.extract(member=member, path=os.path.join(madrid_data_dir, year_str))
+                        zf.extract(member=member, path=os.path.join(data_dir, year_str))
+
+
+if __name__ == "__main__":
+    # Only needed to inspect the csv files: madrid_extract reads them directly from the zip archives
+    unzip_all(zip_dir=zip_dir, data_dir=madrid_data_dir)
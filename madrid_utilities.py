@@ -7,14 +7,21 @@
 # Traffic data
 # https://datos.madrid.es/sites/v/index.jsp?vgnextoid=33cb30c367e78410VgnVCM1000000b205a0aRCRD&vgnextchannel=374512b9ace9f310VgnVCM100000171f5a0aRCRD
 import os
+import numpy as np
+import pandas as pd
 
 madrid_data_dir = "data/Madrid"
 madrid_analysis_dir = "analysis/Madrid"
-madrid_corr_dir = os.path.join(madrid_analysis_dir, "corr")
-madrid_stat_dir = os.path.join(madrid_analysis_dir, "stat")
+corr_subdir = "corr"
+stat_subdir = "stat"
+madrid_corr_dir = os.path.join(madrid_analysis_dir, corr_subdir)
+madrid_stat_dir = os.path.join(madrid_analysis_dir, stat_subdir)
 madrid_proc_dir = "data/Madrid_Processed"
 zip_dir = "data/Madrid/Zip_folders"
 madrid_all_file = os.path.join(madrid_proc_dir, "madrid_all_df.pkl")
+madrid_dataset_dir = os.path.join(madrid_proc_dir, "madrid_all_dataset")
+madrid_cache_dir = os.path.join(madrid_proc_dir, "pipeline_cache")
+madrid_cube_dir = os.path.join(madrid_proc_dir, "madrid_cube")
 pollutant_dict_madrid = {
     1: "SO2",
     6: "CO",
@@ -74,6 +81,43 @@ def convert_station_number(number):
         number = station_code_dict[number]
     return number
 
+
+# Vectorized versions of the dictionaries: lookup tables indexed by code
+station_lookup_table = np.arange(max(station_code_dict.keys()) + 1)
+station_lookup_table[list(station_code_dict.keys())] = list(station_code_dict.values())
+pollutant_names = list(pollutant_dict_madrid.values())
+pollutant_lookup_table = np.full(max(pollutant_dict_madrid.keys()) + 1, -1)
+pollutant_lookup_table[list(pollutant_dict_madrid.keys())] = np.arange(len(pollutant_names))
+
+
+def convert_station_numbers(numbers):
+    """Vectorized convert_station_number
+
+    :param numbers: station numbers
+    :type numbers: np.ndarray
+    :return: new numbers
+    :rtype: np.ndarray
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    in_table = (numbers >= 0) & (numbers < len(station_lookup_table))
+    return np.where(in_table, station_lookup_table[np.where(in_table, numbers, 0)], numbers)
+
+
+def convert_pollutant_codes(codes):
+    """Vectorized lookup of pollutant_dict_madrid
+
+    :param codes: pollutant codes
+    :type codes: np.ndarray
+    :return: pollutant names as categorical with pollutant_names categories
+    :rtype: pd.Categorical
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    in_table = (codes >= 0) & (codes < len(pollutant_lookup_table))
+    category_codes = np.where(in_table, pollutant_lookup_table[np.where(in_table, codes, 0)], -1)
+    if (category_codes == -1).any():
+        raise KeyError(f"unknown pollutant codes {np.unique(codes[category_codes == -1]).tolist()}")
+    return pd.Categorical.from_codes(category_codes, categories=pollutant_names)
+
 # Column variables
 
 
@@ -0,0 +1,14 @@
+from cube_utilities import TimeSeriesCube
+from window_utilities import WindowGenerator
+from madrid_utilities import madrid_cube_dir
+
+
+if __name__ == "__main__":
+    cube = TimeSeriesCube(madrid_cube_dir)
+    # One week of all the pollutants of a station to predict the next day, at most 10% of missing values
+    generator = WindowGenerator(cube.values[cube.station_pos(cube.stations[0])], input_length=168, horizon=24,
+                                stride=24, max_input_nan=0.1, max_target_nan=0.1, time_axis=1,
+                                datetimes=cube.datetimes())
+    print(f"{len(generator)} windows of station {cube.stations[0]}")
+    for inputs, targets in generator.batches(batch_size=32, shuffle=True, seed=0):
+        print(inputs.shape, targets.shape)
@@ -0,0 +1,252 @@
+import os
+import re
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+import pandas as pd
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the maximum RSS is not recorded
+    resource = None
+
+metrics_cols = ["stage", "partition", "wall_s", "cpu_s", "max_rss_mb", "peak_traced_mb", "rows_in", "rows_out",
+                "bytes_read", "bytes_written"]
+
+
+def get_max_rss_mb():
+    """Returns the maximum resident set size reached by the current process since it started, not only during a
+    stage: a stage that needs less memory than a previous one reports the maximum of the previous one
+
+    :return: maximum RSS in MB, None if it is not available
+    :rtype: float
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3
+
+
+def partition_to_str(partition):
+    """Returns the string identifying a partition in the metrics and in the profile file names
+
+    :param partition: {key: value}, e.g. {"year": 2019, "station": 4}
+    :type partition: dict
+    :return: "key=value" pairs joined by "/", "" for no partition
+    :rtype: str
+    """
+    return "/".join(f"{key}={value}" for key, value in partition.items())
+
+
+class NullStage:
+    """Stage doing nothing, returned by disabled recorders so that instrumented code keeps a single code path"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, rows_in=0, rows_out=0, bytes_read=0, bytes_written=0):
+        pass
+
+    def set_partition(self, **partition):
+        pass
+
+
+null_stage = NullStage()
+
+
+class Stage:
+    """Measures one stage of a MetricsRecorder, use it as a context manager. Rows and bytes are counted with add.
+
+    :param recorder: recorder collecting the record of the stage
+    :type recorder: MetricsRecorder
+    :param name: stage name
+    :type name: str
+    :param partition: {key: value} of the partition processed by the stage
+    :type partition: dict
+    """
+
+    def __init__(self, recorder, name, partition):
+        self.recorder = recorder
+        self.record = {"stage": name, "partition": partition_to_str(partition), "rows_in": 0, "rows_out": 0,
+                       "bytes_read": 0, "bytes_written": 0}
+        self.profiler = None
+        self.traced_start = 0
+        self.traced_peak = 0
+
+    def __enter__(self):
+        if self.record["stage"] in self.recorder.profile_stages:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.recorder.trace_memory:
+            self.recorder.start_tracing(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record["wall_s"] = time.perf_counter() - self._wall
+        self.record["cpu_s"] = time.process_time() - self._cpu
+        self.record["max_rss_mb"] = get_max_rss_mb()
+        self.record["peak_traced_mb"] = self.recorder.stop_tracing(self) if self.recorder.trace_memory else None
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.recorder.dump_profile(self.profiler, self.record)
+        self.recorder.records.append(self.record)
+        return False
+
+    def add(self, rows_in=0, rows_out=0, bytes_read=0, bytes_written=0):
+        """Adds processed rows and bytes to the stage
+
+        :param rows_in: input rows
+        :type rows_in: int
+        :param rows_out: output rows
+        :type rows_out: int
+        :param bytes_read: bytes read from disk or network
+        :type bytes_read: int
+        :param bytes_written: bytes written to disk
+        :type bytes_written: int
+        """
+        self.record["rows_in"] += rows_in
+        self.record["rows_out"] += rows_out
+        self.record["bytes_read"] += bytes_read
+        self.record["bytes_written"] += bytes_written
+
+    def set_partition(self, **partition):
+        """Sets the partition of the stage, for partitions only known once their data is read
+
+        :param partition: keys of the partition, e.g. year=2019
+        """
+        self.record["partition"] = partition_to_str(partition)
+
+
+class MetricsRecorder:
+    """Collects wall time, CPU time, maximum RSS of the process, peak memory of the stage, rows and bytes of the
+    stages of a run. A disabled recorder returns null_stage from stage, so the instrumented functions cost one method
+    call per stage.
+
+    :param enabled: whether to record
+    :type enabled: bool
+    :param profile_stages: names of the stages to be profiled with cProfile, one .prof file per stage and partition
+    :type profile_stages: iterable
+    :param profile_dir: output directory of the .prof files
+    :type profile_dir: str
+    :param trace_memory: whether to record the peak memory allocated during every stage with tracemalloc, which
+        tracks the numpy and pandas arrays but not the buffers of pyarrow, and slows down the allocations
+    :type trace_memory: bool
+    """
+
+    def __init__(self, enabled=True, profile_stages=(), profile_dir="profiles", trace_memory=False):
+        self.enabled = enabled
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.records = []
+        self._traced_stages = []
+        self._started_tracing = False
+
+    def spawn(self):
+        """Returns an empty recorder with the same settings, e.g. to be sent to a worker process whose records are
+        then added to this recorder with extend
+
+        :return: recorder
+        :rtype: MetricsRecorder
+        """
+        return MetricsRecorder(enabled=self.enabled, profile_stages=self.profile_stages, profile_dir=self.profile_dir,
+                               trace_memory=self.trace_memory)
+
+    def extend(self, records):
+        """Adds the records of another recorder, e.g. of a worker process
+
+        :param records: records
+        :type records: list
+        """
+        self.records.extend(records)
+
+    def _update_traced_peaks(self):
+        """Updates the peaks of the running stages and resets the peak of tracemalloc for the next stage"""
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._traced_stages:
+            stage.traced_peak = max(stage.traced_peak, peak)
+        tracemalloc.reset_peak()
+
+    def start_tracing(self, stage):
+        """Starts tracing the memory of a stage, nested stages keep the peaks of the stages containing them
+
+        :param stage: stage
+        :type stage: Stage
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._update_traced_peaks()
+        stage.traced_start = stage.traced_peak = tracemalloc.get_traced_memory()[0]
+        self._traced_stages.append(stage)
+
+    def stop_tracing(self, stage):
+        """Stops tracing the memory of a stage
+
+        :param stage: stage
+        :type stage: Stage
+        :return: peak memory allocated during the stage in MB
+        :rtype: float
+        """
+        self._update_traced_peaks()
+        self._traced_stages.remove(stage)
+        if len(self._traced_stages) == 0 and self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return (stage.traced_peak - stage.traced_start) / 1e6
+
+    def stage(self, name, **partition):
+        """Returns the context manager measuring a stage
+
+        :param name: stage name
+        :type name: str
+        :param partition: keys of the partition processed by the stage, e.g. year=2019
+        :return: stage
+        :rtype: Stage or NullStage
+        """
+        if not self.enabled:
+            return null_stage
+        return Stage(self, name, partition)
+
+    def dump_profile(self, profiler, record):
+        """Saves the profile of a stage, it can be read with pstats
+
+        :param profiler: profiler of the stage
+        :type profiler: cProfile.Profile
+        :param record: record of the stage
+        :type record: dict
+        """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = re.sub(r"\W+", "_", f"{record['stage']}_{record['partition']}").strip("_")
+        profiler.dump_stats(os.path.join(self.profile_dir, name + ".prof"))
+
+    def to_frame(self):
+        """Returns the records as a DataFrame
+
+        :return: one row per stage and partition
+        :rtype: pd.DataFrame
+        """
+        return pd.DataFrame(self.records, columns=metrics_cols)
+
+    def save(self, path):
+        """Saves the records as json or csv, depending on the extension of path
+
+        :param path: .json or .csv file
+        :type path: str
+        """
+        if path.endswith(".csv"):
+            self.to_frame().to_csv(path, index=False)
+        else:
+            with open(path, "w") as f:
+                json.dump(self.records, f, indent=1)
+
+
+null_metrics = MetricsRecorder(enabled=False)
@@ -0,0 +1,363 @@
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from madrid_utilities import pollutant_dict_madrid, station_col, pollutant_col, concentration_col, datetime_col, \
+    madrid_corr_dir, madrid_stat_dir
+from madrid_unzip import unzip_all
+from madrid_extract import open_clean_df, convert_from_year_df, fast_convert_from_year_df, open_year_dir, \
+    extract_all_ts
+from madrid_analysis import smart_pivot, fast_pivot, get_stat, save_corr_mat
+from corr_study import avg_corr
+from discomapEEA_utilities import filter_eea_df, eea_kept_cols, validity_col, verification_col
+
+# name: (n_years, n_stations, n_pollutants)
+benchmark_scales = {
+    "small": (1, 4, 4),
+    "medium": (2, 12, 8),
+    "large": (3, 24, 8),
+}
+
+
+def make_long_df(n_stations, n_years, missing_rate=0.1, first_year=2010, seed=0):
+    """Creates a synthetic long table with the same layout as the result of madrid_extract.extract_all_ts
+
+    :param n_stations: number of stations
+    :type n_stations: int
+    :param n_years: number of years of hourly data
+    :type n_years: int
+    :param missing_rate: fraction of invalid (np.nan) concentrations
+    :type missing_rate: float
+    :param first_year: first year of data
+    :type first_year: int
+    :param seed: random seed
+    :type seed: int
+    :return: long table
+    :rtype: pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    datetimes = pd.date_range(f"{first_year}-01-01", f"{first_year + n_years}-01-01", freq="h", inclusive="left")
+    stations = np.arange(1, n_stations + 1)
+    pollutants = list(pollutant_dict_madrid.values())
+    n_series = len(stations) * len(pollutants)
+    concentration = rng.gamma(2., 10., size=n_series * len(datetimes))
+    concentration[rng.random(concentration.shape) < missing_rate] = np.nan
+    return pd.DataFrame({station_col: np.repeat(stations, len(pollutants) * len(datetimes)),
+                         pollutant_col: np.tile(np.repeat(pollutants, len(datetimes)), len(stations)),
+                         concentration_col: concentration,
+                         datetime_col: np.tile(datetimes, n_series)})
+
+
+def time_call(func, **kwargs):
+    """Calls func and measures its wall time
+
+    :param func: function to be timed
+    :type func: callable
+    :return: (result, seconds)
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    res = func(**kwargs)
+    return res, time.perf_counter() - start
+
+
+def measure(func, measure_memory=True, **kwargs):
+    """Calls func measuring its wall time and, in a second traced call, its peak memory allocation
+
+    :param func: function to be measured
+    :type func: callable
+    :param measure_memory: whether to run the traced call, tracing slows the call down so it is not timed
+    :type measure_memory: bool
+    :return: (result, seconds, peak MB or np.nan)
+    :rtype: tuple
+    """
+    res, seconds = time_call(func, **kwargs)
+    peak_mb = np.nan
+    if measure_memory:
+        tracemalloc.start()
+        func(**kwargs)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return res, seconds, peak_mb
+
+
+def benchmark_pivot(n_stations=24, n_years=1):
+    """Compares smart_pivot and fast_pivot in both discriminant directions of madrid_analysis.full_analysis
+
+    :param n_stations: number of stations
+    :type n_stations: int
+    :param n_years: number of years of hourly data
+    :type n_years: int
+    :return: list of timing records
+    :rtype: list
+    """
+    df = make_long_df(n_stations=n_stations, n_years=n_years)
+    records = []
+    for discriminant_column, pivot_column in [(station_col, pollutant_col), (pollutant_col, station_col)]:
+        kwargs = {"df": df, "discriminant_column": discriminant_column, "pivot_column": pivot_column,
+                  "value_column": concentration_col}
+        smart_res, smart_time = time_call(smart_pivot, **kwargs)
+        fast_res, fast_time = time_call(fast_pivot, **kwargs)
+        for disc in smart_res.keys():
+            pd.testing.assert_frame_equal(smart_res[disc], fast_res[disc])
+        records.append({"discriminant": discriminant_column, "rows": len(df), "smart_pivot_s": smart_time,
+                        "fast_pivot_s": fast_time, "speedup": smart_time / fast_time})
+    return records
+
+
+def write_madrid_csvs(data_dir, n_years, n_stations, n_pollutants, missing_rate=0.1, first_year=2010, seed=0,
+                      zip_dir=None):
+    """Writes synthetic Madrid files: one directory per year with one ";" separated csv per month, with
+    H01..H24/V01..V24 columns. One not relevant pollutant is added to exercise the filtering of open_clean_df.
+
+    :param data_dir: data directory
+    :type data_dir: str
+    :param n_years: number of years
+    :type n_years: int
+    :param n_stations: number of stations
+    :type n_stations: int
+    :param n_pollutants: number of relevant pollutants, at most len(pollutant_dict_madrid)
+    :type n_pollutants: int
+    :param missing_rate: fraction of values flagged as not valid
+    :type missing_rate: float
+    :param first_year: first year
+    :type first_year: int
+    :param seed: random seed
+    :type seed: int
+    :param zip_dir: if not None the files of every year are also zipped as zip_dir/Anio<year>.zip
+    :type zip_dir: str
+    :return: list of written files
+    :rtype: list
+    """
+    rng = np.random.default_rng(seed)
+    stations = np.arange(1, n_stations + 1)
+    pollutants = list(pollutant_dict_madrid.keys())[:n_pollutants] + [20]
+    written = []
+    for year in range(first_year, first_year + n_years):
+        year_dir = os.path.join(data_dir, str(year))
+        os.makedirs(year_dir, exist_ok=True)
+        year_files = []
+        for month in range(1, 13):
+            days = pd.date_range(f"{year}-{month:02d}-01", periods=pd.Period(f"{year}-{month:02d}").days_in_month)
+            n_rows = len(stations) * len(pollutants) * len(days)
+            data = {"PROVINCIA": 28, "MUNICIPIO": 79,
+                    "ESTACION": np.repeat(stations, len(pollutants) * len(days)),
+                    "MAGNITUD": np.tile(np.repeat(pollutants, len(days)), len(stations))}
+            data["PUNTO_MUESTREO"] = [f"28079{station:03d}_{pollutant}_38"
+                                      for station, pollutant in zip(data["ESTACION"], data["MAGNITUD"])]
+            data["ANO"] = year
+            data["MES"] = month
+            data["DIA"] = np.tile(days.day, len(stations) * len(pollutants))
+            values = rng.gamma(2., 10., size=(n_rows, 24)).round(2)
+            valid = rng.random((n_rows, 24)) >= missing_rate
+            for h in range(24):
+                data[f"H{h + 1:02d}"] = values[:, h]
+                data[f"V{h + 1:02d}"] = np.where(valid[:, h], "V", "N")
+            path = os.path.join(year_dir, f"{month:02d}_{year}.csv")
+            pd.DataFrame(data).to_csv(path, sep=";", index=False)
+            year_files.append(path)
+        if zip_dir is not None:
+            os.makedirs(zip_dir, exist_ok=True)
+            with zipfile.ZipFile(os.path.join(zip_dir, f"Anio{year}.zip"), "w", zipfile.ZIP_DEFLATED) as zf:
+                for path in year_files:
+                    zf.write(path, arcname=os.path.basename(path))
+        written += year_files
+    return written
+
+
+def write_eea_csvs(data_dir, n_stations, n_hours, missing_rate=0.1, first_date="2013-01-01", seed=0):
+    """Writes synthetic EEA station time series files with the columns of the EEA download service
+
+    :param data_dir: data directory
+    :type data_dir: str
+    :param n_stations: number of station files
+    :type n_stations: int
+    :param n_hours: number of hourly rows of every file
+    :type n_hours: int
+    :param missing_rate: fraction of rows not valid or not verified
+    :type missing_rate: float
+    :param first_date: first datetime
+    :type first_date: str
+    :param seed: random seed
+    :type seed: int
+    :return: list of written files
+    :rtype: list
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    begin = pd.date_range(first_date, periods=n_hours, freq="h")
+    written = []
+    for i in range(n_stations):
+        invalid = rng.random(n_hours) < missing_rate
+        data = pd.DataFrame({"Countrycode": "BE", "Namespace": "BE.CELINE-IRCEL.AQD", "AirQualityNetwork": "NET-BE001A",
+                             "AirQualityStation": f"STA-BE{i:03d}A", "AirQualityStationEoICode": f"BE{i:04d}A",
+                             "SamplingPoint": f"SPO-BE{i:03d}A_00008_100", "SamplingProcess": "SPP-BE_A_chemi",
+                             "Sample": f"SAM-BE{i:03d}A_8", "AirPollutant": "NO2",
+                             "AirPollutantCode": "http://dd.eionet.europa.eu/vocabulary/aq/pollutant/8",
+                             "AveragingTime": "hour", "Concentration": rng.gamma(2., 10., n_hours).round(3),
+                             "UnitOfMeasurement": "µg/m3",
+                             "DatetimeBegin": begin.strftime("%Y-%m-%d %H:%M:%S +01:00"),
+                             "DatetimeEnd": (begin + pd.Timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S +01:00"),
+                             "Validity": np.where(invalid, -1, 1), "Verification": 1})
+        path = os.path.join(data_dir, f"BE_8_{i}_timeseries.csv")
+        data.to_csv(path, index=False)
+        written.append(path)
+    return written
+
+
+def _run_disc_stage(disc_func, disc_df, **kwargs):
+    """Calls disc_func on every pivoted dataframe
+
+    :param disc_func: get_stat or save_corr_mat
+    :type disc_func: callable
+    :param disc_df: {discriminant: pd.DataFrame}
+    :type disc_df: dict
+    :return: list of results
+    :rtype: list
+    """
+    return [disc_func(df=df, **kwargs) for df in disc_df.values()]
+
+
+def _parse_eea_files(files):
+    """Reads and filters EEA station files as eea_smart_download does
+
+    :param files: station files
+    :type files: list
+    :return: total number of rows
+    :rtype: int
+    """
+    return sum(len(filter_eea_df(pd.read_csv(file, usecols=eea_kept_cols + [validity_col, verification_col])))
+               for file in files)
+
+
+def benchmark_scale(scale, work_dir, measure_memory=True):
+    """Generates the synthetic data of a scale and measures every stage of the Madrid/EEA pipeline on it.
+    Relative output paths of the analysis functions are created inside work_dir.
+
+    :param scale: key of benchmark_scales
+    :type scale: str
+    :param work_dir: working directory, it must be empty
+    :type work_dir: str
+    :param measure_memory: whether to measure the peak memory of every stage
+    :type measure_memory: bool
+    :return: list of records {"scale", "stage", "seconds", "peak_mb", "rows"}
+    :rtype: list
+    """
+    n_years, n_stations, n_pollutants = benchmark_scales[scale]
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        os.makedirs(madrid_corr_dir, exist_ok=True)
+        os.makedirs(madrid_stat_dir, exist_ok=True)
+        files = write_madrid_csvs("madrid_csv", n_years=n_years, n_stations=n_stations, n_pollutants=n_pollutants,
+                                  zip_dir="madrid_zip")
+        eea_files = write_eea_csvs("eea_csv", n_stations=n_stations, n_hours=n_years * 8760)
+        year_dir = os.path.dirname(files[0])
+        year_df = open_year_dir(dir_path=year_dir)
+        records = []
+
+        def add(stage, stage_func, rows=None, **kwargs):
+            res, seconds, peak_mb = measure(stage_func, measure_memory=measure_memory, **kwargs)
+            records.append({"scale": scale, "stage": stage, "seconds": seconds, "peak_mb": peak_mb,
+                            "rows": rows(res) if rows is not None else None})
+            return res
+
+        add("unzip", unzip_all, zip_dir="madrid_zip", data_dir="madrid_unzipped")
+        add("open_clean_df", open_clean_df, rows=len, filename=files[0])
+        add("convert_from_year_df", convert_from_year_df, rows=len, data=year_df)
+        add("fast_convert_from_year_df", fast_convert_from_year_df, rows=len, data=year_df)
+        all_df = add("extract_all_ts", extract_all_ts, rows=len, data_dir="madrid_csv")
+        add("extract_all_ts_zip", extract_all_ts, rows=len, data_dir="madrid_zip", from_zip=True)
+        pivot_kwargs = {"df": all_df, "discriminant_column": station_col, "pivot_column": pollutant_col,
+                        "value_column": concentration_col}
+        add("smart_pivot", smart_pivot, rows=len, **pivot_kwargs)
+        disc_df = add("fast_pivot", fast_pivot, rows=len, **pivot_kwargs)
+        add("get_stat", _run_disc_stage, rows=len, disc_func=get_stat, disc_df=disc_df, discriminant_column=station_col)
+        add("save_corr_mat", _run_disc_stage, rows=len, disc_func=save_corr_mat, disc_df=disc_df,
+            discriminant_column=station_col, group_name=pollutant_col)
+        add("avg_corr", avg_corr, rows=len, discriminant_column=station_col, corr_dir=madrid_corr_dir)
+        add("eea_parse", _parse_eea_files, rows=lambda res: res, files=eea_files)
+        return records
+    finally:
+        os.chdir(cwd)
+
+
+def run_benchmarks(output_file, scales=("small", "medium"), measure_memory=True):
+    """Runs the benchmark of every scale in a temporary directory and saves the results as json
+
+    :param output_file: json output file
+    :type output_file: str
+    :param scales: keys of benchmark_scales
+    :type scales: iterable
+    :param measure_memory: whether to measure the peak memory of every stage
+    :type measure_memory: bool
+    :return: results
+    :rtype: dict
+    """
+    records = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work_dir:
+            records += benchmark_scale(scale, work_dir=work_dir, measure_memory=measure_memory)
+    results = {"meta": {"date": datetime.now().isoformat(timespec="seconds"),
+                        "python": sys.version.split()[0],
+                        "pandas": pd.__version__,
+                        "numpy": np.__version__,
+                        "platform": platform.platform(),
+                        "scales": {scale: benchmark_scales[scale] for scale in scales}},
+               "records": records}
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+def compare_benchmarks(reference_file, new_file, tolerance=0.2):
+    """Compares two result files of run_benchmarks
+
+    :param reference_file: reference json file
+    :type reference_file: str
+    :param new_file: new json file
+    :type new_file: str
+    :param tolerance: relative slowdown or memory growth above which a stage is flagged as regression
+    :type tolerance: float
+    :return: DataFrame indexed by (scale, stage) with reference and new values, ratios and regression flag
+    :rtype: pd.DataFrame
+    """
+    frames = []
+    for file in [reference_file, new_file]:
+        with open(file, "r") as f:
+            frames.append(pd.DataFrame(json.load(f)["records"]).set_index(["scale", "stage"])[["seconds", "peak_mb"]])
+    comparison = frames[0].join(frames[1], lsuffix="_ref", rsuffix="_new", how="inner")
+    comparison["time_ratio"] = comparison["seconds_new"] / comparison["seconds_ref"]
+    comparison["memory_ratio"] = comparison["peak_mb_new"] / comparison["peak_mb_ref"]
+    comparison["regression"] = (comparison["time_ratio"] > 1 + tolerance) | \
+                               (comparison["memory_ratio"] > 1 + tolerance)
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Madrid/EEA pipeline benchmarks")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file of the results")
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(benchmark_scales.keys()))
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced runs measuring peak memory")
+    parser.add_argument("--compare", default=None, help="reference json file to compare the results with")
+    parser.add_argument("--pivot", action="store_true", help="only compare smart_pivot and fast_pivot")
+    args = parser.parse_args()
+    if args.pivot:
+        # Madrid network: 24 stations, 8 relevant pollutants
+        print(pd.DataFrame(benchmark_pivot(n_stations=24, n_years=2)))
+    else:
+        run_benchmarks(args.output, scales=args.scales, measure_memory=not args.no_memory)
+        if args.compare is not None:
+            print(compare_benchmarks(args.compare, args.output))
+        else:
+            with open(args.output, "r") as f:
+                print(pd.DataFrame(json.load(f)["records"]))
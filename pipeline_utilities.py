@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import pandas as pd
+
+from store_utilities import get_file_signature
+
+index_file_name = "index.json"
+
+
+def get_func_signature(func):
+    """Returns the string identifying the code of a stage function or of one of its dependencies, so that editing
+    it invalidates the cached outputs of the stage
+
+    :param func: function, class or module
+    :type func: callable or module
+    :return: module, name and source code of func
+    :rtype: str
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ""
+    if inspect.ismodule(func):
+        return f"{func.__name__}\n{source}"
+    return f"{func.__module__}.{func.__qualname__}\n{source}"
+
+
+def get_path_signature(path, use_hash=False):
+    """Returns the signature of a file or of all the files inside a directory
+
+    :param path: file or directory path
+    :type path: str
+    :param use_hash: whether to hash the content of the files instead of using their modification time
+    :type use_hash: bool
+    :return: {relative path: signature}, empty if path does not exist
+    :rtype: dict
+    """
+    if os.path.isfile(path):
+        return {"": get_file_signature(path, use_hash=use_hash)}
+    signature = {}
+    for root, _, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            signature[os.path.relpath(file_path, path)] = get_file_signature(file_path, use_hash=use_hash)
+    return dict(sorted(signature.items()))
+
+
+class Pipeline:
+    """Runs a DAG of stages caching their outputs by content. The key of a stage is the hash of its function code,
+    of its parameters and of the outputs of its input stages, so a stage runs again only when one of them changes.
+    If a stage runs again and produces the same output, the stages depending on it stay cached. Cached outputs are
+    loaded only when a stage that has to run needs them. Nothing is evicted automatically, see evict and clear.
+    Only the source of the stage function itself is hashed, not the code it calls: the functions and modules a stage
+    relies on must be listed in its deps, or its version bumped, otherwise editing them leaves stale outputs cached.
+
+    :param cache_dir: cache directory, one pickle per stage output and an index file
+    :type cache_dir: str
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, index_file_name)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    def add_stage(self, name, func, inputs=None, params=None, watch=(), check=None, deps=(), version=None):
+        """Adds a stage, its function is called as func(**inputs, **params) with the outputs of the input stages
+
+        :param name: stage name
+        :type name: str
+        :param func: stage function, its output must be picklable
+        :type func: callable
+        :param inputs: {argument name: input stage name}
+        :type inputs: dict
+        :param params: {argument name: value}, values must have a stable repr
+        :type params: dict
+        :param watch: names of the params that are paths read by the stage, the signatures of their files are part
+            of the key
+        :type watch: iterable
+        :param check: function of the cached output returning whether it is still valid, e.g. whether the files
+            written by the stage still exist. None means always valid.
+        :type check: callable
+        :param deps: functions, classes or modules called by func, their source code is part of the key
+        :type deps: iterable
+        :param version: value with a stable repr that is part of the key, bump it to invalidate the cached outputs
+            when code that is not in deps changes
+        """
+        if name in self.stages:
+            raise ValueError(f"stage {name} already exists")
+        inputs = {} if inputs is None else dict(inputs)
+        for input_name in inputs.values():
+            if input_name not in self.stages:
+                raise ValueError(f"input stage {input_name} of {name} must be added before it")
+        self.stages[name] = {"func": func, "inputs": inputs, "params": {} if params is None else dict(params),
+                             "watch": list(watch), "check": check, "deps": list(deps), "version": version}
+
+    def get_ancestors(self, targets):
+        """Returns the stages needed to compute targets in topological order
+
+        :param targets: stage names
+        :type targets: iterable
+        :return: stage names
+        :rtype: list
+        """
+        needed = set()
+        to_visit = list(targets)
+        while len(to_visit) > 0:
+            name = to_visit.pop()
+            if name not in needed:
+                needed.add(name)
+                to_visit.extend(self.stages[name]["inputs"].values())
+        # Stages can only depend on stages added before them, so insertion order is topological
+        return [name for name in self.stages if name in needed]
+
+    def get_key(self, name, input_hashes):
+        """Returns the key of a stage output
+
+        :param name: stage name
+        :type name: str
+        :param input_hashes: {argument name: output hash of the input stage}
+        :type input_hashes: dict
+        :return: sha1 hex digest
+        :rtype: str
+        """
+        stage = self.stages[name]
+        sha1 = hashlib.sha1()
+        sha1.update(get_func_signature(stage["func"]).encode())
+        for dep in stage["deps"]:
+            sha1.update(get_func_signature(dep).encode())
+        sha1.update(repr(stage["version"]).encode())
+        sha1.update(repr(sorted(stage["params"].items())).encode())
+        sha1.update(repr(sorted(input_hashes.items())).encode())
+        for param in stage["watch"]:
+            sha1.update(json.dumps(get_path_signature(stage["params"][param]), sort_keys=True).encode())
+        return sha1.hexdigest()
+
+    def get_output_path(self, name, key):
+        """Returns the cache file of a stage output
+
+        :param name: stage name
+        :type name: str
+        :param key: stage key
+        :type key: str
+        :return: file path
+        :rtype: str
+        """
+        return os.path.join(self.cache_dir, name, f"{key}.pkl")
+
+    def _load(self, name, key):
+        with open(self.get_output_path(name, key), "rb") as f:
+            return pickle.load(f)
+
+    def _store(self, name, key, output):
+        """Saves a stage output and returns its content hash
+
+        :return: sha1 hex digest of the pickled output
+        :rtype: str
+        """
+        content = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+        path = self.get_output_path(name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        output_hash = hashlib.sha1(content).hexdigest()
+        self.index.setdefault(name, {})[key] = {"output_hash": output_hash, "bytes": len(content),
+                                                "created": time.time(), "last_used": time.time()}
+        return output_hash
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def _is_cached(self, name, key, outputs):
+        """Returns whether the output of a stage is cached and still valid, loading it if the stage has a check
+
+        :param outputs: {stage name: output} of the outputs already in memory, updated with the loaded output
+        :type outputs: dict
+        :return: whether the output is cached
+        :rtype: bool
+        """
+        if key not in self.index.get(name, {}) or not os.path.exists(self.get_output_path(name, key)):
+            return False
+        check = self.stages[name]["check"]
+        if check is None:
+            return True
+        outputs[name] = self._load(name, key)
+        return check(outputs[name])
+
+    def run(self, targets=None, force=()):
+        """Runs the stages needed to compute targets, skipping the ones whose output is cached
+
+        :param targets: stage names, None means all the stages
+        :type targets: iterable
+        :param force: stage names to run even if cached
+        :type force: iterable
+        :return: ({target: output}, report DataFrame with stage, status ("ran" or "cached"), seconds and key)
+        :rtype: tuple
+        """
+        targets = list(self.stages) if targets is None else list(targets)
+        outputs = {}
+        keys = {}
+        output_hashes = {}
+        report = []
+        for name in self.get_ancestors(targets):
+            stage = self.stages[name]
+            key = self.get_key(name, {arg: output_hashes[input_name] for arg, input_name in stage["inputs"].items()})
+            keys[name] = key
+            start = time.perf_counter()
+            if name not in force and self._is_cached(name, key, outputs):
+                status = "cached"
+            else:
+                kwargs = {arg: self._get_output(input_name, keys[input_name], outputs)
+                          for arg, input_name in stage["inputs"].items()}
+                outputs[name] = stage["func"](**kwargs, **stage["params"])
+                self._store(name, key, outputs[name])
+                status = "ran"
+            self.index[name][key]["last_used"] = time.time()
+            output_hashes[name] = self.index[name][key]["output_hash"]
+            report.append({"stage": name, "status": status, "seconds": time.perf_counter() - start, "key": key[:12]})
+        self._save_index()
+        return {name: self._get_output(name, keys[name], outputs) for name in targets}, pd.DataFrame(report)
+
+    def _get_output(self, name, key, outputs):
+        if name not in outputs:
+            outputs[name] = self._load(name, key)
+        return outputs[name]
+
+    def cache_report(self):
+        """Returns the cached outputs
+
+        :return: DataFrame with stage, key, bytes, created and last_used columns
+        :rtype: pd.DataFrame
+        """
+        rows = [{"stage": name, "key": key, "bytes": entry["bytes"],
+                 "created": pd.Timestamp(entry["created"], unit="s"),
+                 "last_used": pd.Timestamp(entry["last_used"], unit="s")}
+                for name, entries in self.index.items() for key, entry in entries.items()]
+        return pd.DataFrame(rows, columns=["stage", "key", "bytes", "created", "last_used"])
+
+    def _remove(self, name, key):
+        path = self.get_output_path(name, key)
+        if os.path.exists(path):
+            os.remove(path)
+        del self.index[name][key]
+
+    def evict(self, keep_per_stage=None, max_bytes=None, stages=None):
+        """Removes the least recently used outputs
+
+        :param keep_per_stage: number of outputs kept for every stage, None keeps all of them
+        :type keep_per_stage: int
+        :param max_bytes: maximum total size of the kept outputs, None means no limit
+        :type max_bytes: int
+        :param stages: stages to evict from, None means all of them
+        :type stages: iterable
+        :return: number of removed outputs
+        :rtype: int
+        """
+        stages = list(self.index) if stages is None else [name for name in stages if name in self.index]
+        removed = 0
+        if keep_per_stage is not None:
+            for name in stages:
+                by_use = sorted(self.index[name], key=lambda key: self.index[name][key]["last_used"], reverse=True)
+                for key in by_use[keep_per_stage:]:
+                    self._remove(name, key)
+                    removed += 1
+        if max_bytes is not None:
+            entries = sorted(((entry["last_used"], name, key, entry["bytes"]) for name in stages
+                              for key, entry in self.index[name].items()), reverse=True)
+            total = 0
+            for _, name, key, n_bytes in entries:
+                total += n_bytes
+                if total > max_bytes:
+                    self._remove(name, key)
+                    removed += 1
+        self._save_index()
+        return removed
+
+    def clear(self, stages=None):
+        """Removes all the outputs of some stages
+
+        :param stages: stage names, None means all of them
+        :type stages: iterable
+        :return: number of removed outputs
+        :rtype: int
+        """
+        stages = list(self.index) if stages is None else [name for name in stages if name in self.index]
+        removed = 0
+        for name in stages:
+            for key in list(self.index[name]):
+                self._remove(name, key)
+                removed += 1
+        self._save_index()
+        return removed
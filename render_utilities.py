@@ -0,0 +1,128 @@
+import os
+import hashlib
+import matplotlib
+# Headless backend: figures are only saved to file, also from worker processes
+matplotlib.use("Agg")
+import seaborn as sns
+import matplotlib.pyplot as plt
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+hash_suffix = ".sha1"
+
+
+def make_heatmap_job(corr, title, xlabel, ylabel, png_path):
+    """Creates the description of a heatmap to be rendered by render_heatmaps
+
+    :param corr: correlation matrix
+    :type corr: pd.DataFrame
+    :param title: figure title
+    :type title: str
+    :param xlabel: x axis label
+    :type xlabel: str
+    :param ylabel: y axis label
+    :type ylabel: str
+    :param png_path: output file
+    :type png_path: str
+    :return: heatmap job
+    :rtype: dict
+    """
+    return {"corr": corr, "title": title, "xlabel": xlabel, "ylabel": ylabel, "png_path": png_path}
+
+
+def get_job_hash(job):
+    """Returns the hash of everything that is drawn in the heatmap of a job
+
+    :param job: heatmap job
+    :type job: dict
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    corr = job["corr"]
+    sha1.update(corr.to_numpy(dtype=float).tobytes())
+    sha1.update(repr((list(corr.index), list(corr.columns), job["title"], job["xlabel"], job["ylabel"])).encode())
+    return sha1.hexdigest()
+
+
+def is_up_to_date(job):
+    """Returns whether the png of a job exists and was rendered from the same input
+
+    :param job: heatmap job
+    :type job: dict
+    :return: whether the png is up to date
+    :rtype: bool
+    """
+    hash_path = job["png_path"] + hash_suffix
+    if not os.path.exists(job["png_path"]) or not os.path.exists(hash_path):
+        return False
+    with open(hash_path, "r") as f:
+        return f.read() == get_job_hash(job)
+
+
+def render_heatmap(job):
+    """Renders the heatmap of a job and saves the hash of its input next to the png
+
+    :param job: heatmap job
+    :type job: dict
+    :return: png path
+    :rtype: str
+    """
+    sns.heatmap(job["corr"], annot=True, vmin=-1, vmax=1, cmap="YlOrRd")
+    plt.title(job["title"])
+    plt.xlabel(job["xlabel"])
+    plt.ylabel(job["ylabel"])
+    plt.savefig(job["png_path"])
+    plt.close()
+    with open(job["png_path"] + hash_suffix, "w") as f:
+        f.write(get_job_hash(job))
+    return job["png_path"]
+
+
+def remove_stale_heatmaps(jobs):
+    """Removes the png files, and their hashes, left in the directories of the jobs by previous runs and not
+    rendered by any job, e.g. the heatmaps of discriminant values that are no longer in the data
+
+    :param jobs: heatmap jobs as returned by make_heatmap_job
+    :type jobs: list
+    :return: number of removed heatmaps
+    :rtype: int
+    """
+    png_paths = {os.path.abspath(job["png_path"]) for job in jobs}
+    removed = 0
+    for png_dir in {os.path.dirname(png_path) for png_path in png_paths}:
+        for file in os.listdir(png_dir):
+            path = os.path.join(png_dir, file)
+            if file.endswith(".png") and path not in png_paths:
+                os.remove(path)
+                removed += 1
+            elif file.endswith(".png" + hash_suffix) and path[:-len(hash_suffix)] not in png_paths:
+                os.remove(path)
+    return removed
+
+
+def render_heatmaps(jobs, n_jobs=None, skip_unchanged=True, remove_stale=False):
+    """Renders a queue of heatmaps in a process pool
+
+    :param jobs: heatmap jobs as returned by make_heatmap_job
+    :type jobs: list
+    :param n_jobs: number of worker processes, None uses all the cpus, 1 renders in the current process
+    :type n_jobs: int
+    :param skip_unchanged: whether to skip the heatmaps whose png was already rendered from the same input
+    :type skip_unchanged: bool
+    :param remove_stale: whether to remove the heatmaps of the directories of the jobs that no job renders, see
+        remove_stale_heatmaps. jobs must then contain all the heatmaps of their directories.
+    :type remove_stale: bool
+    :return: {"rendered": number of rendered heatmaps, "skipped": number of skipped heatmaps, "removed": number of
+        removed heatmaps}
+    :rtype: dict
+    """
+    to_render = [job for job in jobs if not (skip_unchanged and is_up_to_date(job))]
+    if n_jobs == 1 or len(to_render) <= 1:
+        for job in tqdm(to_render, desc="heatmaps"):
+            render_heatmap(job)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(tqdm(executor.map(render_heatmap, to_render), total=len(to_render), desc="heatmaps"))
+    removed = remove_stale_heatmaps(jobs) if remove_stale else 0
+    return {"rendered": len(to_render), "skipped": len(jobs) - len(to_render), "removed": removed}
@@ -0,0 +1,311 @@
+import os
+import pandas as pd
+
+from madrid_utilities import station_col, pollutant_col, datetime_col, concentration_col
+from store_utilities import list_partitions, file_formats, get_file_signature, read_partitioned_dataset, \
+    load_manifest, save_manifest, remove_parts
+from stat_utilities import default_quantiles
+from metrics_utilities import null_metrics
+
+# Layout: <dataset_dir>/rollups/level=<level>/year=<year>.parquet, from the coarsest to the finest level
+rollup_dir_name = "rollups"
+rollup_levels = ("year", "month", "week", "day")
+end_col = "end"
+count_col = "count"
+mean_col = "mean"
+min_col = "min"
+max_col = "max"
+hour_level = "hour"
+# Datetimes of the hourly data are the start of their hour, the last one of a bucket is its end minus one hour
+last_hour_offset = pd.Timedelta(1, "h")
+
+
+def get_rollup_dir(dataset_dir):
+    """Returns the directory of the rollups of a dataset, inside the dataset directory so that they are stored next
+    to the hourly data. It is ignored by the readers of the partitions.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :return: rollup directory
+    :rtype: str
+    """
+    return os.path.join(dataset_dir, rollup_dir_name)
+
+
+def get_rollup_path(dataset_dir, level, year):
+    """Returns the file of the rollup of a level and a year
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param level: one of rollup_levels
+    :type level: str
+    :param year: year
+    :type year: int
+    :return: file path
+    :rtype: str
+    """
+    return os.path.join(get_rollup_dir(dataset_dir), f"level={level}", f"year={year}.parquet")
+
+
+def quantile_to_col(q):
+    return f"q{round(q * 100):02d}"
+
+
+def get_bucket_starts(datetimes, level):
+    """Returns the start of the bucket of every datetime. Weeks start on Monday and are split at the year boundaries,
+    so that every bucket belongs to one year and the rollups of a year only depend on its data.
+
+    :param datetimes: datetimes
+    :type datetimes: pd.Series
+    :param level: one of rollup_levels
+    :type level: str
+    :return: bucket starts
+    :rtype: pd.Series
+    """
+    days = datetimes.dt.floor("D")
+    if level == "day":
+        return days
+    year_starts = days - pd.to_timedelta(days.dt.dayofyear - 1, unit="D")
+    if level == "week":
+        return (days - pd.to_timedelta(days.dt.dayofweek, unit="D")).clip(lower=year_starts)
+    if level == "month":
+        return days - pd.to_timedelta(days.dt.day - 1, unit="D")
+    if level == "year":
+        return year_starts
+    raise ValueError(f"level must be one of {rollup_levels}")
+
+
+def get_bucket_ends(starts, level):
+    """Returns the end (excluded) of the buckets starting at starts
+
+    :param starts: bucket starts, as returned by get_bucket_starts
+    :type starts: pd.Series
+    :param level: one of rollup_levels
+    :type level: str
+    :return: bucket ends
+    :rtype: pd.Series
+    """
+    if level == "day":
+        return starts + pd.Timedelta(1, "D")
+    if level == "week":
+        next_mondays = starts + pd.to_timedelta(7 - starts.dt.dayofweek, unit="D")
+        return next_mondays.clip(upper=get_bucket_ends(get_bucket_starts(starts, "year"), "year"))
+    if level == "month":
+        return starts + pd.to_timedelta(starts.dt.days_in_month, unit="D")
+    if level == "year":
+        return starts + pd.to_timedelta(365 + starts.dt.is_leap_year.astype(int), unit="D")
+    raise ValueError(f"level must be one of {rollup_levels}")
+
+
+def aggregate_buckets(df, bucket_starts, quantiles=default_quantiles):
+    """Aggregates the concentrations of every station, pollutant and bucket
+
+    :param df: long table
+    :type df: pd.DataFrame
+    :param bucket_starts: bucket start of every row
+    :type bucket_starts: pd.Series
+    :param quantiles: quantiles in [0, 1]
+    :type quantiles: iterable
+    :return: station, pollutant, datetime (bucket start), count (valid values), mean, min, max and quantile columns
+    :rtype: pd.DataFrame
+    """
+    grouped = df.groupby([df[station_col], df[pollutant_col], bucket_starts.rename(datetime_col)], sort=True,
+                         observed=True)[concentration_col]
+    res = grouped.agg([count_col, mean_col, min_col, max_col])
+    quantiles = list(quantiles)
+    if len(quantiles) > 0:
+        quantile_df = grouped.quantile(quantiles).unstack()
+        quantile_df.columns = [quantile_to_col(q) for q in quantile_df.columns]
+        res = res.join(quantile_df)
+    return res.reset_index()
+
+
+def get_year_signatures(dataset_dir):
+    """Returns the signature of the hourly data of every year of a dataset
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :return: {year: {relative path: signature}}
+    :rtype: dict
+    """
+    signatures = {}
+    for year, _, partition_dir in list_partitions(dataset_dir):
+        for part in sorted(os.listdir(partition_dir)):
+            if part.split(".")[-1] in file_formats:
+                path = os.path.join(partition_dir, part)
+                signatures.setdefault(year, {})[os.path.relpath(path, dataset_dir)] = get_file_signature(path)
+    return signatures
+
+
+def build_rollups(dataset_dir, levels=rollup_levels, quantiles=default_quantiles, metrics=null_metrics):
+    """Builds the rollups of every level from the hourly data of a dataset written by
+    madrid_extract.incremental_extract or discomapEEA_extract.extract_eea. Rollups are built one year at a time and
+    only for the years whose hourly files changed since the previous build, or for all of them when levels or
+    quantiles change. The rollups of the years removed from the dataset are removed.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param levels: levels to build, a subset of rollup_levels
+    :type levels: iterable
+    :param quantiles: quantiles in [0, 1]
+    :type quantiles: iterable
+    :param metrics: recorder of the "rollup" stage of every built year
+    :type metrics: metrics_utilities.MetricsRecorder
+    :return: one row per year with year, status ("built" or "cached") and rows (hourly rows read) columns
+    :rtype: pd.DataFrame
+    """
+    levels = [level for level in rollup_levels if level in levels]
+    quantiles = list(quantiles)
+    rollup_dir = get_rollup_dir(dataset_dir)
+    manifest = load_manifest(rollup_dir)
+    year_signatures = {str(year): signature for year, signature in get_year_signatures(dataset_dir).items()}
+    for year in [year for year in manifest if year not in year_signatures]:
+        remove_parts(rollup_dir, manifest.pop(year)["parts"])
+    report = []
+    for year, signature in year_signatures.items():
+        entry = {"signature": signature, "levels": levels, "quantiles": quantiles}
+        if all(manifest.get(year, {}).get(key) == value for key, value in entry.items()):
+            report.append({"year": int(year), "status": "cached", "rows": 0})
+            continue
+        with metrics.stage("rollup", year=year) as rollup_stage:
+            if year in manifest:
+                remove_parts(rollup_dir, manifest.pop(year)["parts"])
+            df = read_partitioned_dataset(dataset_dir, date_from=f"{year}-01-01",
+                                          date_to=pd.Timestamp(f"{int(year) + 1}-01-01") - pd.Timedelta(1, "ns"))
+            entry["parts"] = []
+            for level in levels:
+                rollup_df = aggregate_buckets(df, get_bucket_starts(df[datetime_col], level), quantiles=quantiles)
+                rollup_df.insert(3, end_col, get_bucket_ends(rollup_df[datetime_col], level))
+                path = get_rollup_path(dataset_dir, level, year)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                rollup_df.to_parquet(path, index=False)
+                entry["parts"].append(os.path.relpath(path, rollup_dir))
+                rollup_stage.add(rows_out=len(rollup_df))
+            rollup_stage.add(rows_in=len(df))
+        manifest[year] = entry
+        save_manifest(manifest, rollup_dir)
+        report.append({"year": int(year), "status": "built", "rows": len(df)})
+    save_manifest(manifest, rollup_dir)
+    return pd.DataFrame(report, columns=["year", "status", "rows"])
+
+
+def read_rollup(dataset_dir, level, stations=None, pollutants=None, date_from=None, date_to=None):
+    """Reads the rollup of a level, keeping the buckets overlapping the date range
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param level: one of rollup_levels
+    :type level: str
+    :param stations: stations to keep, None keeps all of them
+    :type stations: list
+    :param pollutants: pollutants to keep, None keeps all of them
+    :type pollutants: list
+    :param date_from: first datetime of the range (included)
+    :type date_from: str or datetime.datetime
+    :param date_to: last datetime of the range (included)
+    :type date_to: str or datetime.datetime
+    :return: rollup, None if the level was not built
+    :rtype: pd.DataFrame
+    """
+    manifest = load_manifest(get_rollup_dir(dataset_dir))
+    years = sorted(int(year) for year, entry in manifest.items() if level in entry["levels"])
+    if len(years) == 0:
+        return None
+    date_from = pd.Timestamp.min if date_from is None else pd.Timestamp(date_from)
+    date_to = pd.Timestamp.max if date_to is None else pd.Timestamp(date_to)
+    df_list = []
+    for year in years:
+        if date_from.year <= year <= date_to.year:
+            df = pd.read_parquet(get_rollup_path(dataset_dir, level, year))
+            mask = (df[datetime_col] <= date_to) & (df[end_col] > date_from)
+            if stations is not None:
+                mask &= df[station_col].isin(stations)
+            if pollutants is not None:
+                mask &= df[pollutant_col].astype(str).isin([str(pollutant) for pollutant in pollutants])
+            df_list.append(df[mask])
+    if len(df_list) == 0:
+        return pd.read_parquet(get_rollup_path(dataset_dir, level, years[0])).iloc[:0]
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
+def combine_buckets(df, periods, with_quantiles):
+    """Aggregates the buckets of a rollup in coarser periods. Counts, means, minima and maxima are merged exactly,
+    quantiles are kept only if every period has one bucket.
+
+    :param df: rollup
+    :type df: pd.DataFrame
+    :param periods: start of the period of every bucket
+    :type periods: pd.Series
+    :param with_quantiles: whether to keep the quantile columns
+    :type with_quantiles: bool
+    :return: aggregated rollup with the columns of aggregate_buckets
+    :rtype: pd.DataFrame
+    """
+    df = df.assign(**{datetime_col: periods.to_numpy(), "_sum": df[mean_col].fillna(0.) * df[count_col]})
+    grouped = df.groupby([station_col, pollutant_col, datetime_col], sort=True, observed=True)
+    res = grouped.agg(**{count_col: (count_col, "sum"), "_sum": ("_sum", "sum"), min_col: (min_col, "min"),
+                         max_col: (max_col, "max")})
+    res.insert(1, mean_col, (res.pop("_sum") / res[count_col]).where(res[count_col] > 0))
+    if with_quantiles:
+        res = res.join(grouped[[col for col in df.columns if col.startswith("q")]].first())
+    return res.reset_index()
+
+
+def query_rollups(dataset_dir, freq, stations=None, pollutants=None, date_from=None, date_to=None,
+                  with_quantiles=False):
+    """Returns the aggregates of the hourly concentrations at the resolution of freq, computed from the coarsest
+    rollup answering the request: its buckets overlapping the date range must be inside the range and inside one
+    period of freq, and, when quantiles are requested, every period must have one bucket, since quantiles cannot be
+    merged. For example monthly means of whole years are computed from the monthly rollup, yearly means from the
+    yearly rollup and monthly means starting in the middle of a month from the daily rollup. When no rollup answers
+    the request, e.g. for hourly frequencies, or when the hourly files of a year of the range changed since the last
+    build_rollups, the hourly data is read.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param freq: pandas period frequency, e.g. "D", "W", "M", "Q" or "A"
+    :type freq: str
+    :param stations: stations to keep, None keeps all of them
+    :type stations: list
+    :param pollutants: pollutants to keep, None keeps all of them
+    :type pollutants: list
+    :param date_from: first datetime of the range (included)
+    :type date_from: str or datetime.datetime
+    :param date_to: last datetime of the range (included)
+    :type date_to: str or datetime.datetime
+    :param with_quantiles: whether to return the quantile columns
+    :type with_quantiles: bool
+    :return: (aggregates with station, pollutant, datetime (period start), count, mean, min, max and, if requested,
+        quantile columns, level used: one of rollup_levels or "hour")
+    :rtype: tuple
+    """
+    range_from = pd.Timestamp.min if date_from is None else pd.Timestamp(date_from)
+    range_to = pd.Timestamp.max if date_to is None else pd.Timestamp(date_to)
+    manifest = load_manifest(get_rollup_dir(dataset_dir))
+    year_signatures = {year: signature for year, signature in get_year_signatures(dataset_dir).items()
+                       if range_from.year <= year <= range_to.year}
+    # The rollups of a year of the range built from other hourly files exclude all the levels
+    up_to_date = all(manifest.get(str(year), {}).get("signature") == signature
+                     for year, signature in year_signatures.items())
+    levels = [level for level in rollup_levels
+              if up_to_date and all(level in manifest[str(year)]["levels"] for year in year_signatures)]
+    for level in levels:
+        df = read_rollup(dataset_dir, level, stations=stations, pollutants=pollutants, date_from=date_from,
+                         date_to=date_to)
+        if df is None:
+            continue
+        last_hours = df[end_col] - last_hour_offset
+        if ((df[datetime_col] < range_from) | (last_hours > range_to)).any():
+            continue
+        periods = df[datetime_col].dt.to_period(freq)
+        if (periods != last_hours.dt.to_period(freq)).any():
+            continue
+        if with_quantiles and pd.DataFrame({station_col: df[station_col], pollutant_col: df[pollutant_col],
+                                            datetime_col: periods}).duplicated().any():
+            continue
+        return combine_buckets(df, periods.dt.start_time, with_quantiles=with_quantiles), level
+    df = read_partitioned_dataset(dataset_dir, stations=stations, pollutants=pollutants, date_from=date_from,
+                                  date_to=date_to)
+    res = aggregate_buckets(df, df[datetime_col].dt.to_period(freq).dt.start_time,
+                            quantiles=default_quantiles if with_quantiles else ())
+    return res, hour_level
@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+
+from madrid_utilities import datetime_col
+
+# Default bin edges of the quantile sketches: 0, then log-spaced from 0.001 to 10000 with a relative resolution of
+# 0.8%, so that e.g. CO in mg/m3 (mostly below 2) and NO2 in ug/m3 (up to hundreds) get the same relative precision
+default_sketch_edges = np.concatenate([[0.], np.geomspace(1e-3, 1e4, 2001)])
+default_quantiles = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+class QuantileSketch:
+    """Fixed-bin histogram approximating quantiles, mergeable by adding the counts. Values outside the edges are
+    counted in the first or last bin.
+
+    :param edges: increasing bin edges
+    :type edges: np.ndarray
+    :param n_columns: number of columns sketched together
+    :type n_columns: int
+    """
+
+    def __init__(self, edges=default_sketch_edges, n_columns=1):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros((n_columns, len(self.edges) - 1), dtype=np.int64)
+
+    def update(self, values):
+        """Adds the values of a chunk ignoring np.nan
+
+        :param values: array (time, column)
+        :type values: np.ndarray
+        """
+        bins = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, len(self.edges) - 2)
+        columns = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+        valid = ~np.isnan(values)
+        np.add.at(self.counts, (columns[valid], bins[valid]), 1)
+
+    def merge(self, other):
+        """Adds the counts of another sketch with the same edges
+
+        :param other: sketch
+        :type other: QuantileSketch
+        :return: self
+        :rtype: QuantileSketch
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("sketches with different edges cannot be merged")
+        self.counts += other.counts
+        return self
+
+    def quantiles(self, q):
+        """Returns the quantiles of every column interpolating linearly inside the bins
+
+        :param q: quantiles in [0, 1]
+        :type q: iterable
+        :return: array (column, quantile), np.nan for columns without values
+        :rtype: np.ndarray
+        """
+        q = np.asarray(q, dtype=float)
+        res = np.full((self.counts.shape[0], len(q)), np.nan)
+        for i, counts in enumerate(self.counts):
+            total = counts.sum()
+            if total == 0:
+                continue
+            cum = np.concatenate([[0], np.cumsum(counts)])
+            res[i] = np.interp(q * total, cum, self.edges)
+        return res
+
+
+class StatAccumulator:
+    """Statistics of the pivoted dataframe of one discriminant value, updated one chunk of rows at a time and
+    mergeable with the accumulators of other chunks, e.g. computed by parallel workers or saved by a previous run.
+    Means and variances are merged with the parallel Welford formulas. Chunks must not share datetimes.
+
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param value: discriminant value
+    :param pivot_columns: pivot columns of the pivoted dataframe
+    :type pivot_columns: list
+    :param sketch_edges: bin edges of the quantile sketches, None disables them
+    :type sketch_edges: np.ndarray
+    """
+
+    def __init__(self, discriminant_column, value, pivot_columns, sketch_edges=None):
+        self.discriminant_column = discriminant_column
+        self.value = value
+        self.pivot_columns = [str(col) for col in pivot_columns]
+        n_columns = len(self.pivot_columns)
+        self.first_date = None
+        self.last_date = None
+        self.length = 0
+        self.n_missing_row = 0
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+        self.min = np.full(n_columns, np.nan)
+        self.max = np.full(n_columns, np.nan)
+        self.sketch = None if sketch_edges is None else QuantileSketch(sketch_edges, n_columns=n_columns)
+
+    @classmethod
+    def from_df(cls, df, discriminant_column, sketch_edges=None):
+        """Creates the accumulator of a pivoted dataframe, as returned by madrid_analysis.fast_pivot
+
+        :param df: pivoted dataframe
+        :type df: pd.DataFrame
+        :param discriminant_column: column acting as discriminant
+        :type discriminant_column: str
+        :param sketch_edges: bin edges of the quantile sketches, None disables them
+        :type sketch_edges: np.ndarray
+        :return: accumulator
+        :rtype: StatAccumulator
+        """
+        pivot_columns = [col for col in df.columns if col not in [datetime_col, discriminant_column]]
+        accumulator = cls(discriminant_column, df[discriminant_column][0], pivot_columns, sketch_edges=sketch_edges)
+        return accumulator.update(df)
+
+    def update(self, df):
+        """Adds the rows of a chunk of the pivoted dataframe
+
+        :param df: pivoted dataframe chunk
+        :type df: pd.DataFrame
+        :return: self
+        :rtype: StatAccumulator
+        """
+        return self.update_values(df[datetime_col], df[self.pivot_columns].to_numpy(dtype=float))
+
+    def update_values(self, datetimes, values):
+        """Adds a chunk given as arrays
+
+        :param datetimes: datetimes of the rows
+        :type datetimes: pd.DatetimeIndex or pd.Series
+        :param values: array (datetime, pivot) with np.nan for missing values
+        :type values: np.ndarray
+        :return: self
+        :rtype: StatAccumulator
+        """
+        if len(datetimes) == 0:
+            return self
+        other = StatAccumulator(self.discriminant_column, self.value, self.pivot_columns)
+        missing = np.isnan(values)
+        other.first_date, other.last_date = pd.Timestamp(datetimes.min()), pd.Timestamp(datetimes.max())
+        other.length = len(datetimes)
+        other.n_missing_row = int(missing.any(axis=1).sum())
+        other.count = (~missing).sum(axis=0)
+        has_values = other.count > 0
+        filled = np.where(missing, 0., values)
+        other.mean = np.divide(filled.sum(axis=0), other.count, out=np.zeros(len(other.count)), where=has_values)
+        other.m2 = (np.where(missing, 0., values - other.mean) ** 2).sum(axis=0)
+        other.min = np.where(has_values, np.where(missing, np.inf, values).min(axis=0), np.nan)
+        other.max = np.where(has_values, np.where(missing, -np.inf, values).max(axis=0), np.nan)
+        if self.sketch is not None:
+            self.sketch.update(values)
+        return self._merge_moments(other)
+
+    def _merge_moments(self, other):
+        """Merges everything but the sketches
+
+        :param other: accumulator
+        :type other: StatAccumulator
+        :return: self
+        :rtype: StatAccumulator
+        """
+        if other.length == 0:
+            return self
+        self.first_date = other.first_date if self.first_date is None else min(self.first_date, other.first_date)
+        self.last_date = other.last_date if self.last_date is None else max(self.last_date, other.last_date)
+        self.length += other.length
+        self.n_missing_row += other.n_missing_row
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(count > 0, other.count / count, 0.)
+            self.m2 = self.m2 + other.m2 + delta ** 2 * np.where(count > 0, self.count * weight, 0.)
+        self.mean = self.mean + delta * weight
+        self.count = count
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        return self
+
+    def merge(self, other):
+        """Merges the accumulator of another chunk of the same discriminant value
+
+        :param other: accumulator
+        :type other: StatAccumulator
+        :return: self
+        :rtype: StatAccumulator
+        """
+        if other.pivot_columns != self.pivot_columns:
+            raise ValueError("accumulators with different pivot columns cannot be merged")
+        if (self.sketch is None) != (other.sketch is None):
+            raise ValueError("accumulators with and without quantile sketches cannot be merged")
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self._merge_moments(other)
+
+    def to_stat_dict(self, quantiles=default_quantiles):
+        """Returns the statistics with the keys of madrid_analysis.get_stat plus count, mean, std (ddof 1), min, max
+        and, when sketched, approximated quantiles of every pivot column
+
+        :param quantiles: quantiles of the sketches
+        :type quantiles: iterable
+        :return: statistic dictionary
+        :rtype: dict
+        """
+        missing = self.length - self.count
+        missing_dict = {col: missing[i] for i, col in enumerate(self.pivot_columns)}
+        missing_dict[self.discriminant_column] = np.int64(0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+        stat_dict = {"discriminant": self.discriminant_column,
+                     "value": self.value,
+                     "first_date": self.first_date,
+                     "last_date": self.last_date,
+                     "length": self.length,
+                     "n_missing_row": self.n_missing_row,
+                     "missing_dict": missing_dict,
+                     "count_dict": dict(zip(self.pivot_columns, self.count)),
+                     "mean_dict": dict(zip(self.pivot_columns, np.where(self.count > 0, self.mean, np.nan))),
+                     "std_dict": dict(zip(self.pivot_columns, std)),
+                     "min_dict": dict(zip(self.pivot_columns, self.min)),
+                     "max_dict": dict(zip(self.pivot_columns, self.max))}
+        if self.sketch is not None:
+            stat_dict["quantile_dict"] = {col: dict(zip(quantiles, col_quantiles)) for col, col_quantiles
+                                          in zip(self.pivot_columns, self.sketch.quantiles(quantiles))}
+        return stat_dict
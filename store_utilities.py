@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import hashlib
+import pandas as pd
+import pyarrow.feather as pf
+import pyarrow.parquet as pq
+
+from madrid_utilities import station_col, pollutant_col, datetime_col
+
+# Layout: <dataset_dir>/year=<year>/pollutant=<pollutant>/<part_name>.<file_format>
+year_partition = "year"
+pollutant_partition = "pollutant"
+file_formats = ["parquet", "feather"]
+manifest_file_name = "manifest.json"
+
+
+def get_partition_dir(dataset_dir, year, pollutant):
+    """Returns the directory of a (year, pollutant) partition
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param year: year of the partition
+    :type year: int
+    :param pollutant: pollutant of the partition
+    :type pollutant: str
+    :return: partition directory
+    :rtype: str
+    """
+    return os.path.join(dataset_dir, f"{year_partition}={year}", f"{pollutant_partition}={pollutant}")
+
+
+def list_partitions(dataset_dir):
+    """Returns all the (year, pollutant, directory) partitions of a dataset sorted by year and pollutant
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :return: list of (year, pollutant, directory)
+    :rtype: list
+    """
+    partitions = []
+    if not os.path.isdir(dataset_dir):
+        return partitions
+    for year_dir in os.listdir(dataset_dir):
+        year_match = re.match(rf"^{year_partition}=(\d+)$", year_dir)
+        if year_match is None:
+            continue
+        for pollutant_dir in os.listdir(os.path.join(dataset_dir, year_dir)):
+            pollutant_match = re.match(rf"^{pollutant_partition}=(.+)$", pollutant_dir)
+            if pollutant_match is not None:
+                partitions.append((int(year_match.group(1)), pollutant_match.group(1),
+                                   os.path.join(dataset_dir, year_dir, pollutant_dir)))
+    return sorted(partitions)
+
+
+def write_partitioned_dataset(df, dataset_dir, part_name="part", file_format="parquet"):
+    """Writes a long table as a columnar dataset partitioned by year and pollutant. Existing files with the same
+    part_name are overwritten, other parts of the same partitions are left untouched.
+
+    :param df: long table with station, pollutant, datetime and concentration columns
+    :type df: pd.DataFrame
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param part_name: name of the file written inside every partition
+    :type part_name: str
+    :param file_format: one of file_formats
+    :type file_format: str
+    :return: list of written files
+    :rtype: list
+    """
+    if file_format not in file_formats:
+        raise ValueError(f"file_format must be one of {file_formats}")
+    written = []
+    for (year, pollutant), part_df in df.groupby([df[datetime_col].dt.year, pollutant_col], sort=True,
+                                                 observed=True):
+        partition_dir = get_partition_dir(dataset_dir, year, pollutant)
+        os.makedirs(partition_dir, exist_ok=True)
+        path = os.path.join(partition_dir, f"{part_name}.{file_format}")
+        part_df = part_df.reset_index(drop=True)
+        if file_format == "parquet":
+            part_df.to_parquet(path, index=False)
+        else:
+            part_df.to_feather(path)
+        written.append(path)
+    return written
+
+
+def _read_part(path, columns):
+    """Reads one file of a partition
+
+    :param path: file path
+    :type path: str
+    :param columns: columns to read, None reads all of them
+    :type columns: list
+    :return: partition data
+    :rtype: pd.DataFrame
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_feather(path, columns=columns)
+
+
+def count_part_rows(path):
+    """Returns the number of rows of one file of a partition reading only its metadata
+
+    :param path: file path
+    :type path: str
+    :return: number of rows
+    :rtype: int
+    """
+    if path.endswith(".parquet"):
+        return pq.read_metadata(path).num_rows
+    return pf.read_table(path, columns=[], memory_map=True).num_rows
+
+
+def count_year_rows(dataset_dir):
+    """Returns the number of rows of every year of a dataset without reading its data
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :return: {year: number of rows} sorted by year
+    :rtype: dict
+    """
+    year_rows = {}
+    for year, _, partition_dir in list_partitions(dataset_dir):
+        for part in os.listdir(partition_dir):
+            if part.split(".")[-1] in file_formats:
+                year_rows[year] = year_rows.get(year, 0) + count_part_rows(os.path.join(partition_dir, part))
+    return year_rows
+
+
+def read_partitioned_dataset(dataset_dir, stations=None, pollutants=None, columns=None, date_from=None, date_to=None):
+    """Reads a dataset written by write_partitioned_dataset. Only the partitions matching pollutants and the
+    date range are opened and only the needed columns are read.
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param stations: stations to keep, None keeps all of them
+    :type stations: list
+    :param pollutants: pollutants to keep, None keeps all of them
+    :type pollutants: list
+    :param columns: columns to return, None returns all of them
+    :type columns: list
+    :param date_from: first datetime to keep (included)
+    :type date_from: str or datetime.datetime
+    :param date_to: last datetime to keep (included)
+    :type date_to: str or datetime.datetime
+    :return: filtered long table
+    :rtype: pd.DataFrame
+    """
+    date_from = None if date_from is None else pd.Timestamp(date_from)
+    date_to = None if date_to is None else pd.Timestamp(date_to)
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns)
+        if stations is not None and station_col not in read_columns:
+            read_columns.append(station_col)
+        if (date_from is not None or date_to is not None) and datetime_col not in read_columns:
+            read_columns.append(datetime_col)
+    if pollutants is not None:
+        pollutants = [str(pollutant) for pollutant in pollutants]
+    df_list = []
+    for year, pollutant, partition_dir in list_partitions(dataset_dir):
+        if pollutants is not None and pollutant not in pollutants:
+            continue
+        if (date_from is not None and year < date_from.year) or (date_to is not None and year > date_to.year):
+            continue
+        for part in sorted(os.listdir(partition_dir)):
+            if part.split(".")[-1] not in file_formats:
+                continue
+            part_df = _read_part(os.path.join(partition_dir, part), columns=read_columns)
+            mask = pd.Series(True, index=part_df.index)
+            if stations is not None:
+                mask &= part_df[station_col].isin(stations)
+            if date_from is not None:
+                mask &= part_df[datetime_col] >= date_from
+            if date_to is not None:
+                mask &= part_df[datetime_col] <= date_to
+            df_list.append(part_df[mask])
+    if len(df_list) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(df_list, axis=0, ignore_index=True)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def get_file_signature(path, use_hash=False):
+    """Returns the signature used to detect whether a source file changed
+
+    :param path: file path
+    :type path: str
+    :param use_hash: whether to use the sha1 of the file content instead of the modification time
+    :type use_hash: bool
+    :return: signature
+    :rtype: dict
+    """
+    stat = os.stat(path)
+    signature = {"size": stat.st_size}
+    if not use_hash:
+        signature["mtime_ns"] = stat.st_mtime_ns
+    else:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        signature["sha1"] = sha1.hexdigest()
+    return signature
+
+
+def load_manifest(dataset_dir):
+    """Loads the manifest of a dataset: {source: {"signature": dict, "parts": [relative paths]}}
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :return: manifest, empty if the dataset has none
+    :rtype: dict
+    """
+    path = os.path.join(dataset_dir, manifest_file_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, dataset_dir):
+    """Saves the manifest of a dataset
+
+    :param manifest: manifest as returned by load_manifest
+    :type manifest: dict
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    tmp_path = os.path.join(dataset_dir, manifest_file_name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, os.path.join(dataset_dir, manifest_file_name))
+
+
+def remove_parts(dataset_dir, parts):
+    """Removes partition files of a dataset and the partition directories left empty
+
+    :param dataset_dir: dataset directory
+    :type dataset_dir: str
+    :param parts: paths relative to dataset_dir
+    :type parts: list
+    """
+    for part in parts:
+        path = os.path.join(dataset_dir, part)
+        if os.path.exists(path):
+            os.remove(path)
+        partition_dir = os.path.dirname(path)
+        while os.path.abspath(partition_dir) != os.path.abspath(dataset_dir) and os.path.isdir(partition_dir) \
+                and len(os.listdir(partition_dir)) == 0:
+            os.rmdir(partition_dir)
+            partition_dir = os.path.dirname(partition_dir)
@@ -0,0 +1,31 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from corr_study import avg_corr
+
+
+def write_corr(corr_dir, name, value):
+    labels = ["NO2", "O3", "SO2"]
+    corr = pd.DataFrame(np.full((3, 3), value), index=labels, columns=labels)
+    corr.to_pickle(os.path.join(corr_dir, f"station_{name}_corr.pkl"))
+
+
+def test_avg_corr_tensor_file_tracks_sources(tmp_path):
+    corr_dir, tensor_file = str(tmp_path), str(tmp_path / "station_corr_tensor.npz")
+    write_corr(corr_dir, "a", 0.2)
+    write_corr(corr_dir, "b", 0.6)
+    assert np.allclose(avg_corr("station", corr_dir, tensor_file=tensor_file)["mean"], 0.4)
+    assert np.allclose(avg_corr("station", corr_dir, tensor_file=tensor_file)["mean"], 0.4)
+    os.remove(os.path.join(corr_dir, "station_b_corr.pkl"))
+    assert np.allclose(avg_corr("station", corr_dir, tensor_file=tensor_file)["mean"], 0.2)
+    write_corr(corr_dir, "c", 0.8)
+    assert np.allclose(avg_corr("station", corr_dir, tensor_file=tensor_file)["mean"], 0.5)
+
+
+def test_avg_corr_without_matrices(tmp_path):
+    tensor_file = str(tmp_path / "station_corr_tensor.npz")
+    assert len(avg_corr("station", str(tmp_path), tensor_file=tensor_file)) == 0
+    assert len(avg_corr("station", str(tmp_path), tensor_file=tensor_file)) == 0
+    assert len(avg_corr("station", str(tmp_path))) == 0
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from corr_utilities import batched_corr, rolling_corr
+
+
+def make_values(n_groups=3, n_times=300, n_vars=6, seed=0):
+    """Returns correlated variables with ties, a constant variable and different missing times"""
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=(n_groups, n_times, 1))
+    values = np.round(base + rng.normal(scale=0.8, size=(n_groups, n_times, n_vars)), 1)
+    values[:, :, -1] = 3.
+    values[rng.random(values.shape) < np.linspace(0., 0.5, n_vars)] = np.nan
+    values[0, :, 1] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("method", ["pearson", "spearman"])
+@pytest.mark.parametrize("min_periods", [1, 200])
+def test_batched_corr_matches_pandas(method, min_periods):
+    values = make_values()
+    corr, counts = batched_corr(values, method=method, min_periods=min_periods)
+    for g in range(values.shape[0]):
+        df = pd.DataFrame(values[g])
+        expected = df.corr(method=method, min_periods=min_periods).to_numpy()
+        np.testing.assert_allclose(corr[g], expected, rtol=0, atol=1e-12)
+        np.testing.assert_array_equal(counts[g], df.notna().astype(int).T @ df.notna().astype(int))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_batched_corr_constant_on_overlap(seed):
+    # The first variable varies, but not at the times where the second one is valid
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(1, 400, 3)) * rng.uniform(0.1, 100.)
+    values[0, :100, 0] = rng.normal() * 5.
+    values[0, 100:, 1] = np.nan
+    corr, _ = batched_corr(values)
+    expected = pd.DataFrame(values[0]).corr().to_numpy()
+    assert np.isnan(expected[0, 1])
+    np.testing.assert_allclose(corr[0], expected, rtol=0, atol=1e-12)
+
+
+def make_series(n_times=3000, n_vars=4, seed=0):
+    """Returns a correlated series with missing values and a sensor stuck near the mean of the series"""
+    rng = np.random.default_rng(seed)
+    values = 50. + 10. * (rng.normal(size=(n_times, 1)) + rng.normal(scale=0.8, size=(n_times, n_vars)))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[1000:1100, 0] = np.round(np.nanmean(values[:, 0]), 2)
+    values[2000:2030, 1:] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("window, step, min_periods", [(24, 1, 2), (48, 5, 30), (24, 7, 2)])
+def test_rolling_corr_matches_pandas(window, step, min_periods):
+    values = make_series()
+    corr, counts, starts, (first, second) = rolling_corr(values, window=window, step=step, min_periods=min_periods,
+                                                         pair_block=4)
+    np.testing.assert_array_equal(starts, np.arange(0, len(values) - window + 1, step))
+    for w, start in enumerate(starts):
+        df = pd.DataFrame(values[start:start + window])
+        expected = df.corr(min_periods=min_periods).to_numpy()[first, second]
+        np.testing.assert_allclose(corr[w], expected, rtol=0, atol=1e-9)
+        valid = df.notna().astype(int)
+        np.testing.assert_array_equal(counts[w], (valid.T @ valid).to_numpy()[first, second])
+
+
+def test_rolling_corr_stuck_sensor():
+    values = make_series(n_times=200000)
+    values[150000:150100, 0] = np.round(np.nanmean(values[:, 0]), 2)
+    corr, _, starts, (first, _) = rolling_corr(values, window=24)
+    stuck = (starts >= 150000) & (starts + 24 <= 150100)
+    assert np.isnan(corr[np.ix_(stuck, first == 0)]).all()
+    assert not np.isnan(corr[np.ix_(stuck, first != 0)]).all()
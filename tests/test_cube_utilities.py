@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cube_utilities import build_cube, TimeSeriesCube, cube_file_prefix
+from madrid_utilities import station_col, pollutant_col, datetime_col, concentration_col
+
+
+def make_long_df(seed=0, scale=1.):
+    """Returns a long table with missing hours, unsorted rows and stations and pollutants in no particular order"""
+    rng = np.random.default_rng(seed)
+    datetimes = pd.date_range("2020-03-28", periods=200, freq="h")
+    df = pd.DataFrame([(station, pollutant, date) for station in [28079008, 28079004, 28079035]
+                       for pollutant in ["NO2", "CO", "O3"] for date in datetimes],
+                      columns=[station_col, pollutant_col, datetime_col])
+    df[concentration_col] = np.round(rng.uniform(0., 100., len(df)), 1) * scale
+    return df.sample(frac=0.8, random_state=seed).reset_index(drop=True)
+
+
+def test_cube_slices_match_long_table(tmp_path):
+    df = make_long_df()
+    cube = build_cube(df, cube_dir=str(tmp_path))
+    assert cube.stations == [28079004, 28079008, 28079035] and cube.pollutants == ["CO", "NO2", "O3"]
+    for (station, pollutant), group in df.groupby([station_col, pollutant_col]):
+        expected = group.set_index(datetime_col)[concentration_col].sort_index().astype(np.float32)
+        series = cube.series(station, pollutant)
+        pd.testing.assert_series_equal(series.dropna(), expected, check_names=False, check_freq=False)
+        assert series.isna().sum() == cube.n_hours - len(group)
+    date_from, date_to = "2020-03-29 02:00", "2020-03-30 05:00"
+    values = cube.get(station=28079035, date_from=date_from, date_to=date_to)
+    rows = df[(df[station_col] == 28079035) & (df[datetime_col] >= date_from) & (df[datetime_col] <= date_to)]
+    assert values.shape == (3, 28) and np.count_nonzero(~np.isnan(values)) == len(rows)
+    np.testing.assert_array_equal(cube.get(station=[28079035], pollutant=["O3", "CO"], date_from=date_from,
+                                           date_to=date_to)[0], values[[2, 0]])
+
+
+def test_cube_slices_are_views(tmp_path):
+    cube = build_cube(make_long_df(), cube_dir=str(tmp_path))
+    for values in [cube.get(station=28079004), cube.get(pollutant="NO2", date_from="2020-03-29"),
+                   cube.series(28079008, "O3", date_to="2020-03-30").to_numpy()]:
+        assert np.shares_memory(values, cube.values)
+    assert not np.shares_memory(cube.get(station=[28079004, 28079008]), cube.values)
+
+
+def test_rebuild_keeps_open_cubes_readable(tmp_path):
+    old_df = make_long_df()
+    old_cube = build_cube(old_df, cube_dir=str(tmp_path))
+    old_values = np.array(old_cube.values)
+    new_cube = build_cube(make_long_df(seed=1, scale=2.), cube_dir=str(tmp_path))
+    np.testing.assert_array_equal(old_cube.values, old_values)
+    assert not np.array_equal(new_cube.values, old_values, equal_nan=True)
+    np.testing.assert_array_equal(TimeSeriesCube(str(tmp_path)).values, new_cube.values)
+    assert len([file for file in os.listdir(tmp_path) if file.startswith(cube_file_prefix)]) == 1
@@ -0,0 +1,43 @@
+import functools
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pandas as pd
+import pytest
+
+from download_utilities import DownloadEngine, HttpCache
+from discomapEEA_utilities import latest_kept_cols, latest_samplingpoint_col, latest_datetime_col
+from discomapEEA_latest import ingest_latest, read_latest_store
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def latest_url(tmp_path):
+    serve_dir = tmp_path / "serve"
+    serve_dir.mkdir()
+    rows = pd.DataFrame({col: "x" for col in latest_kept_cols}, index=range(3))
+    rows[latest_samplingpoint_col] = ["SP1", "SP1", "SP2"]
+    rows[latest_datetime_col] = ["2021-01-01 00:00:00+01:00", "2021-01-01 01:00:00+01:00", "2021-01-01 00:00:00+01:00"]
+    rows.to_csv(serve_dir / "BE_NO2.csv", index=False)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(serve_dir)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_missing_feed_does_not_stop_the_others(tmp_path, latest_url):
+    engine = DownloadEngine(max_workers=2, retries=0, cache=HttpCache(str(tmp_path / "cache")))
+    store_dir = str(tmp_path / "store")
+    report = ingest_latest(["BE"], ["NO2", "CO"], engine=engine, store_dir=store_dir, latest_url=latest_url)
+    report = report.set_index("feed")
+    assert report.loc["BE_NO2", "new_rows"] == 3 and report.loc["BE_NO2", "error"] is None
+    assert report.loc["BE_CO", "new_rows"] == 0 and "404" in report.loc["BE_CO", "error"]
+    assert len(read_latest_store(store_dir)) == 3
+    report = ingest_latest(["BE"], ["NO2"], engine=engine, store_dir=store_dir, latest_url=latest_url)
+    assert report["not_modified"].tolist() == [True] and report["new_rows"].tolist() == [0]
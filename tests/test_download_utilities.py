@@ -0,0 +1,133 @@
+import json
+import os
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from download_utilities import HttpCache, DownloadEngine
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Local stand-in of the download servers:
+    /item/<n> answers n after a random delay, /flaky/<name> answers 503 to the first two requests of every name and
+    /etag answers 304 to requests revalidating its ETag"""
+    flaky_counts = {}
+    lock = threading.Lock()
+
+    def send_body(self, body, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/item/"):
+            time.sleep(random.uniform(0., 0.02))
+            self.send_body(self.path.split("/")[-1].encode())
+        elif self.path.startswith("/flaky/"):
+            with self.lock:
+                count = self.flaky_counts.get(self.path, 0)
+                self.flaky_counts[self.path] = count + 1
+            if count < 2:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_body(b"ok")
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.send_body(b"etag body", {"ETag": '"v1"'})
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def read_index(cache_dir):
+    with open(os.path.join(cache_dir, HttpCache.index_file_name), "r") as f:
+        return json.load(f)
+
+
+def test_cache_index_saved_in_batches(tmp_path):
+    cache = HttpCache(str(tmp_path), save_every=3)
+    cache.store("http://host/a", b"a", {"ETag": '"a"'})
+    cache.read("http://host/a")
+    assert read_index(str(tmp_path)) == {}
+    cache.read("http://host/a")
+    assert list(read_index(str(tmp_path))) == [cache.get_key("http://host/a")]
+    cache.read("http://host/a")
+    cache.close()
+    assert read_index(str(tmp_path)) == cache.index
+    assert HttpCache(str(tmp_path)).read("http://host/a") == b"a"
+
+
+def test_cache_eviction_saves_index(tmp_path):
+    with HttpCache(str(tmp_path), max_bytes=3, save_every=100) as cache:
+        cache.store("http://host/a", b"aa", {})
+        cache.store("http://host/b", b"bb", {})
+        assert cache.evictions == 1
+        assert list(read_index(str(tmp_path))) == [cache.get_key("http://host/b")]
+        assert cache.stats()["bytes"] == 2
+
+
+def test_engine_map_keeps_order(server_url):
+    engine = DownloadEngine(max_workers=8)
+    items = list(range(40))
+    assert engine.map(lambda i: engine.get(f"{server_url}/item/{i}"), items) == [str(i).encode() for i in items]
+    assert engine.throughput()["files"] == len(items)
+
+
+def test_engine_retries_503(server_url):
+    engine = DownloadEngine(max_workers=2, retries=3, backoff_factor=0.01)
+    assert engine.get(f"{server_url}/flaky/a") == b"ok"
+    assert engine.throughput()["retries"] == 2
+
+
+def test_engine_gives_up_after_retries(server_url):
+    engine = DownloadEngine(max_workers=2, retries=1, backoff_factor=0.01)
+    with pytest.raises(requests.HTTPError):
+        engine.get(f"{server_url}/flaky/b")
+
+
+def test_engine_rate_limit_and_throughput(server_url):
+    engine = DownloadEngine(max_workers=8, rate_limit=20)
+    start = time.perf_counter()
+    engine.map(lambda i: engine.get(f"{server_url}/item/{i}"), range(11))
+    elapsed = time.perf_counter() - start
+    # 11 requests to one host at 20 per second need at least 10 intervals of 0.05s
+    assert elapsed >= 0.5
+    stats = engine.throughput()
+    assert stats["files"] == 11
+    assert stats["bytes"] == sum(len(str(i)) for i in range(11))
+    assert stats["files_per_s"] <= 20 * 1.1
+
+
+def test_engine_revalidation_returns_cached_content(server_url, tmp_path):
+    engine = DownloadEngine(max_workers=2, cache=HttpCache(str(tmp_path)))
+    assert engine.fetch(f"{server_url}/etag") == (b"etag body", False)
+    assert engine.fetch(f"{server_url}/etag") == (b"etag body", True)
+    with engine.open_stream(f"{server_url}/etag") as (f, not_modified):
+        assert not_modified and f.read() == b"etag body"
+    assert engine.cache.stats()["hits"] == 2
@@ -0,0 +1,46 @@
+import os
+import shutil
+
+import pandas as pd
+
+from madrid_extract import incremental_extract
+from madrid_utilities import station_col, pollutant_col, datetime_col
+from pipeline_benchmark import write_madrid_csvs
+from store_utilities import read_partitioned_dataset
+
+
+def read_sorted(dataset_dir):
+    df = read_partitioned_dataset(dataset_dir)
+    return df.sort_values([station_col, pollutant_col, datetime_col]).reset_index(drop=True)
+
+
+def test_incremental_equals_full_rebuild(tmp_path):
+    data_dir, dataset_dir = str(tmp_path / "data"), str(tmp_path / "dataset")
+    write_madrid_csvs(data_dir, n_years=2, n_stations=3, n_pollutants=2, first_year=2010)
+    incremental_extract(data_dir, dataset_dir, use_hash=True)
+
+    # Modified file: same name, different values
+    changed = os.path.join(data_dir, "2011", "05_2011.csv")
+    df = pd.read_csv(changed, sep=";")
+    df[[f"H{h:02d}" for h in range(1, 25)]] *= 2
+    df.to_csv(changed, sep=";", index=False)
+    # Added file: one month of a new year
+    new_dir = str(tmp_path / "new")
+    write_madrid_csvs(new_dir, n_years=1, n_stations=3, n_pollutants=2, first_year=2012, seed=1)
+    os.makedirs(os.path.join(data_dir, "2012"))
+    shutil.copy(os.path.join(new_dir, "2012", "01_2012.csv"), os.path.join(data_dir, "2012", "01_2012.csv"))
+    # Removed file
+    os.remove(os.path.join(data_dir, "2010", "03_2010.csv"))
+
+    report = incremental_extract(data_dir, dataset_dir, use_hash=True)
+    assert report["changed"] == [os.path.join("2011", "05_2011.csv")]
+    assert report["added"] == [os.path.join("2012", "01_2012.csv")]
+    assert report["removed"] == [os.path.join("2010", "03_2010.csv")]
+    incremental_df = read_sorted(dataset_dir)
+
+    full_dir = str(tmp_path / "full")
+    incremental_extract(data_dir, full_dir, use_hash=True, full_rebuild=True)
+    full_df = read_sorted(full_dir)
+    pd.testing.assert_frame_equal(incremental_df, full_df)
+    assert not (incremental_df[datetime_col].dt.month.eq(3) & incremental_df[datetime_col].dt.year.eq(2010)).any()
+    assert incremental_df[datetime_col].dt.year.eq(2012).any()
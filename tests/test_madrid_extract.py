@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from madrid_extract import convert_from_year_df, fast_convert_from_year_df
+from madrid_utilities import station_col, pollutant_col
+
+
+def make_year_df(n_rows=40, n_hours=24, seed=0):
+    """Returns synthetic year data with interleaved hour and validity columns, as in the monthly csv files"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2019-02-20", periods=n_rows // 2, freq="D").repeat(2)
+    df = pd.DataFrame({station_col: np.tile([28079004, 28079008], n_rows // 2),
+                       pollutant_col: np.tile([8, 12], n_rows // 2),
+                       "ANO": dates.year, "MES": dates.month, "DIA": dates.day})
+    for hour in range(1, n_hours + 1):
+        # Integer concentrations and validity flags with invalid "N" values
+        df[f"H{hour:02d}"] = rng.integers(0, 200, n_rows)
+        df[f"V{hour:02d}"] = rng.choice(["V", "N"], n_rows, p=[0.8, 0.2])
+    return df
+
+
+def test_fast_convert_parity():
+    df = make_year_df()
+    pd.testing.assert_frame_equal(fast_convert_from_year_df(df), convert_from_year_df(df))
+
+
+def test_fast_convert_parity_duplicated_index():
+    df = make_year_df(seed=1)
+    df.index = np.repeat(np.arange(len(df) // 2), 2)
+    pd.testing.assert_frame_equal(fast_convert_from_year_df(df), convert_from_year_df(df))
+
+
+def test_fast_convert_parity_float_values():
+    df = make_year_df(n_hours=6, seed=2)
+    df["H03"] = df["H03"] / 10.
+    pd.testing.assert_frame_equal(fast_convert_from_year_df(df), convert_from_year_df(df))
@@ -0,0 +1,26 @@
+import numpy as np
+
+from metrics_utilities import MetricsRecorder
+
+
+def test_traced_peak_is_per_stage():
+    metrics = MetricsRecorder(trace_memory=True)
+    with metrics.stage("outer"):
+        values = np.ones(10_000_000)
+        del values
+        with metrics.stage("inner"):
+            values = np.ones(1_000_000)
+    with metrics.stage("later"):
+        values = np.ones(100)
+    peaks = metrics.to_frame().set_index("stage")["peak_traced_mb"]
+    assert 80 <= peaks["outer"] < 81 and 8 <= peaks["inner"] < 9 and peaks["later"] < 1
+
+
+def test_spawned_records_are_extended():
+    metrics = MetricsRecorder(profile_stages=["x"], trace_memory=True)
+    worker = metrics.spawn()
+    assert worker.records == [] and worker.trace_memory and worker.profile_stages == {"x"}
+    with worker.stage("work", year=2019) as stage:
+        stage.add(rows_out=3)
+    metrics.extend(worker.records)
+    assert metrics.to_frame()[["stage", "partition", "rows_out"]].values.tolist() == [["work", "year=2019", 3]]
@@ -0,0 +1,23 @@
+import pandas as pd
+import pytest
+
+from madrid_extract import extract_all_ts
+from pipeline_benchmark import write_madrid_csvs
+
+
+@pytest.fixture(scope="module")
+def data_dirs(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp("data"))
+    zip_dir = str(tmp_path_factory.mktemp("zips"))
+    write_madrid_csvs(data_dir, n_years=2, n_stations=3, n_pollutants=3, zip_dir=zip_dir)
+    return data_dir, zip_dir
+
+
+@pytest.mark.parametrize("per_file, from_zip, compact", [(False, False, False), (True, False, True),
+                                                          (False, True, True), (True, True, False)])
+def test_parallel_equals_serial(data_dirs, per_file, from_zip, compact):
+    data_dir = data_dirs[1] if from_zip else data_dirs[0]
+    serial = extract_all_ts(data_dir, n_jobs=1, from_zip=from_zip, compact=compact)
+    parallel = extract_all_ts(data_dir, n_jobs=2, per_file=per_file, from_zip=from_zip, compact=compact)
+    assert len(serial) > 0
+    pd.testing.assert_frame_equal(parallel, serial)
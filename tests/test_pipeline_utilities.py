@@ -0,0 +1,35 @@
+import sys
+import importlib
+
+from pipeline_utilities import Pipeline
+
+
+def write_module(path, factor):
+    path.write_text(f"def scale(x):\n    return x * {factor}\n")
+
+
+def double_stage(x):
+    import dep_module
+    return dep_module.scale(x)
+
+
+def test_editing_a_dependency_invalidates_the_stage(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+    write_module(tmp_path / "dep_module.py", 2)
+    import dep_module
+
+    def run(version=None):
+        pipeline = Pipeline(str(tmp_path / "cache"))
+        pipeline.add_stage("double", double_stage, params={"x": 3}, deps=[dep_module], version=version)
+        outputs, report = pipeline.run()
+        return outputs["double"], report["status"][0]
+
+    assert run() == (6, "ran")
+    assert run() == (6, "cached")
+    write_module(tmp_path / "dep_module.py", 10)
+    importlib.reload(dep_module)
+    assert run() == (30, "ran")
+    assert run(version=2) == (30, "ran")
+    assert run(version=2) == (30, "cached")
+    sys.modules.pop("dep_module")
@@ -0,0 +1,18 @@
+import os
+
+import pandas as pd
+
+from render_utilities import make_heatmap_job, render_heatmaps, hash_suffix
+
+
+def make_job(tmp_path, name):
+    corr = pd.DataFrame([[1., 0.5], [0.5, 1.]], index=["a", "b"], columns=["a", "b"])
+    return make_heatmap_job(corr, title=name, xlabel="x", ylabel="y", png_path=str(tmp_path / f"{name}.png"))
+
+
+def test_stale_heatmaps_are_removed(tmp_path):
+    jobs = [make_job(tmp_path, "kept"), make_job(tmp_path, "stale")]
+    assert render_heatmaps(jobs, n_jobs=1) == {"rendered": 2, "skipped": 0, "removed": 0}
+    (tmp_path / "kept_corr.pkl").write_bytes(b"")
+    assert render_heatmaps(jobs[:1], n_jobs=1, remove_stale=True) == {"rendered": 0, "skipped": 1, "removed": 1}
+    assert sorted(os.listdir(tmp_path)) == ["kept.png", "kept.png" + hash_suffix, "kept_corr.pkl"]
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from madrid_utilities import station_col, pollutant_col, datetime_col, concentration_col
+from rollup_utilities import build_rollups, query_rollups, aggregate_buckets, get_bucket_starts, get_bucket_ends, \
+    count_col, mean_col, min_col, max_col
+from store_utilities import write_partitioned_dataset, read_partitioned_dataset
+
+
+def make_long_df(stations=(4, 8), first="2019-12-20", last="2021-01-10 23:00", seed=0):
+    rng = np.random.default_rng(seed)
+    datetimes = pd.date_range(first, last, freq="h")
+    df = pd.DataFrame([(station, pollutant, date) for station in stations for pollutant in ["NO2", "O3"]
+                       for date in datetimes], columns=[station_col, pollutant_col, datetime_col])
+    df[concentration_col] = rng.gamma(2., 10., len(df))
+    df.loc[rng.random(len(df)) < 0.1, concentration_col] = np.nan
+    return df
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    dataset_dir = str(tmp_path / "dataset")
+    write_partitioned_dataset(make_long_df(), dataset_dir)
+    return dataset_dir
+
+
+def expected_aggregates(dataset_dir, freq, date_from=None, date_to=None):
+    df = read_partitioned_dataset(dataset_dir, date_from=date_from, date_to=date_to)
+    return aggregate_buckets(df, df[datetime_col].dt.to_period(freq).dt.start_time, quantiles=())
+
+
+def assert_aggregates_equal(res, expected):
+    cols = [station_col, pollutant_col, datetime_col, count_col, mean_col, min_col, max_col]
+    pd.testing.assert_frame_equal(res[cols].reset_index(drop=True), expected[cols].reset_index(drop=True),
+                                  check_dtype=False, check_categorical=False)
+
+
+def test_bucket_edges():
+    datetimes = pd.Series(pd.to_datetime(["2020-02-29 23:00", "2020-12-31 05:00", "2021-01-01 00:00",
+                                          "2021-01-03 23:00"]))
+    expected = {"day": (["2020-02-29", "2020-12-31", "2021-01-01", "2021-01-03"],
+                        ["2020-03-01", "2021-01-01", "2021-01-02", "2021-01-04"]),
+                # Weeks start on Monday and are split at the year boundaries
+                "week": (["2020-02-24", "2020-12-28", "2021-01-01", "2021-01-01"],
+                         ["2020-03-02", "2021-01-01", "2021-01-04", "2021-01-04"]),
+                "month": (["2020-02-01", "2020-12-01", "2021-01-01", "2021-01-01"],
+                          ["2020-03-01", "2021-01-01", "2021-02-01", "2021-02-01"]),
+                "year": (["2020-01-01", "2020-01-01", "2021-01-01", "2021-01-01"],
+                         ["2021-01-01", "2021-01-01", "2022-01-01", "2022-01-01"])}
+    for level, (starts, ends) in expected.items():
+        bucket_starts = get_bucket_starts(datetimes, level)
+        assert bucket_starts.tolist() == pd.to_datetime(starts).tolist()
+        assert get_bucket_ends(bucket_starts, level).tolist() == pd.to_datetime(ends).tolist()
+
+
+@pytest.mark.parametrize("freq, date_from, date_to, with_quantiles, level", [
+    ("A", None, None, False, "year"),
+    ("M", None, None, False, "month"),
+    ("W", None, None, False, "week"),
+    ("W", None, None, True, "hour"),
+    ("D", None, None, True, "day"),
+    ("M", "2020-03-15", "2020-06-30 23:00", False, "day"),
+    ("Q", "2020-01-01", "2020-12-31 23:00", False, "month"),
+    ("H", "2020-05-01", "2020-05-02", False, "hour")])
+def test_query_level_and_values(dataset_dir, freq, date_from, date_to, with_quantiles, level):
+    build_rollups(dataset_dir)
+    res, used_level = query_rollups(dataset_dir, freq=freq, date_from=date_from, date_to=date_to,
+                                    with_quantiles=with_quantiles)
+    assert used_level == level
+    assert_aggregates_equal(res, expected_aggregates(dataset_dir, freq, date_from=date_from, date_to=date_to))
+
+
+def test_incremental_rebuild(dataset_dir):
+    assert build_rollups(dataset_dir)["status"].tolist() == ["built"] * 3
+    assert build_rollups(dataset_dir)["status"].tolist() == ["cached"] * 3
+    # A new station in the hourly files of 2020: the rollups of 2020 are stale until they are rebuilt
+    write_partitioned_dataset(make_long_df(stations=(99,), first="2020-06-01", last="2020-06-30 23:00"), dataset_dir,
+                              part_name="extra")
+    res, level = query_rollups(dataset_dir, freq="M")
+    assert level == "hour" and 99 in res[station_col].tolist()
+    assert query_rollups(dataset_dir, freq="M", date_from="2021-01-01")[1] == "month"
+    assert build_rollups(dataset_dir)["status"].tolist() == ["cached", "built", "cached"]
+    res, level = query_rollups(dataset_dir, freq="M")
+    assert level == "month"
+    assert_aggregates_equal(res, expected_aggregates(dataset_dir, "M"))
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stat_utilities import StatAccumulator, default_sketch_edges
+
+
+def make_accumulator(datetimes, values, sketch_edges=default_sketch_edges):
+    return StatAccumulator("station", 1, ["a", "b"], sketch_edges=sketch_edges).update_values(datetimes, values)
+
+
+def test_merge_equals_single_pass():
+    rng = np.random.default_rng(0)
+    datetimes = pd.date_range("2019-01-01", periods=100, freq="h")
+    values = rng.gamma(2., 10., size=(100, 2))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    merged = make_accumulator(datetimes[:40], values[:40]).merge(make_accumulator(datetimes[40:], values[40:]))
+    single = make_accumulator(datetimes, values)
+    np.testing.assert_allclose(merged.mean, single.mean)
+    np.testing.assert_allclose(merged.m2, single.m2)
+    np.testing.assert_array_equal(merged.sketch.counts, single.sketch.counts)
+
+
+def test_merge_rejects_partial_sketches():
+    datetimes = pd.date_range("2019-01-01", periods=10, freq="h")
+    values = np.ones((10, 2))
+    with pytest.raises(ValueError):
+        make_accumulator(datetimes, values).merge(make_accumulator(datetimes, values, sketch_edges=None))
+    with pytest.raises(ValueError):
+        make_accumulator(datetimes, values, sketch_edges=None).merge(make_accumulator(datetimes, values))
+
+
+@pytest.mark.parametrize("scale", [0.2, 20.])
+def test_sketch_quantiles_relative_precision(scale):
+    # CO readings in mg/m3 are two orders of magnitude smaller than NO2 readings in ug/m3
+    rng = np.random.default_rng(0)
+    datetimes = pd.date_range("2019-01-01", periods=5000, freq="h")
+    values = rng.gamma(2., scale, size=(5000, 2))
+    quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+    stat_dict = make_accumulator(datetimes, values).to_stat_dict(quantiles=quantiles)
+    for j, col in enumerate(["a", "b"]):
+        np.testing.assert_allclose(list(stat_dict["quantile_dict"][col].values()),
+                                   np.quantile(values[:, j], quantiles), rtol=0.01)
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from window_utilities import WindowGenerator, windows_from_pivot_df
+from madrid_utilities import datetime_col, station_col
+
+
+def make_values(n_times=500, n_columns=3, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(n_times, n_columns))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[100:130, 1] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("stride, target_columns, max_input_nan, max_target_nan", [
+    (1, None, 0., 0.), (3, slice(1, 3), 0.1, 0.), (5, 2, 0.2, 0.5), (2, [2, 0], 0.05, 0.25)])
+def test_nan_filter_matches_brute_force(stride, target_columns, max_input_nan, max_target_nan):
+    values = make_values()
+    input_length, horizon = 12, 3
+    generator = WindowGenerator(values, input_length, horizon=horizon, stride=stride, target_columns=target_columns,
+                                max_input_nan=max_input_nan, max_target_nan=max_target_nan)
+    targets = slice(None) if target_columns is None else target_columns
+    expected = []
+    for start in range(0, len(values) - input_length - horizon + 1, stride):
+        inputs = values[start:start + input_length]
+        target = values[start + input_length:start + input_length + horizon][:, targets]
+        if np.isnan(inputs).mean() <= max_input_nan and np.isnan(target).mean() <= max_target_nan:
+            expected.append(start)
+    np.testing.assert_array_equal(generator.starts, expected)
+    for i, start in enumerate(expected):
+        inputs, target = generator[i]
+        np.testing.assert_array_equal(inputs, values[start:start + input_length])
+        np.testing.assert_array_equal(target, values[start + input_length:start + input_length + horizon][:, targets])
+
+
+def test_windows_are_views(tmp_path):
+    path = str(tmp_path / "values.npy")
+    np.save(path, make_values())
+    values = np.load(path, mmap_mode="r")
+    generator = WindowGenerator(values, 24, horizon=6, target_columns=slice(0, 2), max_input_nan=1., max_target_nan=1.)
+    inputs, targets = generator[10]
+    assert np.shares_memory(inputs, values) and np.shares_memory(targets, values)
+    batch_inputs, _ = next(generator.batches(4))
+    assert not np.shares_memory(batch_inputs, values)
+
+
+def test_time_axis():
+    values = make_values(n_columns=4).reshape(500, 2, 2)
+    # (station, time, pollutant) as a station slice of a TimeSeriesCube transposed
+    generator = WindowGenerator(values.transpose(1, 0, 2), 24, horizon=2, time_axis=1, max_input_nan=0.1,
+                                max_target_nan=0.5)
+    expected = WindowGenerator(values, 24, horizon=2, max_input_nan=0.1, max_target_nan=0.5)
+    np.testing.assert_array_equal(generator.starts, expected.starts)
+    inputs, targets = generator[0]
+    assert inputs.shape == (24, 2, 2) and targets.shape == (2, 2, 2)
+    np.testing.assert_array_equal(inputs, expected[0][0])
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_batches(drop_last):
+    generator = WindowGenerator(make_values(), 12, horizon=2, max_input_nan=1., max_target_nan=1.)
+    batch_size = 32
+    batches = list(generator.batches(batch_size, shuffle=True, seed=1, drop_last=drop_last))
+    n_full = len(generator) // batch_size
+    assert len(batches) == n_full + (0 if drop_last or len(generator) % batch_size == 0 else 1)
+    assert all(inputs.shape == (batch_size, 12, 3) and targets.shape == (batch_size, 2, 3)
+               for inputs, targets in batches[:n_full])
+    first_inputs = np.concatenate([inputs[:, 0] for inputs, _ in batches])
+    all_first_inputs = np.stack([generator[i][0][0] for i in range(len(generator))])
+    if not drop_last:
+        # Every window exactly once, in another order
+        assert not np.array_equal(first_inputs, all_first_inputs, equal_nan=True)
+        order = np.lexsort(np.nan_to_num(first_inputs, nan=9.).T)
+        expected_order = np.lexsort(np.nan_to_num(all_first_inputs, nan=9.).T)
+        np.testing.assert_array_equal(first_inputs[order], all_first_inputs[expected_order])
+    same_seed = np.concatenate([inputs[:, 0] for inputs, _ in
+                                generator.batches(batch_size, shuffle=True, seed=1, drop_last=drop_last)])
+    np.testing.assert_array_equal(same_seed, first_inputs)
+
+
+def test_windows_from_pivot_df():
+    datetimes = pd.date_range("2020-01-01", periods=100, freq="h")
+    df = pd.DataFrame({datetime_col: datetimes, station_col: 4, "NO2": np.arange(100.), "O3": np.arange(100.) * 2,
+                       "CO": np.arange(100.) * 3})
+    # A missing hour is filled with np.nan
+    generator, pivot_columns = windows_from_pivot_df(df.drop(50).sample(frac=1., random_state=0), station_col, 10,
+                                                     target_columns=["O3", "CO"])
+    assert pivot_columns == ["NO2", "O3", "CO"] and generator.target_columns == slice(1, 3)
+    assert len(generator) == 100 - 11 + 1 - 11
+    assert generator.window_datetime(0) == datetimes[0]
+    np.testing.assert_array_equal(generator[0][1], [[20., 30.]])
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from madrid_utilities import datetime_col
+
+# Number of time steps whose missing values are counted at a time, bounds the memory of the NaN filter on
+# memory-mapped arrays
+nan_count_block = 1 << 16
+
+
+def to_regular_array(df, discriminant_column, freq="h"):
+    """Returns the values of a pivoted dataframe, as returned by madrid_analysis.smart_pivot or fast_pivot, on a
+    regular time grid: rows are sorted by datetime and missing datetimes are filled with np.nan. This is the only
+    copy needed by WindowGenerator and it is skipped when the dataframe is already regular and float.
+
+    :param df: pivoted dataframe
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant, dropped with the datetime column
+    :type discriminant_column: str
+    :param freq: frequency of the time grid
+    :type freq: str
+    :return: (array (datetime, pivot), datetime labels, pivot labels)
+    :rtype: tuple
+    """
+    pivot_columns = [col for col in df.columns if col not in [datetime_col, discriminant_column]]
+    datetimes = pd.DatetimeIndex(df[datetime_col])
+    grid = pd.date_range(datetimes.min(), datetimes.max(), freq=freq)
+    values_df = df[pivot_columns]
+    if not (len(datetimes) == len(grid) and datetimes.equals(grid)):
+        values_df = values_df.set_axis(datetimes, axis=0).sort_index().reindex(grid)
+    return values_df.to_numpy(dtype=float), grid, pivot_columns
+
+
+def count_nan(values, columns=slice(None)):
+    """Returns the cumulated number of missing values of every time step, counted one block at a time
+
+    :param values: array (time, column)
+    :type values: np.ndarray
+    :param columns: columns to count, index, slice or list of indices
+    :type columns: int or slice or list
+    :return: array (time + 1,), element t is the number of missing values before time step t
+    :rtype: np.ndarray
+    """
+    counts = np.zeros(len(values) + 1, dtype=np.int64)
+    for start in range(0, len(values), nan_count_block):
+        block = values[start:start + nan_count_block][:, columns]
+        counts[start + 1:start + 1 + len(block)] = np.isnan(block).reshape(len(block), -1).sum(axis=1)
+    return np.cumsum(counts)
+
+
+class WindowGenerator:
+    """Input and target windows of a regular multivariate time series for model training. Windows are strided views
+    of values, selected once by the NaN filter: single windows are returned without copying the data, batches are
+    copied only when they are built for the consumer. values can be a memory-mapped array, e.g. a slice of
+    cube_utilities.TimeSeriesCube.values, or the array of to_regular_array.
+
+    The window starting at time step t has the input values[t:t + input_length] and the target
+    values[t + input_length:t + input_length + horizon, target_columns].
+
+    :param values: regular time series, array (time, column) or with time on time_axis
+    :type values: np.ndarray
+    :param input_length: number of time steps of the input windows
+    :type input_length: int
+    :param horizon: number of time steps of the target windows
+    :type horizon: int
+    :param stride: number of time steps between the starts of consecutive windows
+    :type stride: int
+    :param target_columns: column index or slice of the target columns, None means all of them. A list of indices is
+        accepted too but its target windows are copies.
+    :type target_columns: int or slice
+    :param max_input_nan: maximum fraction of missing values of an input window
+    :type max_input_nan: float
+    :param max_target_nan: maximum fraction of missing values of a target window
+    :type max_target_nan: float
+    :param time_axis: axis of values indexing time steps, e.g. 1 for a station of a TimeSeriesCube
+    :type time_axis: int
+    :param datetimes: datetime of every time step, used by window_datetime
+    :type datetimes: pd.DatetimeIndex
+    """
+
+    def __init__(self, values, input_length, horizon=1, stride=1, target_columns=None, max_input_nan=0.,
+                 max_target_nan=0., time_axis=0, datetimes=None):
+        if input_length < 1 or horizon < 1 or stride < 1:
+            raise ValueError("input_length, horizon and stride must be positive")
+        values = np.moveaxis(values, time_axis, 0)
+        self.values = values.reshape(len(values), -1) if values.ndim == 1 else values
+        self.input_length = input_length
+        self.horizon = horizon
+        self.stride = stride
+        self.target_columns = slice(None) if target_columns is None else target_columns
+        self.datetimes = datetimes
+        window_length = input_length + horizon
+        if len(self.values) < window_length:
+            self.windows = np.empty((0, window_length) + self.values.shape[1:], dtype=self.values.dtype)
+            self.starts = np.empty(0, dtype=np.int64)
+            return
+        # (start, column, time) view moved to (start, time, column)
+        self.windows = np.moveaxis(sliding_window_view(self.values, window_length, axis=0), -1, 1)
+        starts = np.arange(0, len(self.values) - window_length + 1, stride)
+        input_nan = count_nan(self.values)
+        target_nan = count_nan(self.values, self.target_columns)
+        input_size = input_length * np.prod(self.values.shape[1:], dtype=np.int64)
+        target_size = horizon * np.prod(self.values[:1][:, self.target_columns].shape[1:], dtype=np.int64)
+        keep = (input_nan[starts + input_length] - input_nan[starts] <= max_input_nan * input_size) & \
+               (target_nan[starts + window_length] - target_nan[starts + input_length] <= max_target_nan * target_size)
+        self.starts = starts[keep]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        """Returns a window without copying it
+
+        :param i: window index
+        :type i: int
+        :return: (input view (input_length, column), target view (horizon, target column))
+        :rtype: tuple
+        """
+        window = self.windows[self.starts[i]]
+        return window[:self.input_length], window[self.input_length:, self.target_columns]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def window_datetime(self, i):
+        """Returns the datetime of the first time step of a window
+
+        :param i: window index
+        :type i: int
+        :return: datetime
+        :rtype: pd.Timestamp
+        """
+        return self.datetimes[self.starts[i]]
+
+    def batches(self, batch_size, shuffle=False, seed=None, drop_last=False):
+        """Yields batches of windows, shuffling only the window indices
+
+        :param batch_size: number of windows of every batch
+        :type batch_size: int
+        :param shuffle: whether to shuffle the windows
+        :type shuffle: bool
+        :param seed: seed of the shuffling
+        :type seed: int
+        :param drop_last: whether to drop the last batch if it is smaller than batch_size
+        :type drop_last: bool
+        :return: generator of (inputs (batch, input_length, column), targets (batch, horizon, target column))
+        :rtype: generator
+        """
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            index = order[start:start + batch_size]
+            if drop_last and len(index) < batch_size:
+                return
+            batch = self.windows[self.starts[index]]
+            yield batch[:, :self.input_length], batch[:, self.input_length:, self.target_columns]
+
+
+def windows_from_pivot_df(df, discriminant_column, input_length, freq="h", **kwargs):
+    """Returns the window generator of a pivoted dataframe, e.g. a *_df.pkl file saved by madrid_analysis
+
+    :param df: pivoted dataframe
+    :type df: pd.DataFrame
+    :param discriminant_column: column acting as discriminant
+    :type discriminant_column: str
+    :param input_length: number of time steps of the input windows
+    :type input_length: int
+    :param freq: frequency of the time grid, see to_regular_array
+    :type freq: str
+    :param kwargs: other parameters of WindowGenerator, target_columns are given as pivot labels. Consecutive labels
+        are converted to a slice, so that their target windows are views.
+    :return: (window generator, pivot labels)
+    :rtype: tuple
+    """
+    values, grid, pivot_columns = to_regular_array(df, discriminant_column, freq=freq)
+    target_columns = kwargs.pop("target_columns", None)
+    if isinstance(target_columns, (list, tuple)):
+        positions = [pivot_columns.index(str(col)) for col in target_columns]
+        if positions == list(range(positions[0], positions[0] + len(positions))):
+            target_columns = slice(positions[0], positions[-1] + 1)
+        else:
+            target_columns = positions
+    elif target_columns is not None:
+        target_columns = pivot_columns.index(str(target_columns))
+    return WindowGenerator(values, input_length, target_columns=target_columns, datetimes=grid, **kwargs), \
+        pivot_columns